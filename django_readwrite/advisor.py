@@ -0,0 +1,209 @@
+"""
+A routing advisor, for finding views which could use a read-only database.
+It is enabled by the READWRITE_ROUTING_ADVISOR setting.
+
+For every request, it records the view, how the database was chosen (by
+the HTTP_PATHS, HTTP_METHODS or view decorators), whether any write
+queries were run, and the number and time of queries on each database.
+These are added up per view and request method in a bounded table.
+
+Every READWRITE_ROUTING_ADVISOR_FLUSH_INTERVAL seconds, each process
+stores its table in Django's cache backend, where the readwrite_advisor
+management command can read and combine them into a report.
+
+"""
+
+import os
+import socket
+import threading
+import time
+
+from django.core.cache import cache as cache_backend
+
+from django_readwrite import settings as config
+from django_readwrite.connection import request_state
+from django_readwrite.cursors import query_observers
+from django_readwrite.utils import LRUCache
+
+
+# The cache key listing the cache keys of every process's table, and the
+# cache key for when the tables were last cleared by the command.
+INDEX_KEY = 'readwrite.advisor'
+CLEARED_KEY = 'readwrite.advisor.cleared'
+
+# The most processes to keep tables for, and how long (in seconds) the
+# table of a process which has stopped is kept.
+MAX_PROCESSES = 100
+TABLE_TIMEOUT = 60 * 60 * 24
+
+
+def get_view_name(view_func):
+    name = getattr(view_func, '__name__', None) or view_func.__class__.__name__
+    return '%s.%s' % (view_func.__module__, name)
+
+
+class RequestRecord(object):
+    """What one request did, according to the query observer."""
+
+    __slots__ = ('routing', 'view', 'wrote', 'databases')
+
+    def __init__(self, routing):
+        self.routing = routing
+        self.view = None
+        self.wrote = False
+        self.databases = {}
+
+
+class ViewRecord(object):
+    """
+    The requests for one view and request method. The databases attribute
+    is a dict of {alias: [count, time]} for the queries on each database,
+    and routing is a dict of {routing: count} for how the database of the
+    requests was chosen.
+
+    """
+
+    def __init__(self, view, method):
+        self.view = view
+        self.method = method
+        self.requests = 0
+        self.writes = 0
+        self.routing = {}
+        self.databases = {}
+
+    def add(self, record):
+        self.requests += 1
+        if record.wrote:
+            self.writes += 1
+        self.routing[record.routing] = self.routing.get(record.routing, 0) + 1
+        for alias, (count, elapsed) in record.databases.items():
+            try:
+                database = self.databases[alias]
+            except KeyError:
+                database = self.databases[alias] = [0, 0.0]
+            database[0] += count
+            database[1] += elapsed
+
+    def merge(self, data):
+        """Adds the counts from another ViewRecord's as_dict()."""
+        self.requests += data['requests']
+        self.writes += data['writes']
+        for routing, count in data['routing'].items():
+            self.routing[routing] = self.routing.get(routing, 0) + count
+        for alias, (count, elapsed) in data['databases'].items():
+            database = self.databases.setdefault(alias, [0, 0.0])
+            database[0] += count
+            database[1] += elapsed
+
+    def as_dict(self):
+        return {
+            'view': self.view,
+            'method': self.method,
+            'requests': self.requests,
+            'writes': self.writes,
+            'routing': dict(self.routing),
+            'databases': dict((alias, list(values)) for alias, values in self.databases.items()),
+        }
+
+
+class RoutingAdvisor(object):
+    """A query observer which records what each view does."""
+
+    def __init__(self, table_size, flush_interval):
+        self.table = LRUCache(table_size)
+        self.flush_interval = flush_interval
+        self.started = self.flushed = time.time()
+        self.lock = threading.Lock()
+        self.cache_key = 'readwrite.advisor:%s:%d' % (socket.gethostname(), os.getpid())
+
+    def start(self, routing):
+        """Starts recording the current request."""
+        request_state.advisor_record = RequestRecord(routing)
+
+    def view(self, view_func, routing=None):
+        """Records the view of the current request, and how it was routed."""
+        record = request_state.advisor_record
+        if record is not None:
+            record.view = get_view_name(view_func)
+            if routing:
+                record.routing = routing
+
+    def finish(self, request):
+        """Adds the current request to the table."""
+        record = request_state.advisor_record
+        if record is None or record.view is None:
+            return
+        request_state.advisor_record = None
+        key = (record.view, request.method)
+        view_record = self.table.get(key)
+        if view_record is None:
+            view_record = ViewRecord(*key)
+            self.table.set(key, view_record)
+        view_record.add(record)
+        if time.time() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def query_executed(self, db, sql, params, read_sql, elapsed):
+        record = request_state.advisor_record
+        if record is not None:
+            if not read_sql:
+                record.wrote = True
+            try:
+                database = record.databases[db.alias]
+            except KeyError:
+                database = record.databases[db.alias] = [0, 0.0]
+            database[0] += 1
+            database[1] += elapsed
+
+    def query_failed(self, db, sql, params, error):
+        pass
+
+    def flush(self):
+        """Stores this process's table in the cache backend."""
+
+        with self.lock:
+            if time.time() - self.flushed < self.flush_interval:
+                # Another thread has just flushed it.
+                return
+            self.flushed = time.time()
+
+        cleared = cache_backend.get(CLEARED_KEY)
+        if cleared and cleared > self.started:
+            self.table.clear()
+            self.started = time.time()
+
+        table = [view_record.as_dict() for view_record in self.table.values()]
+        cache_backend.set(self.cache_key, table, TABLE_TIMEOUT)
+
+        keys = cache_backend.get(INDEX_KEY) or []
+        if self.cache_key not in keys:
+            keys = (keys + [self.cache_key])[-MAX_PROCESSES:]
+            cache_backend.set(INDEX_KEY, keys, TABLE_TIMEOUT)
+
+
+def get_shared_table():
+    """Returns the tables of every process, combined into a list of ViewRecords."""
+    keys = cache_backend.get(INDEX_KEY) or []
+    result = {}
+    for table in cache_backend.get_many(keys).values():
+        for data in table:
+            key = (data['view'], data['method'])
+            if key not in result:
+                result[key] = ViewRecord(*key)
+            result[key].merge(data)
+    return result.values()
+
+
+def clear_shared_table():
+    """Removes the tables of every process, which clear them when they next flush."""
+    keys = cache_backend.get(INDEX_KEY) or []
+    for key in keys:
+        cache_backend.delete(key)
+    cache_backend.delete(INDEX_KEY)
+    cache_backend.set(CLEARED_KEY, time.time(), TABLE_TIMEOUT)
+
+
+routing_advisor = RoutingAdvisor(config.ROUTING_ADVISOR_TABLE_SIZE, config.ROUTING_ADVISOR_FLUSH_INTERVAL)
+
+if config.ROUTING_ADVISOR:
+    query_observers.append(routing_advisor)
@@ -0,0 +1,153 @@
+"""
+Load balancers for choosing a database when more than one is configured
+for a request.
+
+The balancer is chosen with the READWRITE_BALANCER setting, which is the
+import path of a Balancer subclass, and READWRITE_BALANCER_OPTIONS, which
+is a dictionary of keyword arguments to create it with.
+
+"""
+
+import random
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from django_readwrite import settings as config
+from django_readwrite.cursors import query_observers
+
+
+class Balancer(object):
+    """
+    The interface shared by all balancers. Subclasses must implement
+    choose() and may implement the other methods to track usage.
+
+    If observe_queries is True, the balancer will be added to the query
+    observers and have query_executed() called after every query.
+
+    """
+
+    observe_queries = False
+
+    def choose(self, aliases):
+        """Returns one of the given database aliases."""
+        raise NotImplementedError
+
+    def started(self, alias):
+        """Called when a request starts using a database."""
+
+    def finished(self, alias):
+        """Called when a request stops using a database."""
+
+    def query_executed(self, db, sql, params, read_sql, elapsed):
+        """Called after a query, if observe_queries is True."""
+
+    def query_failed(self, db, sql, params, error):
+        """Called after a query fails, if observe_queries is True."""
+
+
+class RandomBalancer(Balancer):
+    """Chooses a database at random. This is the default."""
+
+    def choose(self, aliases):
+        return random.choice(aliases)
+
+
+class WeightedBalancer(Balancer):
+    """
+    Chooses a database at random, in proportion to its WEIGHT option
+    in settings.DATABASES. Databases without a WEIGHT have a weight of 1.
+
+    """
+
+    def __init__(self, weights=None):
+        self.weights = weights or config.WEIGHTS
+
+    def choose(self, aliases):
+        weights = self.weights
+        total = sum(weights.get(alias, 1) for alias in aliases)
+        point = random.uniform(0, total)
+        for alias in aliases:
+            point -= weights.get(alias, 1)
+            if point <= 0:
+                return alias
+        return aliases[-1]
+
+
+class LeastOutstandingBalancer(Balancer):
+    """
+    Picks two databases at random and chooses the one with fewer requests
+    currently using it (power of two choices). This avoids sending
+    everything to the least busy database while still favouring it.
+
+    """
+
+    def __init__(self):
+        self.outstanding = {}
+        self.lock = threading.Lock()
+
+    def load(self, alias):
+        return self.outstanding.get(alias, 0)
+
+    def choose(self, aliases):
+        if len(aliases) == 1:
+            return aliases[0]
+        first, second = random.sample(aliases, 2)
+        if self.load(second) < self.load(first):
+            return second
+        return first
+
+    def started(self, alias):
+        with self.lock:
+            self.outstanding[alias] = self.outstanding.get(alias, 0) + 1
+
+    def finished(self, alias):
+        with self.lock:
+            self.outstanding[alias] = self.outstanding.get(alias, 1) - 1
+
+
+class EWMABalancer(LeastOutstandingBalancer):
+    """
+    Picks two databases at random and chooses the one with the lower
+    exponentially weighted moving average of query time, multiplied by the
+    number of requests currently using it. Databases which have not been
+    used yet are preferred, so that every database gets measured.
+
+    The decay is the weight given to each new query time.
+
+    """
+
+    observe_queries = True
+
+    def __init__(self, decay=0.1):
+        super(EWMABalancer, self).__init__()
+        self.decay = decay
+        self.latencies = {}
+
+    def load(self, alias):
+        return self.latencies.get(alias, 0) * (self.outstanding.get(alias, 0) + 1)
+
+    def query_executed(self, db, sql, params, read_sql, elapsed):
+        alias = db.alias
+        latency = self.latencies.get(alias)
+        if latency is None:
+            self.latencies[alias] = elapsed
+        else:
+            self.latencies[alias] = latency + self.decay * (elapsed - latency)
+
+
+def load_balancer(path, options):
+    """Creates a balancer from its import path and keyword arguments."""
+    module_name, class_name = path.rsplit('.', 1)
+    try:
+        balancer_class = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError) as error:
+        raise ImproperlyConfigured('Error loading balancer %r: %s' % (path, error))
+    return balancer_class(**options)
+
+
+balancer = load_balancer(config.BALANCER, config.BALANCER_OPTIONS)
+
+if balancer.observe_queries:
+    query_observers.append(balancer)
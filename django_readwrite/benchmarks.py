@@ -0,0 +1,240 @@
+"""
+Microbenchmarks for the hot paths of django_readwrite. Run them with the
+readwrite_benchmark management command, or call them directly from a shell.
+
+Each benchmark returns a list of (label, seconds per call) tuples.
+
+"""
+
+import itertools
+import random
+import re
+import sqlite3
+import timeit
+
+from django.db import connections
+
+from django_readwrite import balancers
+from django_readwrite.connection import connection_state, request_state, ConnectionProxy
+from django_readwrite.cursors import query_observers, RestrictedCursorWrapper
+from django_readwrite.paths import PathRouter
+from django_readwrite.profiling import QueryProfiler, QueryStats
+from django_readwrite.readonly import read_only_mode
+from django_readwrite.utils import LRUCache
+
+
+def measure(func, number=100000, repeat=3):
+    """Returns the best time per call of func, in seconds."""
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def connection_attribute_access(number=100000):
+    """
+    Compares the cost of an attribute lookup on a patched connection when
+    the active connection is looked up on every access (the behaviour before
+    connections were bound) against the bound lookup used by ConnectionProxy.
+
+    """
+
+    connection = connections[connection_state.alias]
+
+    def per_access():
+        alias = connection_state.alias
+        target = alias and connections[alias] or connection
+        return super(ConnectionProxy, target).__getattribute__('alias')
+
+    def bound():
+        return connection.alias
+
+    return [
+        ('connection attribute (looked up per access)', measure(per_access, number)),
+        ('connection attribute (bound)', measure(bound, number)),
+    ]
+
+
+def balancer_choice(number=100000):
+    """
+    Compares the cost of each load balancer choosing a database, including
+    the calls made when the request starts and finishes using it.
+
+    """
+
+    class FakeDatabase(object):
+        alias = None
+
+    aliases = ['replica%d' % index for index in range(1, 5)]
+    weights = dict((alias, index + 1) for index, alias in enumerate(aliases))
+    db = FakeDatabase()
+
+    results = []
+    for balancer in (
+        balancers.RandomBalancer(),
+        balancers.WeightedBalancer(weights),
+        balancers.LeastOutstandingBalancer(),
+        balancers.EWMABalancer(),
+    ):
+        def request(balancer=balancer):
+            db.alias = alias = balancer.choose(aliases)
+            balancer.started(alias)
+            if balancer.observe_queries:
+                balancer.query_executed(db, 'SELECT 1', (), True, 0.001)
+            balancer.finished(alias)
+        label = 'balancer request (%s)' % balancer.__class__.__name__
+        results.append((label, measure(request, number)))
+    return results
+
+
+def url_corpus(size=10000, seed=0):
+    """
+    Returns a list of request paths resembling real traffic: a few very
+    popular pages, and a long tail of detail pages with numeric ids.
+
+    """
+    rng = random.Random(seed)
+    popular = ['/', '/search/', '/login/', '/cart/', '/api/v1/session/']
+    sections = ['products', 'category', 'reviews', 'users', 'api/v1/items', 'admin/orders']
+    paths = []
+    for i in range(size):
+        if rng.random() < 0.5:
+            paths.append(rng.choice(popular))
+        else:
+            section = rng.choice(sections)
+            paths.append('/%s/%d/' % (section, int(rng.paretovariate(1.2) * 10)))
+    return paths
+
+
+def path_routing(number=100000):
+    """
+    Compares matching a realistic corpus of request paths against the
+    HTTP_PATHS prefixes of many databases: with one regex per database
+    (the behaviour before PathRouter), with the PathRouter trie, and with
+    the PathRouter LRU cache in front of the trie.
+
+    """
+
+    path_prefixes = {}
+    for index in range(10):
+        path_prefixes['db%d' % index] = ['/admin/', '/api/v%d/' % index, '/section%d/' % index]
+    regexes = dict(
+        (alias, re.compile(r'^(%s)' % '|'.join(re.escape(path) for path in paths)))
+        for alias, paths in path_prefixes.items()
+    )
+    router = PathRouter(path_prefixes, cache_size=1000)
+    paths = itertools.cycle(url_corpus())
+
+    def regex_per_database():
+        path = next(paths)
+        return [alias for alias, regex in regexes.items() if regex.search(path)]
+
+    def trie():
+        return router._match(next(paths))
+
+    def cached():
+        return router.match(next(paths))
+
+    results = [
+        ('path routing (regex per database)', measure(regex_per_database, number)),
+        ('path routing (trie)', measure(trie, number)),
+    ]
+    seconds = measure(cached, number)
+    label = 'path routing (trie with LRU cache, %(hits)d hits, %(misses)d misses)' % router.cache.stats()
+    results.append((label, seconds))
+    return results
+
+
+def cursor_overhead(number=100000):
+    """
+    Compares the time taken to run a trivial query on an in-memory sqlite
+    database with a plain cursor, the RestrictedCursorWrapper as it was
+    before database policies were precomputed (looking up the database
+    options for every query), with the SQL classification remembered in an
+    LRU cache, the current RestrictedCursorWrapper, and the debug cursor
+    used with SQL_QUERY_DEBUG.
+
+    """
+
+    db = connections[connection_state.alias]
+    raw_cursor = sqlite3.connect(':memory:').cursor()
+    sql = 'SELECT 1'
+
+    class OptionsLookupCursorWrapper(RestrictedCursorWrapper):
+        def execute(self, sql, params=()):
+            read_sql = bool(self.READ_SQL_RE.match(sql))
+            db_options = connections.databases[self.db.alias]
+            read_only_warning = db_options.get('READ_ONLY_WARNING')
+            read_only_database = db_options.get('READ_ONLY') or read_only_warning
+            if not read_sql and (read_only_database or read_only_mode):
+                self.check_write(sql, params)
+            return self.cursor.execute(sql, params)
+
+    class LRUCacheCursorWrapper(RestrictedCursorWrapper):
+        cache = LRUCache(1000)
+        def is_read_sql(self, sql):
+            read_sql = self.cache.get(sql, LRUCache.missed)
+            if read_sql is LRUCache.missed:
+                read_sql = self.READ_SQL_RE.match(sql) is not None
+                self.cache.set(sql, read_sql)
+            return read_sql
+
+    cursors = (
+        ('plain', raw_cursor),
+        ('restricted (options per query)', OptionsLookupCursorWrapper(raw_cursor, db)),
+        ('restricted (LRU classification)', LRUCacheCursorWrapper(raw_cursor, db)),
+        ('restricted', RestrictedCursorWrapper(raw_cursor, db)),
+        ('debug', RestrictedCursorWrapper(db.make_debug_cursor(raw_cursor), db)),
+    )
+
+    results = []
+    try:
+        for label, cursor in cursors:
+            def query(cursor=cursor):
+                # A new string each time, like the SQL generated by the ORM.
+                cursor.execute(''.join((sql, ' ')), ())
+            results.append(('sqlite query with %s cursor' % label, measure(query, number)))
+    finally:
+        del db.queries[:]
+    return results
+
+
+def profiler_overhead(number=100000):
+    """
+    Measures the time taken to run a trivial query on an in-memory sqlite
+    database with the RestrictedCursorWrapper, with and without the query
+    profiler collecting statistics for the current request.
+
+    """
+
+    db = connections[connection_state.alias]
+    cursor = RestrictedCursorWrapper(sqlite3.connect(':memory:').cursor(), db)
+
+    def query():
+        cursor.execute('SELECT 1', ())
+
+    results = [('sqlite query without profiler', measure(query, number))]
+    profiler = QueryProfiler(sample_rate=1, server_timing=False)
+    query_observers.append(profiler)
+    try:
+        request_state.query_stats = QueryStats()
+        results.append(('sqlite query with profiler', measure(query, number)))
+    finally:
+        query_observers.remove(profiler)
+        request_state.query_stats = None
+    return results
+
+
+BENCHMARKS = (
+    connection_attribute_access,
+    balancer_choice,
+    path_routing,
+    cursor_overhead,
+    profiler_overhead,
+)
+
+
+def run(names=None, number=100000):
+    """Runs the named benchmarks, or all of them, yielding result rows."""
+    for benchmark in BENCHMARKS:
+        if not names or benchmark.__name__ in names:
+            for label, seconds in benchmark(number=number):
+                yield label, seconds
@@ -1,26 +1,54 @@
 import contextlib
-import threading
 
 from django.db import connections
 
+from django_readwrite.local import local, reset_local
 from django_readwrite.settings import FALLBACK_DATABASE
 
 
-class ConnectionState(threading.local):
+# Marker for a ConnectionState which has not resolved its connection yet.
+UNBOUND = object()
+
+
+class ConnectionState(local):
+    """
+    Holds the database alias that is active for the current thread (or
+    greenlet, see django_readwrite.local), along with the
+    connection for that alias. The connection is resolved the first time it
+    is needed after the alias changes, and then reused until the alias
+    changes again, so ConnectionProxy can avoid looking it up on every
+    attribute access.
+
+    """
 
     _alias = FALLBACK_DATABASE
 
+    connection = UNBOUND
+
     def _get_alias(self):
         return self._alias
 
     def _set_alias(self, value):
         self._alias = value
+        self.connection = UNBOUND
 
     def _del_alias(self):
         self._alias = FALLBACK_DATABASE
+        self.connection = UNBOUND
 
     alias = property(_get_alias, _set_alias, _del_alias)
 
+    def bind(self):
+        """
+        Resolves and caches the connection for the current alias. A value of
+        None means that there is no active alias, so each connection should
+        use itself.
+
+        """
+        alias = self._alias
+        self.connection = alias and connections[alias] or None
+        return self.connection
+
     @contextlib.contextmanager
     def force(self, value):
         old_value = self.alias
@@ -31,6 +59,51 @@ class ConnectionState(threading.local):
             self.alias = old_value
 
 
+class RequestState(local):
+    """
+    Holds values for the current request in the current thread. These are
+    reset by MultiDBMiddleware at the start and end of every request.
+
+    """
+
+    # The database that the load balancer was told this request started.
+    balanced_alias = None
+
+    # The read-only database which SELECT queries are sent to, until the
+    # request writes to its own database. See READWRITE_OFFLOAD_READS.
+    offload_alias = None
+
+    # The offload database that the load balancer was told this request started.
+    balanced_offload_alias = None
+
+    # The offload database whose connection is closed when the request ends,
+    # since Django only closes the connection of the request's own database.
+    offload_connection_alias = None
+
+    # Whether this request needs a transaction which has not started yet.
+    # See READWRITE_LAZY_TRANSACTIONS.
+    transaction_pending = False
+
+    # The database that MultiDBTransactionMiddleware (or a pending transaction)
+    # entered transaction management for.
+    transaction_alias = None
+
+    # The writeable database that this request committed to.
+    pinned_alias = None
+
+    # The QueryStats being collected for this request, if it was sampled.
+    query_stats = None
+
+    # The RequestRecord being collected for this request by the routing advisor.
+    advisor_record = None
+
+    # The RequestQueries being counted for this request by the N+1 detector.
+    request_queries = None
+
+    def reset(self):
+        reset_local(self)
+
+
 class ConnectionProxy(object):
 
     def __init__(self, *args, **kwargs):
@@ -38,14 +111,17 @@ class ConnectionProxy(object):
             super(ConnectionProxy, self).__init__(*args, **kwargs)
 
     def __getattribute__(self, name):
-        alias = connection_state.alias
-        connection = alias and connections[alias] or self
-        return super(ConnectionProxy, connection).__getattribute__(name)
+        connection = connection_state.connection
+        if connection is UNBOUND:
+            connection = connection_state.bind()
+        return super(ConnectionProxy, connection or self).__getattribute__(name)
 
     def __setattr__(self, name, value):
-        alias = connection_state.alias
-        connection = alias and connections[alias] or self
-        return super(ConnectionProxy, connection).__setattr__(name, value)
+        connection = connection_state.connection
+        if connection is UNBOUND:
+            connection = connection_state.bind()
+        return super(ConnectionProxy, connection or self).__setattr__(name, value)
 
 
 connection_state = ConnectionState()
+request_state = RequestState()
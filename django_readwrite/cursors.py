@@ -1,12 +1,29 @@
+import collections
 import logging
 import re
 import sys
 import time
 
 from django.db import connections
+from django.db.models.signals import pre_save
 from django.utils.encoding import smart_unicode, force_unicode, smart_str
 
+from django_readwrite import settings as config
+from django_readwrite.connection import connection_state, request_state
 from django_readwrite.readonly import read_only_mode, ReadOnlyError
+from django_readwrite.resultcache import CachedResultCursor, result_cache
+from django_readwrite.transactions import lazy_transactions
+
+
+# Objects with query_executed(db, sql, params, read_sql, elapsed) and
+# query_failed(db, sql, params, error) methods, which are called after every
+# query. A failure to connect is reported with an sql and params of None.
+# Queries are only timed when there is at least one observer.
+query_observers = []
+
+# The HedgedReads used for databases with the HEDGE_READS option, which is
+# set when django_readwrite.hedging is loaded.
+read_hedger = None
 
 
 class RestrictedDatabaseError(Exception):
@@ -15,13 +32,48 @@ class RestrictedDatabaseError(Exception):
         super(RestrictedDatabaseError, self).__init__(smart_str(message))
 
 
+# The read-only restrictions for a database, and whether its reads are cached or hedged.
+DatabasePolicy = collections.namedtuple('DatabasePolicy', ('read_only', 'warning', 'cache_results', 'hedge_reads'))
+
+database_policies = {}
+
+
+def get_policy(alias):
+    """
+    Returns the DatabasePolicy for a database, according to the READ_ONLY,
+    READ_ONLY_WARNING, RESULT_CACHE and HEDGE_READS options within
+    settings.DATABASES.
+    These are resolved once per database and then reused by every cursor.
+
+    """
+    try:
+        return database_policies[alias]
+    except KeyError:
+        options = connections.databases[alias]
+        warning = bool(options.get('READ_ONLY_WARNING'))
+        read_only = warning or bool(options.get('READ_ONLY'))
+        policy = DatabasePolicy(
+            read_only=read_only,
+            warning=warning,
+            cache_results=bool(read_only and config.RESULT_CACHE and options.get('RESULT_CACHE', True)),
+            hedge_reads=bool(read_only and options.get('HEDGE_READS')),
+        )
+        database_policies[alias] = policy
+        return policy
+
+
 class RestrictedCursorWrapper(object):
 
     READ_SQL_RE = re.compile(r'\s*(SELECT|EXPLAIN|SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.IGNORECASE)
 
+    # Read queries which can be sent to a read-only database instead.
+    OFFLOAD_SQL_RE = re.compile(r'\s*(SELECT|EXPLAIN)\b', re.IGNORECASE)
+    LOCKING_SQL_RE = re.compile(r'\bFOR\s+(?:NO\s+KEY\s+)?(?:UPDATE|SHARE|KEY\s+SHARE)\b|\bLOCK\s+IN\s+SHARE\s+MODE\b', re.IGNORECASE)
+
     def __init__(self, cursor, db):
         self.cursor = cursor
         self.db = db  # Instance of a BaseDatabaseWrapper subclass
+        self.policy = get_policy(db.alias)
 
     def __getattr__(self, attr):
         if attr in self.__dict__:
@@ -32,61 +84,252 @@ class RestrictedCursorWrapper(object):
     def __iter__(self):
         return iter(self.cursor)
 
-    def execute(self, sql, params=()):
+    def is_read_sql(self, sql):
+        # Django's SELECT queries always start like this,
+        # so check for that before trying the regex.
+        return sql[:7] == 'SELECT ' or self.READ_SQL_RE.match(sql) is not None
 
-        read_sql = bool(self.READ_SQL_RE.match(sql))
-
-        db_options = connections.databases[self.db.alias]
-        read_only_warning = db_options.get('READ_ONLY_WARNING')
-        read_only_database = db_options.get('READ_ONLY') or read_only_warning
-
-        if read_only_database:
-            if not read_sql:
-                if read_only_mode:
-                    raise ReadOnlyError
-                try:
-                    raise RestrictedDatabaseError(self.db.alias, get_sql_output(sql, params))
-                except RestrictedDatabaseError as error:
-                    if not read_only_warning:
-                        raise
-                    logging.warning(
-                        'RestrictedDatabaseWarning: %s' % smart_unicode(error)
-                    )
-        elif not read_sql and read_only_mode:
+    def check_write(self, sql, params):
+        """Raises an error if writing is not allowed on this database."""
+
+        if self.policy.read_only:
+            if read_only_mode:
+                raise ReadOnlyError
+            try:
+                raise RestrictedDatabaseError(self.db.alias, get_sql_output(sql, params))
+            except RestrictedDatabaseError as error:
+                if not self.policy.warning:
+                    raise
+                logging.warning(
+                    'RestrictedDatabaseWarning: %s' % smart_unicode(error)
+                )
+        elif read_only_mode:
             raise ReadOnlyError
 
+    def before_write(self, sql, params):
+        """
+        Checks that a write query is allowed, and then prepares for it by
+        invalidating cached results, stopping offloaded reads and starting
+        the request's pending transaction.
+
+        """
+        self.check_write(sql, params)
+        if config.RESULT_CACHE:
+            result_cache.invalidate(sql)
+        request_state.offload_alias = None
+        if request_state.transaction_pending:
+            lazy_transactions.start()
+
+    def execute(self, sql, params=()):
+
+        read_sql = self.is_read_sql(sql)
+        if not read_sql:
+            self.before_write(sql, params)
+        elif self.policy.cache_results:
+            return self.execute_cached(sql, params)
+        elif request_state.offload_alias and not self.policy.read_only:
+            return self.execute_offloaded(sql, params)
+        elif self.policy.hedge_reads and read_hedger:
+            return read_hedger.execute(self, sql, params)
+
+        if not query_observers:
+            return self.cursor.execute(sql, params)
+        return self.observe(self.cursor.execute, sql, params, read_sql)
+
+    def execute_cached(self, sql, params):
+        """
+        Runs a read query, serving its rows from the result cache if they
+        are there, and otherwise adding them to it. See resultcache.py.
+
+        """
+
+        if not isinstance(self.cursor, CachedResultCursor):
+            self.cursor = CachedResultCursor(self.cursor)
+
+        key, versions, result = result_cache.get(sql, params)
+        if result is not None:
+            self.cursor.serve(result)
+            return
+
+        if not query_observers:
+            self.cursor.execute(sql, params)
+        else:
+            self.observe(self.cursor.execute, sql, params, True)
+        if key is not None:
+            self.cursor.serve(result_cache.fetch(key, versions, self.cursor.cursor))
+
+    def execute_offloaded(self, sql, params):
+        """
+        Runs a read query on the read-only database chosen for the current
+        request, unless it must see the request's own database. Savepoints
+        and locking reads stop any more queries from being offloaded.
+
+        """
+
+        if self.LOCKING_SQL_RE.search(sql) or not self.OFFLOAD_SQL_RE.match(sql):
+            request_state.offload_alias = None
+            return self.execute(sql, params)
+
+        if not isinstance(self.cursor, OffloadingCursor):
+            self.cursor = OffloadingCursor(self.cursor)
+        return self.cursor.execute_offloaded(request_state.offload_alias, sql, params)
+
+    def executemany(self, sql, param_list):
+        """
+        Runs a query for every set of parameters in one batch. The query is
+        checked once for the whole batch, and counts as one query for the
+        query observers (with the list of parameters as its params).
+
+        """
+
+        read_sql = self.is_read_sql(sql)
+        if not read_sql:
+            self.before_write(sql, None)
+
+        if not query_observers:
+            return self.cursor.executemany(sql, param_list)
+        return self.observe(self.cursor.executemany, sql, param_list, read_sql)
+
+    def callproc(self, procname, params=()):
+        """
+        Calls a stored procedure. There is no way of knowing what a
+        procedure does, so it is treated as a write query.
+
+        """
+
+        self.before_write('CALL %s' % procname, None)
+
+        if not query_observers:
+            return self.cursor.callproc(procname, params)
+        return self.observe(self.cursor.callproc, procname, params, False)
+
+    def observe(self, method, sql, params, read_sql):
+        """Runs a query with the cursor method and tells the query observers."""
+        start = time.time()
+        try:
+            result = method(sql, params)
+        except Exception as error:
+            for observer in query_observers:
+                observer.query_failed(self.db, sql, params, error)
+            raise
+        elapsed = time.time() - start
+        for observer in query_observers:
+            observer.query_executed(self.db, sql, params, read_sql, elapsed)
+        return result
+
+
+class OffloadingCursor(object):
+    """
+    Wraps a database cursor, so that read queries can be run on a cursor
+    for another database instead. Results come from whichever cursor ran
+    the last query.
+
+    """
+
+    def __init__(self, cursor):
+        self.cursor = self.active_cursor = cursor
+        self.offload_cursor = None
+        self.offload_alias = None
+
+    def __getattr__(self, attr):
+        return getattr(self.active_cursor, attr)
+
+    def __iter__(self):
+        return iter(self.active_cursor)
+
+    def execute(self, sql, params=()):
+        self.active_cursor = self.cursor
         return self.cursor.execute(sql, params)
 
+    def executemany(self, sql, param_list):
+        self.active_cursor = self.cursor
+        return self.cursor.executemany(sql, param_list)
+
+    def callproc(self, procname, params=()):
+        self.active_cursor = self.cursor
+        return self.cursor.callproc(procname, params)
+
+    def execute_offloaded(self, alias, sql, params):
+        # The other database's cursor is restricted as usual, and
+        # is used without the proxy so that it keeps its own alias.
+        with connection_state.force(None):
+            if self.offload_alias != alias:
+                self.offload_cursor = connections[alias].cursor()
+                self.offload_alias = alias
+            self.active_cursor = self.offload_cursor
+            return self.offload_cursor.execute(sql, params)
+
 
 class PrintCursorWrapper(RestrictedCursorWrapper):
 
     def execute(self, sql, params=()):
+        start = time.time()
         try:
-            try:
-                start = time.time()
-                result = super(PrintCursorWrapper, self).execute(sql, params)
-            except Exception:
-                sql = get_sql_output(sql, params)
-                color = 'red'
-                raise
-            else:
-                sql = self.db.ops.last_executed_query(self.cursor, sql, params)
-                options = connections.databases[self.db.alias]
-                read_only = options.get('READ_ONLY') or options.get('READ_ONLY_WARNING')
-                color = read_only and 'green' or 'purple'
-                return result
-        finally:
-            elapsed = (time.time() - start) * 1000
-            if elapsed < 1:
-                time_taken = '%.4f ms' % elapsed
-            else:
-                time_taken = '%d ms' % elapsed
-            sys.stderr.write('[%s] %s\n' % (time_taken, colorize(sql, color)))
+            result = super(PrintCursorWrapper, self).execute(sql, params)
+        except Exception:
+            self.print_query(start, get_sql_output(sql, params), 'red')
+            raise
+        sql = self.db.ops.last_executed_query(self.cursor, sql, params)
+        self.print_query(start, sql, self.color)
+        return result
+
+    def executemany(self, sql, param_list):
+        if not hasattr(param_list, '__len__'):
+            param_list = list(param_list)
+        start = time.time()
+        try:
+            result = super(PrintCursorWrapper, self).executemany(sql, param_list)
+        except Exception:
+            self.print_query(start, '%d times: %s' % (len(param_list), sql), 'red')
+            raise
+        self.print_query(start, '%d times: %s' % (len(param_list), sql), self.color)
+        return result
+
+    def callproc(self, procname, params=()):
+        start = time.time()
+        try:
+            result = super(PrintCursorWrapper, self).callproc(procname, params)
+        except Exception:
+            self.print_query(start, 'CALL %s' % procname, 'red')
+            raise
+        self.print_query(start, 'CALL %s' % procname, self.color)
+        return result
+
+    @property
+    def color(self):
+        return self.policy.read_only and 'green' or 'purple'
+
+    def print_query(self, start, sql, color):
+        elapsed = (time.time() - start) * 1000
+        if elapsed < 1:
+            time_taken = '%.4f ms' % elapsed
+        else:
+            time_taken = '%d ms' % elapsed
+        sys.stderr.write('[%s] %s\n' % (time_taken, colorize(sql, color)))
+
+
+def open_cursor(db):
+    """
+    Returns a new database cursor from a BaseDatabaseWrapper, letting the
+    query observers know if it could not connect.
+
+    """
+    if not query_observers:
+        return db._cursor()
+    try:
+        return db._cursor()
+    except Exception as error:
+        for observer in query_observers:
+            observer.query_failed(db, None, None, error)
+        raise
 
 
 def get_sql_output(sql, params):
     """Turns an sql string and params into something readable."""
 
+    if params is None:
+        return smart_unicode(sql)
+
     # Convert params to contain Unicode values.
     to_unicode = lambda s: force_unicode(s, strings_only=True, errors='replace')
     if isinstance(params, (list, tuple)):
@@ -107,3 +350,18 @@ def colorize(message, color):
         'end': '\033[0m',
     }
     return terminal_colors[color] + message + terminal_colors['end']
+
+
+def stop_offloading(**kwargs):
+    """
+    Stops offloading the current request's reads when a model is about to be
+    saved. Model.save() checks whether the primary key exists before choosing
+    between UPDATE and INSERT, and a lagging read-only database could miss a
+    row which is already on the request's own database.
+
+    """
+    request_state.offload_alias = None
+
+
+if config.OFFLOAD_READS:
+    pre_save.connect(stop_offloading, dispatch_uid='django_readwrite.cursors.stop_offloading')
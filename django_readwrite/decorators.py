@@ -1,11 +1,14 @@
 import functools
 
-from django.db import transaction
+from django.db import transaction, DEFAULT_DB_ALIAS
 from django.forms.util import ErrorList
 from django.utils.functional import wraps
 
+from django_readwrite import settings as config
 from django_readwrite import signals
+from django_readwrite.connection import request_state
 from django_readwrite.readonly import read_only_mode, ReadOnlyError
+from django_readwrite.transactions import lazy_transactions
 
 
 def full_clean_if_not_read_only(full_clean):
@@ -23,27 +26,61 @@ def full_clean_if_not_read_only(full_clean):
     return wrapper
 
 
+def use_alias(*aliases):
+    """
+    View decorator for making MultiDBMiddleware use one of the given
+    databases for requests to the view, regardless of the request method
+    and path. Read-only mode still applies.
+
+    Apply this before any other view decorators, so that they copy the
+    database aliases onto the view that ends up in the URLconf.
+
+    """
+    def decorator(view_func):
+        view_func.readwrite_aliases = tuple(aliases)
+        return view_func
+    return decorator
+
+
+def use_replica(view_func):
+    """View decorator for making requests use a read-only database."""
+    return use_alias(*(config.READ_ONLY_DATABASES or [DEFAULT_DB_ALIAS]))(view_func)
+
+
+def use_primary(view_func):
+    """View decorator for making requests use the default database."""
+    return use_alias(DEFAULT_DB_ALIAS)(view_func)
+
 
 def transaction_decorator(queue_method, *args, **kwargs):
 
-    if 'key' in kwargs:
-        key = kwargs['key']
-        func = None
-    else:
-        key = None
-        func = args[0]
+    # Used as @post_commit, or with options as @post_commit(key=...).
+    key = kwargs.get('key')
+    func = args and args[0] or None
 
     # todo - set this automatically instead, based on whether this transaction has altered any m2m
     mandate_transaction = kwargs.get('mandate_transaction', False)
 
+    # Run the function in a background thread (post_commit only).
+    background = kwargs.get('background', False)
+    if background and queue_method is not signals.queue_post_commit:
+        raise TypeError('Only post_commit functions can be run in the background.')
+    queue_kwargs = background and {'background': True} or {}
+
+    # The database whose transaction the function is queued for.
+    using = kwargs.get('using')
+
     def decorator(func):
         @wraps(func)
         def wrapped_func(*args, **kwargs):
-            if not transaction.is_managed():
+            lazy_transactions.start_pending(using)
+            if not transaction.is_managed(using=using):
                 if mandate_transaction:
                     raise Exception('Unable to continue, transaction required. Need to wrap this call in a transaction. See @commit_on_success.')
                 # Not currently within a transaction,
                 # so run the function immediately.
+                if background:
+                    return signals.run_in_background(lambda: func(*args, **kwargs))
                 return func(*args, **kwargs)
             else:
                 # Allow a callable key function that takes
@@ -56,7 +93,7 @@ def transaction_decorator(queue_method, *args, **kwargs):
                 # the current transaction is committed.
                 closure = lambda: func(*args, **kwargs)
                 # Now actually queue it.
-                queue_method(closure, key=unique_key)
+                queue_method(closure, key=unique_key, using=using, **queue_kwargs)
 
         return wrapped_func
 
@@ -77,13 +114,56 @@ pre_commit = functools.partial(
 )
 
 
+def post_commit_batch(*args, **kwargs):
+    """
+    Decorator for a function which takes a list of items, to be called once
+    with all of the items queued during a transaction, after it commits.
+    Calling the decorated function with one item queues it. Outside of a
+    transaction, the function is called immediately with just that item.
+
+        @post_commit_batch(group=lambda account: account.region, unique=True)
+        def sync_accounts(accounts):
+            ...
+
+    The group option is a function taking an item, and the function is
+    called once for each group. The unique, background and using options
+    are as for signals.queue_post_commit_batch.
+
+    """
+
+    group = kwargs.get('group')
+    options = {
+        'unique': kwargs.get('unique', False),
+        'background': kwargs.get('background', False),
+        'using': kwargs.get('using'),
+    }
+
+    def decorator(func):
+        @wraps(func)
+        def wrapped_func(item):
+            lazy_transactions.start_pending(options['using'])
+            if not transaction.is_managed(using=options['using']):
+                if options['background']:
+                    return signals.run_in_background(lambda: func([item]))
+                return func([item])
+            signals.queue_post_commit_batch(func, item, group=group and group(item), **options)
+
+        return wrapped_func
+
+    if args:
+        return decorator(args[0])
+    else:
+        return decorator
+
+
 def wrap(before=None, after=None, condition=lambda *args, **kwargs: True):
     """
     A helper for creating decorators.
 
     Runs a "before" function before the decorated function, and an "after"
     function afterwards. The condition check is performed once before
-    the decorated function.
+    the decorated function. All of them are called with the decorated
+    function's arguments.
 
     """
     def decorator(func):
@@ -91,10 +171,10 @@ def wrap(before=None, after=None, condition=lambda *args, **kwargs: True):
         def wrapped(*args, **kwargs):
             yes = condition(*args, **kwargs)
             if yes and before:
-                before()
+                before(*args, **kwargs)
             result = func(*args, **kwargs)
             if yes and after:
-                after()
+                after(*args, **kwargs)
             return result
         return wrapped
     return decorator
@@ -105,14 +185,15 @@ def wrap_before(before, condition=lambda *args, **kwargs: True):
     A helper for creating decorators.
 
     Runs a "before" function before the decorated function. The condition
-    check is performed before the decorated function is called.
+    check is performed before the decorated function is called. Both are
+    called with the decorated function's arguments.
 
     """
     def decorator(func):
         @functools.wraps(func)
         def wrapped(*args, **kwargs):
             if condition(*args, **kwargs):
-                before()
+                before(*args, **kwargs)
             return func(*args, **kwargs)
         return wrapped
     return decorator
@@ -123,7 +204,8 @@ def wrap_after(after, condition=lambda *args, **kwargs: True):
     A helper for creating decorators.
 
     Runs an "after" function after the decorated function. The condition
-    check is performed after the decorated function is called.
+    check is performed after the decorated function is called. Both are
+    called with the decorated function's arguments.
 
     """
     def decorator(func):
@@ -131,15 +213,38 @@ def wrap_after(after, condition=lambda *args, **kwargs: True):
         def wrapped(*args, **kwargs):
             result = func(*args, **kwargs)
             if condition(*args, **kwargs):
-                after()
+                after(*args, **kwargs)
             return result
         return wrapped
     return decorator
 
 
+def entering_transaction(managed=True, using=None):
+    """
+    Sends the rest of the current request's reads to its own database, and
+    starts its pending transaction first if it has one, so that it is the
+    outermost transaction.
+
+    """
+    request_state.offload_alias = None
+    if request_state.transaction_pending:
+        lazy_transactions.start()
+
+
+enter_transaction_management = wrap_before(
+    before=entering_transaction,
+)
+
+# For the transaction functions which fail or do nothing useful outside of
+# transaction management, so that they see the request's pending transaction.
+start_pending_transaction = wrap_before(
+    before=lambda using=None: lazy_transactions.start_pending(using),
+)
+
+
 managed = wrap(
-    before=signals.send_pre_commit,
-    after=signals.send_post_commit,
+    before=lambda flag=True, using=None: signals.send_pre_commit(using),
+    after=lambda flag=True, using=None: signals.send_post_commit(using),
     condition=lambda flag=True, using=None: not flag and transaction.is_dirty(using=using),
 )
 
@@ -162,3 +267,22 @@ commit = wrap(
 rollback = wrap_after(
     after=signals.send_post_rollback,
 )
+
+
+def savepoint(func):
+    """Starts keeping the functions queued inside a new savepoint separately."""
+    @functools.wraps(func)
+    def wrapped(using=None):
+        sid = func(using=using)
+        signals.send_savepoint(sid, using)
+        return sid
+    return wrapped
+
+
+savepoint_commit = wrap_after(
+    after=signals.send_savepoint_commit,
+)
+
+savepoint_rollback = wrap_after(
+    after=signals.send_savepoint_rollback,
+)
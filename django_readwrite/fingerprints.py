@@ -0,0 +1,51 @@
+"""
+Normalizing SQL into fingerprints, so that queries which differ only in
+their values can be counted together. For example, both of these:
+
+    SELECT * FROM "app_item" WHERE "id" IN (1, 2, 3) AND "name" = 'x'
+    SELECT * FROM "app_item" WHERE "id" IN (%s, %s) AND "name" = %s
+
+have the fingerprint:
+
+    SELECT * FROM "app_item" WHERE "id" IN (...) AND "name" = ?
+
+"""
+
+import re
+
+from django_readwrite.utils import LRUCache
+
+
+FINGERPRINT_CACHE_SIZE = 1000
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'(?<![\w"`.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b', re.IGNORECASE)
+PLACEHOLDER_RE = re.compile(r'%(?:\([^)]*\))?s|\?')
+LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+VALUES_RE = re.compile(r'\bVALUES\s*\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))*', re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'\s+')
+
+fingerprint_cache = LRUCache(FINGERPRINT_CACHE_SIZE)
+
+
+def normalize(sql):
+    """Replaces the values in some SQL with placeholders."""
+    sql = STRING_RE.sub('?', sql)
+    sql = PLACEHOLDER_RE.sub('?', sql)
+    sql = NUMBER_RE.sub('?', sql)
+    sql = LIST_RE.sub('(...)', sql)
+    sql = VALUES_RE.sub('VALUES (...)', sql)
+    return WHITESPACE_RE.sub(' ', sql).strip()
+
+
+def fingerprint(sql):
+    """
+    Returns the normalized form of some SQL. The ORM reuses a small number
+    of SQL strings, so the results are remembered in an LRU cache.
+
+    """
+    result = fingerprint_cache.get(sql)
+    if result is None:
+        result = normalize(sql)
+        fingerprint_cache.set(sql, result)
+    return result
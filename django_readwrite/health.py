@@ -0,0 +1,171 @@
+"""
+Circuit breakers for avoiding databases which are failing.
+
+Each database has a circuit breaker which counts consecutive errors from
+connecting to it or running queries on it. Only errors which mean that the
+database is failing are counted: failures to connect, the OperationalError
+and InterfaceError of the database drivers (and of Django, in versions which
+have them), and errors which leave the connection closed. Errors caused by
+the query itself, such as bad SQL or a missing table, are not. Django 1.2
+turns most driver errors into a plain DatabaseError, so a query error which
+leaves the connection open is only counted if the driver's error class got
+through. When the count reaches
+READWRITE_CIRCUIT_BREAKER_FAILURES, the breaker opens and the database is
+no longer chosen by the middleware. After READWRITE_CIRCUIT_BREAKER_TIMEOUT
+seconds, the breaker half-opens and sends a probe query to the database in
+a background thread. If the probe succeeds then the breaker closes and the
+database is used again, otherwise it stays open for another timeout.
+
+Every change of state sends the circuit_breaker_changed signal.
+
+"""
+
+import logging
+import threading
+
+from django.db import connections, utils
+from django.utils.importlib import import_module
+
+from django_readwrite import settings as config
+from django_readwrite.connection import connection_state
+from django_readwrite.cursors import query_observers
+from django_readwrite.signals import circuit_breaker_changed
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def get_connection_errors():
+    """
+    Returns the exception classes which mean that a database is failing,
+    rather than the query which raised them.
+
+    """
+    modules = [utils]
+    for options in connections.databases.values():
+        try:
+            modules.append(import_module(options['ENGINE'] + '.base').Database)
+        except (ImportError, AttributeError):
+            pass
+    errors = []
+    for module in modules:
+        for name in ('OperationalError', 'InterfaceError'):
+            error = getattr(module, name, None)
+            if error is not None and error not in errors:
+                errors.append(error)
+    return tuple(errors)
+
+
+class CircuitBreaker(object):
+
+    probe_sql = 'SELECT 1'
+
+    def __init__(self, alias, failures, timeout):
+        self.alias = alias
+        self.max_failures = failures
+        self.timeout = timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return '<CircuitBreaker %r: %s>' % (self.alias, self.state)
+
+    def change_state(self, new_state):
+        old_state = self.state
+        self.state = new_state
+        logging.warning('Circuit breaker for database %r is now %s.' % (self.alias, new_state))
+        circuit_breaker_changed.send(
+            sender=self,
+            alias=self.alias,
+            old_state=old_state,
+            new_state=new_state,
+        )
+
+    def success(self):
+        if self.failures and self.state is CLOSED:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state is CLOSED and self.failures >= self.max_failures:
+                self.open()
+
+    def open(self):
+        self.change_state(OPEN)
+        timer = threading.Timer(self.timeout, self.probe)
+        timer.daemon = True
+        timer.start()
+
+    def probe(self):
+        """
+        Half-opens the breaker and runs a query to see if the database has
+        recovered. This uses an unrestricted cursor, and runs in its own
+        thread so it is not affected by the alias of any request.
+
+        """
+
+        with self.lock:
+            self.change_state(HALF_OPEN)
+
+        with connection_state.force(None):
+            connection = connections[self.alias]
+            try:
+                cursor = connection._cursor()
+                cursor.execute(self.probe_sql)
+                cursor.fetchall()
+            except Exception:
+                logging.exception('Circuit breaker probe failed for database %r.' % self.alias)
+                with self.lock:
+                    self.open()
+            else:
+                with self.lock:
+                    self.failures = 0
+                    self.change_state(CLOSED)
+            finally:
+                connection.close()
+
+
+class CircuitBreakers(object):
+    """
+    The circuit breakers for every database. This is a query observer,
+    so it gets told about each query and connection attempt.
+
+    """
+
+    def __init__(self, failures, timeout):
+        self.breakers = {}
+        for alias in connections.databases:
+            self.breakers[alias] = CircuitBreaker(alias, failures, timeout)
+        self.connection_errors = get_connection_errors()
+
+    def __getitem__(self, alias):
+        return self.breakers[alias]
+
+    def filter(self, aliases):
+        """Returns the databases which have closed circuit breakers."""
+        breakers = self.breakers
+        return [alias for alias in aliases if alias not in breakers or breakers[alias].state is CLOSED]
+
+    def query_executed(self, db, sql, params, read_sql, elapsed):
+        breaker = self.breakers.get(db.alias)
+        if breaker:
+            breaker.success()
+
+    def query_failed(self, db, sql, params, error):
+        # An sql of None means that it could not connect.
+        if sql is not None and not isinstance(error, self.connection_errors):
+            if not getattr(db.connection, 'closed', False):
+                return
+        breaker = self.breakers.get(db.alias)
+        if breaker:
+            breaker.failure()
+
+
+circuit_breakers = CircuitBreakers(config.CIRCUIT_BREAKER_FAILURES, config.CIRCUIT_BREAKER_TIMEOUT)
+
+if config.CIRCUIT_BREAKER_FAILURES:
+    query_observers.append(circuit_breakers)
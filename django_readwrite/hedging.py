@@ -0,0 +1,235 @@
+"""
+Hedged reads, for cutting the slowest queries on read-only databases with
+the HEDGE_READS option within settings.DATABASES.
+
+SELECT queries on those databases are run by a worker thread, while the
+request's thread waits for them. If a query has not finished within the
+READWRITE_HEDGE_PERCENTILE of recent query times, the same query is also
+sent to another read-only database using a pooled connection (see
+django_readwrite.parallel), and whichever answers first is used. The rows
+are fetched by the worker, and served from memory.
+
+If the other database answers first, the request's connection is left to
+the query still running on it, and is closed once that finishes. The
+request opens a new connection for its next query.
+
+READWRITE_HEDGE_BUDGET limits the fraction of queries which are hedged,
+so a database which is slow for everyone doesn't get twice the load. Every
+query adds that fraction of a hedge to the budget, and every hedge spends
+a whole one. If
+all of the READWRITE_HEDGE_WORKERS threads are busy, queries run in the
+request's thread as usual.
+
+"""
+
+import sys
+import threading
+import time
+
+from django.db import connections
+
+from django_readwrite import cursors
+from django_readwrite import settings as config
+from django_readwrite.connection import connection_state
+from django_readwrite.cursors import open_cursor, query_observers
+from django_readwrite.health import circuit_breakers
+from django_readwrite.lag import lag_monitor
+from django_readwrite.parallel import call_with_connection
+from django_readwrite.resultcache import CachedResult, CachedResultCursor
+from django_readwrite.workers import WorkerPool
+
+
+# The number of recent query times kept for working out the delay, and
+# how often (in queries) it is worked out again.
+MAX_TIMES = 1000
+DELAY_INTERVAL = 100
+
+# The most hedges which can be saved up by the budget.
+MAX_TOKENS = 10
+
+
+def fetch_result(cursor, sql, params):
+    cursor.execute(sql, params)
+    return CachedResult(cursor.description, list(cursor.fetchall()), cursor.rowcount)
+
+
+def fetch_hedge(sql, params):
+    # This is called by call_with_connection, with a pooled alias active.
+    alias = connection_state.alias
+    with connection_state.force(None):
+        return fetch_result(open_cursor(connections[alias]), sql, params)
+
+
+class Race(object):
+    """A query running on two databases, where the first answer wins."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.running = set()
+        self.results = {}
+        self.errors = {}
+        self.winner = None
+        # The connection to close when the original query finishes, if it lost.
+        self.abandoned = None
+
+    def start(self, worker_pool, name, func, *args):
+        with self.lock:
+            self.running.add(name)
+        worker_pool.submit(self.run, name, func, *args)
+
+    def run(self, name, func, *args):
+        try:
+            result = func(*args)
+        except Exception:
+            error = sys.exc_info()
+            with self.lock:
+                self.errors[name] = error
+                if len(self.errors) == len(self.running):
+                    self.finished.set()
+        else:
+            with self.lock:
+                self.results[name] = result
+                if self.winner is None:
+                    self.winner = name
+                    self.finished.set()
+        finally:
+            with self.lock:
+                abandoned = name == 'query' and self.abandoned
+            if abandoned:
+                try:
+                    abandoned.close()
+                except Exception:
+                    pass
+
+
+class HedgedReads(object):
+
+    def __init__(self, percentile, min_delay, budget, workers):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.worker_pool = WorkerPool('readwrite-hedging', workers)
+        self.times = []
+        self.next_time = 0
+        self.samples = 0
+        self.delay = min_delay
+        self.tokens = MAX_TOKENS
+        self.queries = 0
+        self.fired = 0
+        self.won = 0
+        self.skipped = 0
+
+    def execute(self, wrapper, sql, params):
+        """Runs a read query for a RestrictedCursorWrapper, hedging it if it is slow."""
+
+        if not wrapper.OFFLOAD_SQL_RE.match(sql) or self.worker_pool.in_worker() or not self.worker_pool.has_capacity():
+            # This is not a plain read, or it is a hedge itself,
+            # or there is no thread to run it.
+            if not query_observers:
+                return wrapper.cursor.execute(sql, params)
+            return wrapper.observe(wrapper.cursor.execute, sql, params, True)
+
+        if not isinstance(wrapper.cursor, CachedResultCursor):
+            wrapper.cursor = CachedResultCursor(wrapper.cursor)
+        cursor = wrapper.cursor
+
+        # The database the query runs on. Under connection_state.force(None),
+        # wrapper.db is whichever wrapper the ORM called, which may not be it.
+        alias = wrapper.db.alias
+
+        with self.lock:
+            self.queries += 1
+            self.tokens = min(self.tokens + self.budget, MAX_TOKENS)
+
+        race = Race()
+        start = time.time()
+        race.start(self.worker_pool, 'query', fetch_result, cursor.cursor, sql, params)
+
+        if not race.finished.wait(self.delay) and self.spend_token():
+            other_alias = self.choose_other(alias)
+            if other_alias:
+                with self.lock:
+                    self.fired += 1
+                race.start(self.worker_pool, 'hedge', call_with_connection, other_alias,
+                           lambda: fetch_hedge(sql, params))
+        race.finished.wait()
+        elapsed = time.time() - start
+
+        with race.lock:
+            winner = race.winner
+            if winner == 'hedge' and 'query' not in race.results and 'query' not in race.errors:
+                # Leave the connection to the query still running on it.
+                with connection_state.force(None):
+                    db = connections[alias]
+                    race.abandoned = db.connection
+                    db.connection = None
+                    cursor.cursor = open_cursor(db)
+
+        if winner is None:
+            error = race.errors.get('query') or race.errors['hedge']
+            for observer in query_observers:
+                observer.query_failed(wrapper.db, sql, params, error[1])
+            raise error[0], error[1], error[2]
+
+        if winner == 'hedge':
+            with self.lock:
+                self.won += 1
+        else:
+            self.add_time(elapsed)
+        for observer in query_observers:
+            observer.query_executed(wrapper.db, sql, params, True, elapsed)
+        cursor.serve(race.results[winner])
+
+    def add_time(self, elapsed):
+        """Remembers a query time, and works out the delay again now and then."""
+        with self.lock:
+            self.samples += 1
+            if len(self.times) < MAX_TIMES:
+                self.times.append(elapsed)
+            else:
+                self.times[self.next_time] = elapsed
+                self.next_time = (self.next_time + 1) % MAX_TIMES
+            if self.samples % DELAY_INTERVAL == 0:
+                times = sorted(self.times)
+                index = int(round((len(times) - 1) * self.percentile / 100.0))
+                self.delay = max(times[index], self.min_delay)
+
+    def spend_token(self):
+        """Checks if the budget allows another hedge, and spends it."""
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            self.skipped += 1
+            return False
+
+    def choose_other(self, alias):
+        """Returns another read-only database to send a hedge to, or None."""
+        aliases = [other for other in config.READ_ONLY_DATABASES if other != alias]
+        if config.MAX_LAG:
+            aliases = lag_monitor.filter(aliases)
+        if config.CIRCUIT_BREAKER_FAILURES:
+            aliases = circuit_breakers.filter(aliases)
+        return aliases and aliases[self.fired % len(aliases)] or None
+
+    def stats(self):
+        return {
+            'queries': self.queries,
+            'delay': self.delay,
+            'fired': self.fired,
+            'won': self.won,
+            'skipped': self.skipped,
+        }
+
+
+hedged_reads = HedgedReads(
+    percentile=config.HEDGE_PERCENTILE,
+    min_delay=config.HEDGE_MIN_DELAY,
+    budget=config.HEDGE_BUDGET,
+    workers=config.HEDGE_WORKERS,
+)
+
+if config.HEDGED_DATABASES:
+    cursors.read_hedger = hedged_reads
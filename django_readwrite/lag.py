@@ -0,0 +1,155 @@
+"""
+Replication lag monitoring for read-only databases.
+
+Databases with MAX_LAG defined in settings.DATABASES have their replication
+lag measured by a background thread, at most once per
+READWRITE_LAG_CHECK_INTERVAL seconds. The middleware uses the most recent
+measurements to avoid choosing databases that have fallen too far behind.
+
+The query used to measure lag depends on the database engine, and can be
+overridden per-database with the LAG_QUERY option. It must return the lag in
+seconds as the first column of a single row. Databases using an engine
+without a lag query, and without the LAG_QUERY option, are always treated
+as lagging.
+
+"""
+
+import logging
+import os
+import threading
+import time
+
+from django.db import connections
+
+from django_readwrite import settings as config
+from django_readwrite.connection import connection_state
+
+
+POSTGRESQL_LAG_QUERY = (
+    'SELECT CASE'
+    ' WHEN pg_last_xlog_receive_location() = pg_last_xlog_replay_location() THEN 0'
+    ' ELSE EXTRACT(EPOCH FROM clock_timestamp() - pg_last_xact_replay_timestamp())'
+    ' END'
+)
+
+
+# Queries for measuring replication lag, for each engine. Each one is a
+# tuple of (sql, column name) where a column name of None means the first
+# column of the result.
+LAG_QUERIES = {
+    'mysql': ('SHOW SLAVE STATUS', 'Seconds_Behind_Master'),
+    'postgresql': (POSTGRESQL_LAG_QUERY, None),
+    'postgresql_psycopg2': (POSTGRESQL_LAG_QUERY, None),
+}
+
+
+def get_lag_query(alias):
+    """Returns the (sql, column name) used to measure lag on a database."""
+    options = connections.databases[alias]
+    if options.get('LAG_QUERY'):
+        return options['LAG_QUERY'], None
+    engine = options['ENGINE'].split('.')[-1]
+    return LAG_QUERIES.get(engine)
+
+
+class ReplicationLagMonitor(object):
+    """
+    Measures the replication lag of databases in a background thread and
+    remembers the results. The thread is started on first use in each
+    process, so it survives servers that fork their workers.
+
+    A database whose lag could not be measured is treated as being too far
+    behind. A database that has not been measured yet is not.
+
+    """
+
+    def __init__(self, max_lag, interval):
+        self.max_lag = max_lag
+        self.interval = interval
+        self.lags = {}
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def start(self):
+        """Starts the background thread, unless it is already running."""
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.lags = {}
+                thread = threading.Thread(target=self.run, name='ReplicationLagMonitor')
+                thread.daemon = True
+                thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                logging.exception('Could not check replication lag.')
+            time.sleep(self.interval)
+
+    def check(self):
+        """Measures and remembers the lag of every monitored database."""
+        for alias in self.max_lag:
+            self.lags[alias] = self.measure(alias)
+
+    def measure(self, alias):
+        """
+        Returns the replication lag of a database in seconds. This uses an
+        unrestricted cursor because the lag queries are not always SELECTs.
+        The transaction is rolled back afterwards, so the connection isn't
+        left idle in a transaction between measurements.
+
+        """
+
+        lag_query = get_lag_query(alias)
+        if not lag_query:
+            # It can't be measured, so it can't be trusted to be up to date.
+            logging.warning('No replication lag query is available for database %r, so it is treated as lagging.' % alias)
+            return float('inf')
+
+        sql, column = lag_query
+        with connection_state.force(None):
+            connection = connections[alias]
+            try:
+                cursor = connection._cursor()
+                cursor.execute(sql)
+                row = cursor.fetchone()
+                if row and column:
+                    names = [description[0] for description in cursor.description]
+                    row = (row[names.index(column)],)
+                connection._rollback()
+            except Exception:
+                logging.exception('Could not measure the replication lag of database %r.' % alias)
+                connection.close()
+                return float('inf')
+
+        if not row:
+            # No replication status means this is not a replica,
+            # so it cannot be behind.
+            return 0
+        elif row[0] is None:
+            # Replication has stopped.
+            return float('inf')
+        else:
+            return float(row[0])
+
+    def lag(self, alias):
+        """Returns the last measured lag of a database, or None."""
+        return self.lags.get(alias)
+
+    def is_lagging(self, alias):
+        max_lag = self.max_lag.get(alias)
+        if max_lag is None:
+            return False
+        lag = self.lags.get(alias)
+        return lag is not None and lag > max_lag
+
+    def filter(self, aliases):
+        """Returns the databases which are not too far behind."""
+        if self.pid != os.getpid():
+            self.start()
+        return [alias for alias in aliases if not self.is_lagging(alias)]
+
+
+lag_monitor = ReplicationLagMonitor(config.MAX_LAG, config.LAG_CHECK_INTERVAL)
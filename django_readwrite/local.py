@@ -0,0 +1,63 @@
+"""
+Storage that is local to the current thread or greenlet.
+
+The routing state and commit function pools hold values for the current
+request. By default these are stored per-thread, but servers which run
+many requests in one thread (gevent or eventlet) need them stored
+per-greenlet instead.
+
+This is controlled by the READWRITE_LOCAL setting:
+    'thread' uses threading.local
+    'greenlet' uses gevent.local.local or eventlet.corolocal.local
+    'auto' (the default) uses 'greenlet' if gevent or eventlet has
+    monkey-patched the thread module, otherwise 'thread'
+
+"""
+
+import sys
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+from django_readwrite import settings as config
+
+
+def is_green():
+    """Checks if gevent or eventlet has monkey-patched the thread module."""
+    if 'gevent.monkey' in sys.modules:
+        if sys.modules['gevent.monkey'].is_module_patched('thread'):
+            return True
+    if 'eventlet.patcher' in sys.modules:
+        if sys.modules['eventlet.patcher'].is_monkey_patched('thread'):
+            return True
+    return False
+
+
+def get_greenlet_local():
+    try:
+        from gevent.local import local
+    except ImportError:
+        try:
+            from eventlet.corolocal import local
+        except ImportError:
+            raise ImproperlyConfigured('READWRITE_LOCAL is "greenlet" but neither gevent nor eventlet is installed.')
+    return local
+
+
+def get_local_class(backend):
+    if backend == 'auto':
+        backend = is_green() and 'greenlet' or 'thread'
+    if backend == 'thread':
+        return threading.local
+    elif backend == 'greenlet':
+        return get_greenlet_local()
+    else:
+        raise ImproperlyConfigured('Unknown READWRITE_LOCAL value: %r' % backend)
+
+
+def reset_local(obj):
+    """Removes all of the attributes of a local object for the current thread or greenlet."""
+    obj.__dict__.clear()
+
+
+local = get_local_class(config.LOCAL_BACKEND)
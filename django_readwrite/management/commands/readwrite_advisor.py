@@ -0,0 +1,71 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_readwrite import settings as config
+from django_readwrite.advisor import clear_shared_table, get_shared_table
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Report the views which use a writeable database but have not written '
+        'to it, according to the READWRITE_ROUTING_ADVISOR recordings.'
+    )
+    args = 'report|clear'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--min-requests', type='int', default=100,
+            help='Only report views with at least this many requests.'),
+    )
+
+    requires_model_validation = False
+
+    # What to change for each way of routing a request.
+    advice = {
+        'method': 'use @use_replica',
+        'path': 'remove the HTTP_PATHS rule',
+        'view': 'use @use_replica instead of @use_primary/@use_alias',
+    }
+
+    def handle(self, action='report', **options):
+
+        if action == 'clear':
+            clear_shared_table()
+            print 'Cleared the routing advisor tables'
+        elif action == 'report':
+            self.report(options['min_requests'])
+        else:
+            raise CommandError('Usage: readwrite_advisor [%s]' % self.args)
+
+    def report(self, min_requests):
+
+        if not config.ROUTING_ADVISOR:
+            print 'Warning: READWRITE_ROUTING_ADVISOR is not enabled in this process'
+
+        candidates = []
+        for record in get_shared_table():
+            if record.writes or record.requests < min_requests:
+                continue
+            # Only views which used a writeable database can be moved.
+            primary = [
+                values for alias, values in record.databases.items()
+                if alias not in config.READ_ONLY_DATABASES_SET
+            ]
+            if primary:
+                candidates.append((sum(elapsed for count, elapsed in primary), record))
+
+        if not candidates:
+            print 'No views are candidates for using a read-only database'
+            return
+
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        print 'Views which used a writeable database without writing to it:'
+        for primary_time, record in candidates:
+            print
+            print '%s %s' % (record.method, record.view)
+            print '    %d requests, %.1f ms on writeable databases' % (record.requests, primary_time * 1000)
+            for alias, (count, elapsed) in sorted(record.databases.items()):
+                print '    %s: %d queries, %.1f ms' % (alias, count, elapsed * 1000)
+            for routing, count in sorted(record.routing.items()):
+                print '    routed by %s for %d requests: %s' % (routing, count, self.advice.get(routing, ''))
@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from django_readwrite import benchmarks
+
+
+class Command(BaseCommand):
+
+    help = 'Run the django_readwrite microbenchmarks.'
+    args = '[benchmark ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--number', type='int', default=100000,
+            help='Number of calls to time for each benchmark.'),
+    )
+
+    requires_model_validation = False
+
+    def handle(self, *names, **options):
+        for label, seconds in benchmarks.run(names, number=options['number']):
+            print '%-60s %10.3f us' % (label, seconds * 1000000)
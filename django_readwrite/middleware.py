@@ -4,24 +4,36 @@ request's HTTP method.
 
 The databases used will depend on the value of 'HTTP_METHODS' defined in
 settings.DATABASES. If more than one database is configured for the same
-HTTP method, then this middleware will randomly choose one per-request.
+HTTP method, then this middleware will choose one per-request using the
+load balancer configured with the READWRITE_BALANCER setting.
 
 """
 
-import random
-
-from django.core.exceptions import MiddlewareNotUsed
+from django.core.exceptions import MiddlewareNotUsed, ViewDoesNotExist
 from django.core.signals import got_request_exception, request_finished, request_started
-from django.db import connection, transaction, DEFAULT_DB_ALIAS
+from django.core.urlresolvers import get_resolver
+from django.db import close_connection, connection, connections, transaction, DEFAULT_DB_ALIAS
 
 from django_readwrite import settings as config
-from django_readwrite.connection import connection_state
-from django_readwrite.readonly import read_only_mode, ReadOnlyError
+from django_readwrite.advisor import routing_advisor
+from django_readwrite.balancers import balancer
+from django_readwrite.connection import connection_state, request_state
+from django_readwrite.nplusone import nplusone_detector
+from django_readwrite.paths import path_router
+from django_readwrite.persistent import check_connections, discard_connections, release_connections
+from django_readwrite.pinning import get_pin, set_pin
+from django_readwrite.profiling import query_profiler
+from django_readwrite.readonly import ReadOnlyError
+from django_readwrite.routing import choose_database
+from django_readwrite.transactions import lazy_transactions
 from django_readwrite.views import read_only_error
 
 
 class MultiDBMiddleware(object):
 
+    # Databases for each view, built from the URLconf on first use.
+    view_aliases = None
+
     def __init__(self):
 
         if not config.DATABASE_MAPPINGS and not config.READ_ONLY_DATABASES:
@@ -33,18 +45,65 @@ class MultiDBMiddleware(object):
                 dispatch_uid='MultiDBMiddleware.cleanup',
             )
 
+        # Keep connections open between requests for databases with the
+        # CONN_MAX_AGE option within the settings.DATABASES options, instead
+        # of letting Django close them. See django_readwrite.persistent.
+        if config.CONN_MAX_AGES:
+            request_finished.disconnect(close_connection)
+            request_finished.connect(
+                receiver=release_connections,
+                dispatch_uid='django_readwrite.persistent.release_connections',
+            )
+            got_request_exception.connect(
+                receiver=discard_connections,
+                dispatch_uid='django_readwrite.persistent.discard_connections',
+            )
+            request_started.connect(
+                receiver=check_connections,
+                dispatch_uid='django_readwrite.persistent.check_connections',
+            )
+
     def cleanup(self, **kwargs):
+        self.finish_balancing()
+        self.close_offload_connection()
+        request_state.reset()
         del connection_state.alias
 
+    def finish_balancing(self):
+        if request_state.balanced_alias:
+            balancer.finished(request_state.balanced_alias)
+            request_state.balanced_alias = None
+        if request_state.balanced_offload_alias:
+            balancer.finished(request_state.balanced_offload_alias)
+            request_state.balanced_offload_alias = None
+        request_state.offload_alias = None
+
+    def close_offload_connection(self):
+        """
+        Closes the connection used for offloaded reads, unless it is kept
+        between requests with the CONN_MAX_AGE option.
+
+        """
+        alias = request_state.offload_connection_alias
+        if alias:
+            request_state.offload_connection_alias = None
+            if alias not in config.CONN_MAX_AGES:
+                with connection_state.force(None):
+                    try:
+                        connections[alias].close()
+                    except Exception:
+                        # It was already broken, so just forget about it.
+                        connections[alias].connection = None
+
     def process_request(self, request):
 
         # See if the current request path has been configured to use any
         # particular databases. This is controlled by defining HTTP_PATHS
         # within the settings.DATABASES options.
-        db_aliases = []
-        for db_alias, paths_regex in config.DATABASE_PATHS.items():
-            if paths_regex.search(request.path):
-                db_aliases.append(db_alias)
+        db_aliases = None
+        routing = 'path'
+        if config.DATABASE_PATH_PREFIXES:
+            db_aliases = path_router.match(request.path)
 
         # Otherwise, use the request method to determine the database to use.
         # This is controlled by defining HTTP_METHODS within the
@@ -52,35 +111,129 @@ class MultiDBMiddleware(object):
         # method has not been specified anywhere.
         if not db_aliases:
             db_aliases = config.DATABASE_MAPPINGS.get(request.method) or [DEFAULT_DB_ALIAS]
+            routing = 'method'
 
-        # Always use a read-only database when in read-only mode. This is
-        # controlled by defining READ_ONLY or READ_ONLY_WARNING within the
-        # settings.DATABASES options. This is slightly more complicated than
-        # necessary so it can avoid unnecessarily checking the value of
-        # read_only_mode (which accesses memcache).
-        if config.READ_ONLY_DATABASES:
-            for alias in db_aliases:
-                if alias not in config.READ_ONLY_DATABASES_SET:
-                    # One of the options is not a read database,
-                    # so read-only mode will have to be checked.
-                    if read_only_mode:
-                        db_aliases = config.READ_ONLY_DATABASES
-                    break
-
-        if len(db_aliases) == 1:
-            connection_state.alias = db_aliases[0]
-        elif db_aliases:
-            connection_state.alias = random.choice(db_aliases)
-        else:
-            # This request method is not specified in the settings,
-            # so use the default database connection.
-            connection_state.alias = DEFAULT_DB_ALIAS
+        self.use_databases(request, db_aliases)
+
+        # Record what the request does for the readwrite_advisor command.
+        # This is controlled by the READWRITE_ROUTING_ADVISOR setting.
+        if config.ROUTING_ADVISOR:
+            routing_advisor.start(routing)
+
+        # Sample some requests for query statistics. This is controlled by
+        # the READWRITE_PROFILE_SAMPLE_RATE setting.
+        if config.PROFILE_SAMPLE_RATE:
+            query_profiler.start()
+
+        # Count repeated queries. This is controlled by the
+        # READWRITE_NPLUSONE_THRESHOLD setting.
+        if config.NPLUSONE_THRESHOLD:
+            nplusone_detector.start()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+
+        # See if the view has been decorated to use particular databases.
+        # This is controlled by the use_replica, use_primary and use_alias
+        # decorators, and overrides the database chosen for the request.
+        if self.view_aliases is None:
+            self.view_aliases = self.build_view_aliases()
+        try:
+            db_aliases = self.view_aliases[view_func]
+        except KeyError:
+            db_aliases = getattr(view_func, 'readwrite_aliases', None)
+            self.view_aliases[view_func] = db_aliases
+        except TypeError:
+            # The view is not hashable.
+            db_aliases = getattr(view_func, 'readwrite_aliases', None)
+
+        if db_aliases:
+            self.finish_balancing()
+            self.close_offload_connection()
+            self.use_databases(request, db_aliases)
+
+        if config.ROUTING_ADVISOR:
+            routing_advisor.view(view_func, db_aliases and 'view')
+
+    def build_view_aliases(self):
+        """
+        Returns a dictionary of {view: aliases} for every view in the URLconf,
+        where aliases were set by the use_replica, use_primary or use_alias
+        decorators (or are None). This avoids having to look for them on every
+        request. Views that are not in the URLconf are added as they are used.
+
+        """
+
+        result = {}
+
+        def add_patterns(patterns):
+            for pattern in patterns:
+                if hasattr(pattern, 'url_patterns'):
+                    add_patterns(pattern.url_patterns)
+                else:
+                    try:
+                        view_func = pattern.callback
+                    except ViewDoesNotExist:
+                        continue
+                    result[view_func] = getattr(view_func, 'readwrite_aliases', None)
+
+        add_patterns(get_resolver(None).url_patterns)
+        return result
+
+    def use_databases(self, request, db_aliases):
+        """Chooses one of the given databases to use for the request."""
+
+        # Send clients who have recently written to a database back to that
+        # database, rather than to a read-only database which might not have
+        # their changes yet. This is controlled by the READWRITE_PIN_AFTER_WRITE
+        # setting and the PIN_TTL option within the settings.DATABASES options.
+        if config.PIN_AFTER_WRITE and config.READ_ONLY_DATABASES_SET.issuperset(db_aliases):
+            pinned_alias = get_pin(request)
+            if pinned_alias:
+                db_aliases = [pinned_alias]
+
+        alias, balanced = choose_database(db_aliases)
+        connection_state.alias = alias
+        if balanced:
+            request_state.balanced_alias = alias
+
+        # Send the SELECT queries of requests using a writeable database to
+        # a read-only database, until they write something. This is
+        # controlled by the READWRITE_OFFLOAD_READS setting. Clients who
+        # are pinned to the database keep reading from it.
+        if config.OFFLOAD_READS and alias not in config.READ_ONLY_DATABASES_SET:
+            if not (config.PIN_AFTER_WRITE and get_pin(request)):
+                self.offload_reads()
+
+        # Resolve the connection for the chosen alias now, so it is looked
+        # up once per request rather than on every attribute access.
+        connection_state.bind()
+
+    def offload_reads(self):
+        offload_alias, balanced = choose_database(config.READ_ONLY_DATABASES)
+        if balanced:
+            request_state.balanced_offload_alias = offload_alias
+        # The read-only databases might all be lagging or failing.
+        if offload_alias in config.READ_ONLY_DATABASES_SET:
+            request_state.offload_alias = offload_alias
+            request_state.offload_connection_alias = offload_alias
+
+    def process_response(self, request, response):
+        if request_state.pinned_alias:
+            set_pin(request, response, request_state.pinned_alias)
+        if config.PROFILE_SAMPLE_RATE:
+            query_profiler.finish(request, response)
+        if config.ROUTING_ADVISOR:
+            routing_advisor.finish(request)
+        if config.NPLUSONE_THRESHOLD:
+            nplusone_detector.finish(request)
+        return response
 
 
 class MultiDBTransactionMiddleware(object):
     """
     Transaction middleware. Optimizes Django's transaction middleware
-    to only create transactions when using a writeable database.
+    to only create transactions when using a writeable database, and
+    (with READWRITE_LAZY_TRANSACTIONS) only once the request writes.
 
     This requires read-only databases to use the "autocommit" option,
     otherwise it will automatically create a transaction as soon as the
@@ -98,30 +251,61 @@ class MultiDBTransactionMiddleware(object):
         if connection.alias in config.READ_ONLY_DATABASES_SET:
             # This is a read-only request, so we know that nothing will be
             # written to the database. There's no need to begin a transaction.
-            pass
+            request_state.transaction_pending = False
+        elif config.LAZY_TRANSACTIONS:
+            # Wait until the request writes something or enters transaction
+            # management itself. See django_readwrite.transactions.
+            lazy_transactions.defer()
         else:
-            # Create a transaction.
+            # Create a transaction. Unlike transactions entered by views,
+            # this doesn't stop the request's reads from being offloaded.
+            offload_alias = request_state.offload_alias
             transaction.enter_transaction_management()
             transaction.managed(True)
+            request_state.transaction_alias = connection.alias
+            request_state.offload_alias = offload_alias
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """
+        Enters transaction management for the view's database, if it has been
+        routed to another database by MultiDBMiddleware.process_view. The
+        transaction entered for the request's database is committed and left
+        first, so it doesn't stay open on that connection.
+
+        """
+
+        transaction_alias = request_state.transaction_alias
+        if transaction_alias and transaction_alias != connection.alias:
+            with connection_state.force(transaction_alias):
+                self.leave_transaction(commit=True)
+            request_state.transaction_alias = None
+
+        if not transaction.is_managed():
+            self.process_request(request)
 
     def process_exception(self, request, exception):
         """Rolls back the database and leaves transaction management."""
 
-        if transaction.is_managed():
-            if transaction.is_dirty():
-                transaction.rollback()
-            transaction.leave_transaction_management()
+        lazy_transactions.cancel()
+        self.leave_transaction(commit=False)
 
     def process_response(self, request, response):
         """Commits and leaves transaction management."""
 
+        lazy_transactions.cancel()
+        self.leave_transaction(commit=True)
+
+        return response
+
+    def leave_transaction(self, commit):
         if transaction.is_managed():
             if transaction.is_dirty():
-                transaction.commit()
+                if commit:
+                    transaction.commit()
+                else:
+                    transaction.rollback()
             transaction.leave_transaction_management()
 
-        return response
-
 
 class ReadOnlyMiddleware(object):
 
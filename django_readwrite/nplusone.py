@@ -0,0 +1,123 @@
+"""
+Detecting N+1 query patterns, where a request runs the same query over and
+over (such as once for every object in a list). It is enabled by the
+READWRITE_NPLUSONE_THRESHOLD setting.
+
+Queries are counted per request by database and SQL fingerprint (see
+django_readwrite.fingerprints). When a query runs more times than the
+threshold, the stack is looked at once to find the code outside of Django
+which ran it. At the end of the request, the queries which ran too many
+times are logged to the 'django_readwrite.nplusone' logger and sent as the
+nplusone_detected signal. With READWRITE_NPLUSONE_STRICT, an NPlusOneError
+is raised instead, from MultiDBMiddleware.process_response. It isn't raised
+by the query itself, so that the other query observers still see it.
+
+"""
+
+import logging
+import os
+import traceback
+
+import django
+
+import django_readwrite
+from django_readwrite import settings as config
+from django_readwrite.connection import request_state
+from django_readwrite.cursors import query_observers
+from django_readwrite.fingerprints import fingerprint
+from django_readwrite.signals import nplusone_detected
+
+
+logger = logging.getLogger('django_readwrite.nplusone')
+
+# Code in these directories is skipped when looking for the caller.
+LIBRARY_DIRS = tuple(
+    os.path.dirname(module.__file__) + os.sep
+    for module in (django, django_readwrite)
+)
+
+
+class NPlusOneError(Exception):
+    pass
+
+
+class Finding(object):
+    """A query which ran too many times in one request."""
+
+    def __init__(self, alias, fingerprint, count, call_site):
+        self.alias = alias
+        self.fingerprint = fingerprint
+        self.count = count
+        # A (filename, line number, function name, source line) tuple, or None.
+        self.call_site = call_site
+
+    def __unicode__(self):
+        if self.call_site:
+            location = ' from %s:%d in %s' % self.call_site[:3]
+        else:
+            location = ''
+        return u'%d queries on %r%s: %s' % (self.count, self.alias, location, self.fingerprint)
+
+
+class RequestQueries(object):
+    """The number of times each query has run in one request."""
+
+    __slots__ = ('counts', 'findings')
+
+    def __init__(self):
+        self.counts = {}
+        self.findings = []
+
+
+def get_call_site():
+    """Returns the innermost frame of the stack which is not library code."""
+    for frame in reversed(traceback.extract_stack()):
+        if not frame[0].startswith(LIBRARY_DIRS):
+            return frame
+    return None
+
+
+class NPlusOneDetector(object):
+    """A query observer which counts the queries of each request."""
+
+    def __init__(self, threshold, strict):
+        self.threshold = threshold
+        self.strict = strict
+
+    def start(self):
+        request_state.request_queries = RequestQueries()
+
+    def finish(self, request):
+        """Reports the queries which ran too many times in the current request."""
+        queries = request_state.request_queries
+        if queries is None:
+            return
+        request_state.request_queries = None
+        if queries.findings:
+            for finding in queries.findings:
+                finding.count = queries.counts[finding.alias, finding.fingerprint]
+            if self.strict:
+                message = u'; '.join(unicode(finding) for finding in queries.findings)
+                raise NPlusOneError(message.encode('utf-8'))
+            for finding in queries.findings:
+                logger.warning(u'Possible N+1 query in %s: %s' % (request.path, unicode(finding)))
+            nplusone_detected.send(sender=self, request=request, findings=queries.findings)
+
+    def query_executed(self, db, sql, params, read_sql, elapsed):
+        queries = request_state.request_queries
+        if queries is None:
+            return
+        key = (db.alias, fingerprint(sql))
+        count = queries.counts.get(key, 0) + 1
+        queries.counts[key] = count
+        if count == self.threshold + 1:
+            queries.findings.append(Finding(key[0], key[1], count, get_call_site()))
+
+    def query_failed(self, db, sql, params, error):
+        pass
+
+
+nplusone_detector = NPlusOneDetector(config.NPLUSONE_THRESHOLD, config.NPLUSONE_STRICT)
+
+if config.NPLUSONE_THRESHOLD:
+    query_observers.append(nplusone_detector)
@@ -0,0 +1,99 @@
+"""
+Running independent read queries at the same time, on the read-only
+databases. For example, a view which needs several slow aggregates can
+wait for the slowest one instead of all of them in turn:
+
+    from django_readwrite.parallel import parallel
+
+    total, visits = parallel(
+        lambda: Order.objects.aggregate(Sum('total')),
+        lambda: Visit.objects.count(),
+    )
+
+Each function is called in one of READWRITE_PARALLEL_WORKERS threads, with
+its own connection to one of the READ_ONLY databases (spread evenly over
+the ones which are not lagging or failing). The connections come from a
+TemporaryConnectionPool for each database, so they are reused between
+calls. The databases are read-only, so the functions can't write anything,
+and they don't see anything written by the current transaction.
+
+"""
+
+import random
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+from django_readwrite import settings as config
+from django_readwrite.connection import connection_state
+from django_readwrite.health import circuit_breakers
+from django_readwrite.lag import lag_monitor
+from django_readwrite.pool import TemporaryConnectionPool
+from django_readwrite.workers import WorkerPool
+
+
+worker_pool = WorkerPool('readwrite-parallel', config.PARALLEL_WORKERS)
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(alias):
+    try:
+        return connection_pools[alias]
+    except KeyError:
+        with connection_pools_lock:
+            if alias not in connection_pools:
+                connection_pools[alias] = TemporaryConnectionPool(
+                    alias_prefix='%s_parallel' % alias,
+                    from_alias=alias,
+                    max_size=config.PARALLEL_WORKERS,
+                    keep_open=True,
+                    idle_timeout=config.PARALLEL_IDLE_TIMEOUT,
+                )
+            return connection_pools[alias]
+
+
+def choose_aliases(count):
+    """Returns a read-only database for each of count functions."""
+
+    aliases = config.READ_ONLY_DATABASES
+    if not aliases:
+        raise ImproperlyConfigured('parallel() requires a database with the READ_ONLY option.')
+
+    # Avoid databases which are lagging or failing, unless they all are.
+    if config.MAX_LAG:
+        aliases = lag_monitor.filter(aliases) or aliases
+    if config.CIRCUIT_BREAKER_FAILURES:
+        aliases = circuit_breakers.filter(aliases) or aliases
+
+    start = random.randrange(len(aliases))
+    return [aliases[(start + index) % len(aliases)] for index in range(count)]
+
+
+def call_with_connection(alias, func):
+    """Calls a function using a pooled connection to a database."""
+    with get_connection_pool(alias).get() as pooled_alias:
+        with connection_state.force(pooled_alias):
+            return func()
+
+
+def parallel(*funcs):
+    """
+    Calls the functions at the same time, each using a connection to a
+    read-only database, and returns a list of their results in the same
+    order. If any of them raise an exception, the first one is raised
+    once they have all finished.
+
+    """
+
+    aliases = choose_aliases(len(funcs))
+
+    if worker_pool.in_worker():
+        # Waiting for the other workers from one of them could deadlock.
+        return [call_with_connection(alias, func) for alias, func in zip(aliases, funcs)]
+
+    futures = [worker_pool.submit(call_with_connection, alias, func) for alias, func in zip(aliases, funcs)]
+    for future in futures:
+        future.wait()
+    return [future.result() for future in futures]
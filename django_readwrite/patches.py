@@ -4,17 +4,26 @@ from django.db.backends import BaseDatabaseWrapper
 from django.db.backends.dummy.base import DatabaseWrapper as DummyDatabaseWrapper
 from django.forms.models import BaseModelForm
 
-from django_readwrite import decorators
+from django_readwrite import decorators, persistent
+from django_readwrite import settings as config
 from django_readwrite.connection import ConnectionProxy
-from django_readwrite.cursors import PrintCursorWrapper, RestrictedCursorWrapper
+from django_readwrite.cursors import open_cursor, query_observers, PrintCursorWrapper, RestrictedCursorWrapper
 
 
-# Patch Django's transaction management functions to trigger signals.
+# Patch Django's transaction management functions to trigger signals and
+# keep track of savepoints, to stop offloading reads once a transaction
+# has been entered, and to start the request's pending transaction.
+transaction.enter_transaction_management = decorators.enter_transaction_management(transaction.enter_transaction_management)
 transaction.managed = decorators.managed(transaction.managed)
 transaction.commit_unless_managed = decorators.commit_unless_managed(transaction.commit_unless_managed)
 transaction.rollback_unless_managed = decorators.rollback_unless_managed(transaction.rollback_unless_managed)
-transaction.commit = decorators.commit(transaction.commit)
-transaction.rollback = decorators.rollback(transaction.rollback)
+transaction.commit = decorators.start_pending_transaction(decorators.commit(transaction.commit))
+transaction.rollback = decorators.start_pending_transaction(decorators.rollback(transaction.rollback))
+transaction.set_dirty = decorators.start_pending_transaction(transaction.set_dirty)
+transaction.set_clean = decorators.start_pending_transaction(transaction.set_clean)
+transaction.savepoint = decorators.start_pending_transaction(decorators.savepoint(transaction.savepoint))
+transaction.savepoint_commit = decorators.savepoint_commit(transaction.savepoint_commit)
+transaction.savepoint_rollback = decorators.savepoint_rollback(transaction.savepoint_rollback)
 
 
 # Patch Django's form class to handle read-only mode.
@@ -32,13 +41,23 @@ for connection_class in set(conn.__class__ for conn in connections.all()):
 # Patch Django's BaseDatabaseWrapper to enforce database write restrictions.
 if settings.SQL_DEBUG and not settings.TEST_MODE:
     def cursor(self):
-        cursor = self.make_debug_cursor(self._cursor())
+        cursor = self.make_debug_cursor(open_cursor(self))
         return PrintCursorWrapper(cursor, self)
 elif settings.SQL_QUERY_DEBUG:
     def cursor(self):
-        cursor = self.make_debug_cursor(self._cursor())
+        cursor = self.make_debug_cursor(open_cursor(self))
         return RestrictedCursorWrapper(cursor, self)
 else:
     def cursor(self):
-        return RestrictedCursorWrapper(self._cursor(), self)
+        return RestrictedCursorWrapper(open_cursor(self), self)
 BaseDatabaseWrapper.cursor = cursor
+
+
+# Load the modules which add query observers to the cursors,
+# according to the settings.
+from django_readwrite import advisor, balancers, hedging, health, nplusone, profiling, slowlog
+
+# Mark the kept connections which had database errors, so they are checked
+# at the end of the request. See django_readwrite.persistent.
+if config.CONN_MAX_AGES:
+    query_observers.append(persistent.connection_errors)
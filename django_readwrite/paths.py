@@ -0,0 +1,57 @@
+"""
+Matching request paths against the HTTP_PATHS options in settings.DATABASES.
+
+"""
+
+from django_readwrite import settings as config
+from django_readwrite.utils import LRUCache
+
+
+class PathRouter(object):
+    """
+    Finds every database with an HTTP_PATHS prefix matching a request path.
+
+    The prefixes are compiled into a trie, so a path is matched against all
+    of them in a single pass over its characters, which stops as soon as no
+    prefix can match. Results are remembered in an LRU cache keyed by path.
+
+    """
+
+    def __init__(self, path_prefixes, cache_size):
+        self.trie = {}
+        for alias, prefixes in path_prefixes.items():
+            for prefix in prefixes:
+                node = self.trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(alias)
+        self.cache = LRUCache(cache_size)
+
+    def match(self, path):
+        """Returns a tuple of the databases with a prefix matching the path."""
+        aliases = self.cache.get(path, LRUCache.missed)
+        if aliases is LRUCache.missed:
+            aliases = self._match(path)
+            self.cache.set(path, aliases)
+        return aliases
+
+    def _match(self, path):
+        result = []
+        node = self.trie
+        for char in path:
+            if None in node:
+                result.extend(node[None])
+            try:
+                node = node[char]
+            except KeyError:
+                break
+        else:
+            if None in node:
+                result.extend(node[None])
+        if len(result) > 1:
+            # A database with several matching prefixes only counts once.
+            result = sorted(set(result), key=result.index)
+        return tuple(result)
+
+
+path_router = PathRouter(config.DATABASE_PATH_PREFIXES, config.PATH_CACHE_SIZE)
@@ -0,0 +1,180 @@
+"""
+Persistent connections. Databases with the CONN_MAX_AGE option defined
+within settings.DATABASES keep their connections open between requests,
+for up to that many seconds after they were opened (or forever if it is
+None).
+
+Django closes connections at the end of every request, but with
+ConnectionProxy it only closes the connection of the current alias. When
+any database has CONN_MAX_AGE, MultiDBMiddleware replaces that with
+release_connections, which goes through the connection of every alias in
+the current thread. Connections for databases without CONN_MAX_AGE are
+closed as usual. The others are closed once they are too old. Any
+transaction left open by the request is rolled back, so the next request
+starts cleanly, and the connection is closed if that fails. Connections
+which had a database error are checked with a SELECT 1 query instead.
+Every connection is closed after a request which raised a database error.
+
+At the start of each request, check_connections closes the kept
+connections which have become too old. Those which have been idle for
+READWRITE_CONN_HEALTH_CHECK_INTERVAL seconds are checked with a SELECT 1
+query first, in case the database server closed them, so that the request
+opens new ones instead of failing on its first query. Connections used
+more recently than that are kept without asking the server.
+
+"""
+
+import sys
+import time
+
+from django.db import connections, transaction, DatabaseError
+from django.db.backends.signals import connection_created
+
+from django_readwrite import settings as config
+from django_readwrite.connection import connection_state
+
+
+# The value of psycopg2.extensions.TRANSACTION_STATUS_IDLE.
+TRANSACTION_STATUS_IDLE = 0
+
+
+def get_open_connections():
+    """Returns the database wrappers in this thread which have a connection."""
+    result = []
+    for alias in connections.databases:
+        wrapper = connections[alias]
+        if wrapper.connection is not None:
+            result.append((alias, wrapper))
+    return result
+
+
+def is_usable(wrapper, ping=False):
+    """
+    Checks that a connection is still open, and rolls back anything left in
+    it. With ping, it also checks that the database server still answers.
+
+    """
+    connection = wrapper.connection
+    if getattr(connection, 'closed', False):
+        return False
+    try:
+        connection.rollback()
+        if ping:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+    except Exception:
+        return False
+    return True
+
+
+def in_transaction(alias, wrapper):
+    """
+    Checks whether a connection might have a transaction open. This doesn't
+    ask the database server, so drivers which can't tell (such as MySQLdb)
+    are assumed to have one, since a transaction left open by reads would
+    give the next request old data.
+
+    """
+    if transaction.is_dirty(using=alias):
+        return True
+    get_transaction_status = getattr(wrapper.connection, 'get_transaction_status', None)
+    if get_transaction_status is None:
+        return True
+    return get_transaction_status() != TRANSACTION_STATUS_IDLE
+
+
+def has_been_idle(wrapper, now):
+    """Checks whether a connection has been idle long enough to check it."""
+    released = getattr(wrapper, 'readwrite_released', None)
+    if released is None or released[0] is not wrapper.connection:
+        # It wasn't kept from a previous request.
+        return True
+    return now - released[1] >= config.CONN_HEALTH_CHECK_INTERVAL
+
+
+def is_too_old(alias, wrapper, now):
+    max_age = config.CONN_MAX_AGES[alias]
+    if max_age is None:
+        return False
+    opened = getattr(wrapper, 'readwrite_opened', None)
+    if opened is None or opened[0] is not wrapper.connection:
+        # It was opened before this module was loaded, so count from now.
+        opened = wrapper.readwrite_opened = (wrapper.connection, now)
+    return now - opened[1] >= max_age
+
+
+def connection_opened(sender, connection, **kwargs):
+    """Remembers when each connection was opened."""
+    with connection_state.force(None):
+        connection.readwrite_opened = (connection.connection, time.time())
+
+
+def close(wrapper):
+    try:
+        wrapper.close()
+    except Exception:
+        # It was already broken, so just forget about it.
+        wrapper.connection = None
+
+
+def release_connections(**kwargs):
+    """Closes the connections which should not be kept for the next request."""
+    now = time.time()
+    with connection_state.force(None):
+        for alias, wrapper in get_open_connections():
+            failed = getattr(wrapper, 'readwrite_failed', False)
+            wrapper.readwrite_failed = False
+            if alias not in config.CONN_MAX_AGES or is_too_old(alias, wrapper, now):
+                close(wrapper)
+            elif failed and not is_usable(wrapper, ping=True):
+                close(wrapper)
+            elif not failed and in_transaction(alias, wrapper) and not is_usable(wrapper):
+                close(wrapper)
+            else:
+                wrapper.readwrite_released = (wrapper.connection, now)
+
+
+def check_connections(**kwargs):
+    """Closes the kept connections which are too old or no longer work."""
+    now = time.time()
+    with connection_state.force(None):
+        for alias, wrapper in get_open_connections():
+            if alias in config.CONN_MAX_AGES:
+                if is_too_old(alias, wrapper, now):
+                    close(wrapper)
+                elif has_been_idle(wrapper, now) and not is_usable(wrapper, ping=True):
+                    close(wrapper)
+
+
+def discard_connections(**kwargs):
+    """Closes every connection after a request raised a database error."""
+    error = sys.exc_info()[1]
+    if isinstance(error, DatabaseError):
+        with connection_state.force(None):
+            for alias, wrapper in get_open_connections():
+                close(wrapper)
+
+
+class ConnectionErrors(object):
+    """
+    A query observer which marks the connections that had database errors.
+    It is added to the query observers by django_readwrite.patches, since
+    this module is loaded before django_readwrite.cursors can be.
+
+    """
+
+    def query_executed(self, db, sql, params, read_sql, elapsed):
+        pass
+
+    def query_failed(self, db, sql, params, error):
+        alias = db.alias
+        with connection_state.force(None):
+            connections[alias].readwrite_failed = True
+
+
+connection_errors = ConnectionErrors()
+
+if config.CONN_MAX_AGES:
+    connection_created.connect(connection_opened, dispatch_uid='django_readwrite.persistent.connection_opened')
@@ -0,0 +1,102 @@
+"""
+Read-your-writes pinning. When READWRITE_PIN_AFTER_WRITE is enabled, a
+request which commits a write to a database pins its client to that
+database for the PIN_TTL of the database. Requests from that client which
+would otherwise use a read-only database will use the pinned database
+until the pin expires, so they don't read from a replica which hasn't
+caught up with their own writes yet.
+
+The pin is stored in a signed cookie, or in the session if
+READWRITE_PIN_AFTER_WRITE is 'session'. Session pinning requires the
+SessionMiddleware to be listed before MultiDBMiddleware.
+
+"""
+
+import hashlib
+import hmac
+import time
+
+from django.conf import settings
+
+from django_readwrite import settings as config
+from django_readwrite.connection import connection_state, request_state
+from django_readwrite.signals import post_commit
+
+try:
+    from django.utils.crypto import constant_time_compare, salted_hmac
+except ImportError:
+    # Django < 1.3
+    def salted_hmac(key_salt, value):
+        key = hashlib.sha1(key_salt + settings.SECRET_KEY).digest()
+        return hmac.new(key, msg=value, digestmod=hashlib.sha1)
+
+    def constant_time_compare(value1, value2):
+        if len(value1) != len(value2):
+            return False
+        result = 0
+        for char1, char2 in zip(value1, value2):
+            result |= ord(char1) ^ ord(char2)
+        return result == 0
+
+
+SESSION_KEY = 'readwrite.pin'
+
+# Keeps the pin cookie's signatures apart from any other HMAC of SECRET_KEY.
+SALT = 'django_readwrite.pinning'
+
+
+def sign(value):
+    return salted_hmac(SALT, value).hexdigest()
+
+
+def get_pin(request):
+    """Returns the database that a request's client is pinned to, or None."""
+
+    if config.PIN_AFTER_WRITE == 'session':
+        try:
+            alias, expires = request.session[SESSION_KEY]
+        except (KeyError, TypeError, ValueError):
+            return None
+    else:
+        try:
+            value, signature = request.COOKIES[config.PIN_COOKIE_NAME].rsplit(':', 1)
+            alias, expires = value.rsplit(':', 1)
+            expires = float(expires)
+        except (KeyError, ValueError):
+            return None
+        if not constant_time_compare(signature, sign(value)):
+            return None
+
+    if expires > time.time() and alias in config.PIN_TTLS:
+        return alias
+    return None
+
+
+def set_pin(request, response, alias):
+    """Pins a request's client to a database."""
+
+    ttl = config.PIN_TTLS[alias]
+    if not ttl:
+        return
+    expires = time.time() + ttl
+
+    if config.PIN_AFTER_WRITE == 'session':
+        request.session[SESSION_KEY] = (alias, expires)
+    else:
+        value = '%s:%f' % (alias, expires)
+        response.set_cookie(
+            key=config.PIN_COOKIE_NAME,
+            value='%s:%s' % (value, sign(value)),
+            max_age=ttl,
+        )
+
+
+def remember_write(**kwargs):
+    """Remembers which writeable database the current request committed to."""
+    alias = connection_state.alias
+    if alias and alias not in config.READ_ONLY_DATABASES_SET:
+        request_state.pinned_alias = alias
+
+
+if config.PIN_AFTER_WRITE:
+    post_commit.connect(remember_write, dispatch_uid='django_readwrite.pinning.remember_write')
@@ -1,51 +1,227 @@
 import contextlib
 import itertools
+import logging
 import threading
-
-from Queue import Queue, Empty
+import time
 
 from django.db import connections
 
 from django_readwrite.connection import connection_state
 
 
+class PoolTimeoutError(Exception):
+    pass
+
+
+class PooledConnection(object):
+    """A database alias belonging to a pool, and its open connection (if any)."""
+
+    __slots__ = ('alias', 'connection', 'created', 'last_used')
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.connection = None
+        self.created = None
+        self.last_used = None
+
+
 class TemporaryConnectionPool(object):
     """
-    An unlimited pool of temporary connections which can be used in
-    isolation. An instance of this class should be created at the process
-    level. Threads can safely "get" a connection using the get() context
-    manager and have sole access to it for the duration of the context.
+    A pool of temporary connections which can be used in isolation. An
+    instance of this class should be created at the process level. Threads
+    can safely "get" a connection using the get() context manager and have
+    sole access to it for the duration of the context.
+
+    Each connection has its own alias in settings.DATABASES, copied from
+    another database. With max_size, no more than that many aliases are
+    created, and get() waits for up to timeout seconds (or forever if the
+    timeout is None) for one to be returned before raising PoolTimeoutError.
+
+    By default, connections are closed when the context exits. With
+    keep_open, they are kept for the next thread instead. Django's database
+    wrappers are thread-local, so the raw connection is moved between the
+    wrappers of each thread. Kept connections are checked with the check_sql
+    query before being reused, and are closed after idle_timeout seconds
+    without being used, or max_lifetime seconds after they were opened.
+    SQLite connections can only be moved between threads if the database
+    has check_same_thread set to False in its OPTIONS.
 
     """
 
-    def __init__(self, alias_prefix, from_alias='default'):
+    def __init__(self, alias_prefix, from_alias='default', max_size=None, timeout=None,
+                 keep_open=False, idle_timeout=None, max_lifetime=None, check_sql='SELECT 1'):
         self.prefix = alias_prefix
         self.from_alias = from_alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self.keep_open = keep_open
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.check_sql = check_sql
         self.count = itertools.count(1)
-        self.lock = threading.Lock()
-        self.connections = Queue()
+        self.condition = threading.Condition()
+        self.idle = []
+        self.size = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.creates = 0
+        self.reuses = 0
+        self.discards = 0
 
     def _new_connection(self):
         """Create a new unique connection, using details from another."""
-        with self.lock:
-            alias = '%s%d' % (self.prefix, next(self.count))
-            connections.databases[alias] = connections.databases[self.from_alias]
-        return alias
+        alias = '%s%d' % (self.prefix, next(self.count))
+        connections.databases[alias] = connections.databases[self.from_alias]
+        return PooledConnection(alias)
 
     @contextlib.contextmanager
     def get(self):
         """
-        Get or create a database connection for temporary use.
-        The connection is automatically closed when the context exits.
+        Get or create a database connection for temporary use. The connection
+        is automatically closed (or kept, with keep_open) when the context
+        exits, and is always closed if the context raised an exception.
 
         """
+        pooled = self.acquire()
+        discard = True
         try:
-            alias = self.connections.get(block=False)
-        except Empty:
-            alias = self._new_connection()
-        try:
-            yield alias
+            yield pooled.alias
+            discard = False
         finally:
-            with connection_state.force(None):
-                connections[alias].close()
-            self.connections.put(alias)
+            # Anything raised, even GeneratorExit or KeyboardInterrupt,
+            # discards the connection but still returns the alias.
+            self.release(pooled, discard=discard)
+
+    def acquire(self):
+        """Takes a connection from the pool, waiting for one if it is full."""
+
+        self.reap()
+
+        deadline = self.timeout is not None and time.time() + self.timeout
+        with self.condition:
+            self.checkouts += 1
+            waited = False
+            while True:
+                if self.idle:
+                    pooled = self.idle.pop()
+                    break
+                if self.max_size is None or self.size < self.max_size:
+                    self.size += 1
+                    try:
+                        pooled = self._new_connection()
+                    except BaseException:
+                        # Give the slot back, and to anyone waiting for it.
+                        self.size -= 1
+                        self.condition.notify()
+                        raise
+                    break
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeoutError('No connections were returned to the %r pool within %s seconds.' % (self.prefix, self.timeout))
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait()
+
+        if pooled.connection is not None and not self.reusable(pooled, check=True):
+            self.close(pooled)
+
+        with connection_state.force(None):
+            connections[pooled.alias].connection = pooled.connection
+        if pooled.connection is not None:
+            self.reuses += 1
+        else:
+            pooled.created = time.time()
+        return pooled
+
+    def release(self, pooled, discard=False):
+        """Puts a connection back into the pool."""
+
+        with connection_state.force(None):
+            wrapper = connections[pooled.alias]
+            if pooled.connection is None and wrapper.connection is not None:
+                self.creates += 1
+            pooled.connection = wrapper.connection
+            # Detach it from this thread's wrapper.
+            wrapper.connection = None
+
+        if pooled.connection is not None:
+            if discard or not self.keep_open or not self.reusable(pooled):
+                self.close(pooled)
+            else:
+                try:
+                    # Don't leave anything uncommitted for the next thread.
+                    pooled.connection.rollback()
+                except Exception:
+                    self.close(pooled)
+
+        pooled.last_used = time.time()
+        with self.condition:
+            self.idle.append(pooled)
+            self.condition.notify()
+        self.reap()
+
+    def reusable(self, pooled, check=False):
+        """Checks if a connection is young enough, and optionally that it works."""
+        if self.max_lifetime is not None and time.time() - pooled.created > self.max_lifetime:
+            return False
+        if check and self.check_sql:
+            try:
+                cursor = pooled.connection.cursor()
+                cursor.execute(self.check_sql)
+                cursor.fetchall()
+                cursor.close()
+            except Exception:
+                return False
+        return True
+
+    def close(self, pooled):
+        connection, pooled.connection = pooled.connection, None
+        self.close_connection(pooled.alias, connection)
+
+    def close_connection(self, alias, connection):
+        try:
+            connection.close()
+        except Exception:
+            logging.exception('Error closing pooled connection %r.' % alias)
+        self.discards += 1
+
+    def reap(self):
+        """Closes the kept connections which have been idle for too long."""
+
+        if self.idle_timeout is None:
+            return
+
+        expired = []
+        cutoff = time.time() - self.idle_timeout
+        with self.condition:
+            for pooled in self.idle:
+                if pooled.connection is not None and pooled.last_used < cutoff:
+                    # Closing the connection leaves the alias in the pool.
+                    expired.append((pooled.alias, pooled.connection))
+                    pooled.connection = None
+
+        for alias, connection in expired:
+            self.close_connection(alias, connection)
+
+    def stats(self):
+        with self.condition:
+            open_idle = len([pooled for pooled in self.idle if pooled.connection is not None])
+            return {
+                'size': self.size,
+                'max_size': self.max_size,
+                'idle': len(self.idle),
+                'idle_open': open_idle,
+                'in_use': self.size - len(self.idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'creates': self.creates,
+                'reuses': self.reuses,
+                'discards': self.discards,
+            }
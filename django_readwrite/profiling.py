@@ -0,0 +1,94 @@
+"""
+A sampling query profiler. For a READWRITE_PROFILE_SAMPLE_RATE fraction of
+requests, it counts the queries and the time they took, in total and for
+each database, with a histogram of query times per database. SQL is not
+kept, so it is cheap enough to leave running in production.
+
+At the end of a sampled request, the statistics are sent as the
+request_query_stats signal and, if READWRITE_PROFILE_SERVER_TIMING is
+enabled, added to the response as a Server-Timing header.
+
+"""
+
+import bisect
+import random
+
+from django_readwrite import settings as config
+from django_readwrite.connection import request_state
+from django_readwrite.cursors import query_observers
+from django_readwrite.signals import request_query_stats
+
+
+# The upper bounds (in seconds) of the histogram buckets for query times.
+# There is an extra bucket for queries slower than the last one.
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class QueryStats(object):
+    """
+    Query statistics for one request. The databases attribute is a dict of
+    {alias: [count, time, histogram]} where the histogram is a list of
+    query counts for each of the HISTOGRAM_BUCKETS.
+
+    """
+
+    __slots__ = ('count', 'time', 'databases')
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.databases = {}
+
+    def add(self, alias, elapsed):
+        self.count += 1
+        self.time += elapsed
+        try:
+            database = self.databases[alias]
+        except KeyError:
+            database = self.databases[alias] = [0, 0.0, [0] * (len(HISTOGRAM_BUCKETS) + 1)]
+        database[0] += 1
+        database[1] += elapsed
+        database[2][bisect.bisect_left(HISTOGRAM_BUCKETS, elapsed)] += 1
+
+    def server_timing(self):
+        """Returns the statistics as a Server-Timing header value."""
+        metrics = ['db;dur=%.3f;desc="%d queries"' % (self.time * 1000, self.count)]
+        for alias, (count, elapsed, histogram) in sorted(self.databases.items()):
+            metrics.append('db-%s;dur=%.3f;desc="%d queries"' % (alias, elapsed * 1000, count))
+        return ', '.join(metrics)
+
+
+class QueryProfiler(object):
+    """A query observer which records queries for sampled requests."""
+
+    def __init__(self, sample_rate, server_timing):
+        self.sample_rate = sample_rate
+        self.server_timing = server_timing
+
+    def start(self):
+        """Decides whether to sample the current request."""
+        if random.random() < self.sample_rate:
+            request_state.query_stats = QueryStats()
+
+    def finish(self, request, response):
+        """Reports the statistics for the current request, if it was sampled."""
+        stats = request_state.query_stats
+        if stats is not None:
+            request_state.query_stats = None
+            if self.server_timing:
+                response['Server-Timing'] = stats.server_timing()
+            request_query_stats.send(sender=self, request=request, stats=stats)
+
+    def query_executed(self, db, sql, params, read_sql, elapsed):
+        stats = request_state.query_stats
+        if stats is not None:
+            stats.add(db.alias, elapsed)
+
+    def query_failed(self, db, sql, params, error):
+        pass
+
+
+query_profiler = QueryProfiler(config.PROFILE_SAMPLE_RATE, config.PROFILE_SERVER_TIMING)
+
+if config.PROFILE_SAMPLE_RATE:
+    query_observers.append(query_profiler)
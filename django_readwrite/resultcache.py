@@ -0,0 +1,339 @@
+"""
+Caching the results of SELECT queries on read-only databases. It is
+enabled by the READWRITE_RESULT_CACHE setting, and can be disabled for a
+database by setting the RESULT_CACHE option to False within the
+settings.DATABASES options.
+
+Results are cached by their exact SQL and parameters, for up to
+READWRITE_RESULT_CACHE_TIMEOUT seconds. They are shared between all of the
+read-only databases, which are assumed to be replicas of the same data.
+Results with more than READWRITE_RESULT_CACHE_MAX_ROWS rows are not cached,
+and at most READWRITE_RESULT_CACHE_SIZE results are kept in each process.
+
+Every table has a version, which changes whenever a write to the table is
+seen on a writeable database, and again when it is committed. A cached
+result is only used if the tables it was read from have not changed since.
+Writes which can't be parsed, and stored procedures, change the version of
+every table. Replicas can still return rows from before a commit until they
+catch up, so results can be up to the timeout out of date.
+
+With READWRITE_RESULT_CACHE_SHARED, results and table versions are also
+stored in Django's cache backend. Processes check it when they don't have a
+result, and see the writes made by other processes after up to
+READWRITE_RESULT_CACHE_VERSION_DELAY seconds.
+
+"""
+
+import hashlib
+import re
+import time
+import uuid
+
+from django.core.cache import cache as cache_backend
+
+from django_readwrite import settings as config
+from django_readwrite.contrib.sluggish import SluggishCache
+from django_readwrite.local import local
+from django_readwrite.signals import post_commit, post_rollback
+from django_readwrite.utils import LRUCache
+
+
+TABLE_CACHE_SIZE = 1000
+
+# The version used for invalidating every table.
+ALL_TABLES = '*'
+
+NAME = r'[`"\[]?[\w$]+[`"\]]?(?:\.[`"\[]?[\w$]+[`"\]]?)?'
+NAME_RE = re.compile(r'[\w$]+')
+READ_TABLES_RE = re.compile(
+    r'\b(?:FROM|JOIN)\s+(%s(?:\s+(?:AS\s+)?%s)?(?:\s*,\s*%s(?:\s+(?:AS\s+)?%s)?)*)' % (NAME, NAME, NAME, NAME),
+    re.IGNORECASE,
+)
+WRITE_TABLES_RE = re.compile(
+    r'\b(?:INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|UPDATE|DELETE\s+FROM|'
+    r'TRUNCATE(?:\s+TABLE)?|ALTER\s+TABLE|DROP\s+TABLE(?:\s+IF\s+EXISTS)?)\s+(%s)' % NAME,
+    re.IGNORECASE,
+)
+# Statements which are not reads, but don't change any data either.
+NO_DATA_SQL_RE = re.compile(
+    r'\s*(SET|SHOW|BEGIN|START|COMMIT|ROLLBACK|LOCK|UNLOCK|CREATE|ANALYZE|VACUUM)\b',
+    re.IGNORECASE,
+)
+
+
+def table_name(name):
+    """Returns a table name without its quotes or schema, in lowercase."""
+    return NAME_RE.findall(name)[-1].lower()
+
+
+def parse_read_tables(sql):
+    """Returns the set of tables which some read SQL reads from."""
+    tables = set()
+    for table_list in READ_TABLES_RE.findall(sql):
+        for item in table_list.split(','):
+            tables.add(table_name(item.split()[0]))
+    return frozenset(tables)
+
+
+def parse_write_tables(sql):
+    """
+    Returns the set of tables which some write SQL changes. This is None
+    if the tables could not be found, and empty if no data is changed.
+
+    """
+    tables = frozenset(table_name(name) for name in WRITE_TABLES_RE.findall(sql))
+    if tables:
+        return tables
+    if NO_DATA_SQL_RE.match(sql):
+        return frozenset()
+    return None
+
+
+class CachedResult(object):
+    """
+    The rows returned by a query. An incomplete result has the first rows
+    of a query which returned too many rows to cache, and the rest must be
+    fetched from the cursor.
+
+    """
+
+    def __init__(self, description, rows, rowcount, complete=True):
+        self.description = description
+        self.rows = rows
+        self.rowcount = rowcount
+        self.complete = complete
+
+
+class CachedResultCursor(object):
+    """
+    Wraps a database cursor, so that the rows of a query can be served from
+    a CachedResult instead of from the database. Running another query on
+    the cursor goes back to using the database.
+
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.result = None
+        self.position = 0
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def serve(self, result):
+        self.result = result
+        self.position = 0
+
+    def execute(self, sql, params=()):
+        self.result = None
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.result = None
+        return self.cursor.executemany(sql, param_list)
+
+    def callproc(self, procname, params=()):
+        self.result = None
+        return self.cursor.callproc(procname, params)
+
+    @property
+    def description(self):
+        if self.result is None:
+            return self.cursor.description
+        return self.result.description
+
+    @property
+    def rowcount(self):
+        if self.result is None or not self.result.complete:
+            return self.cursor.rowcount
+        return self.result.rowcount
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows and rows[0] or None
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.cursor.arraysize
+        if self.result is None:
+            return self.cursor.fetchmany(size)
+        start = self.position
+        rows = self.result.rows[start:start + size]
+        self.position = start + len(rows)
+        if len(rows) < size and not self.result.complete:
+            rows.extend(self.cursor.fetchmany(size - len(rows)))
+        return rows
+
+    def fetchall(self):
+        if self.result is None:
+            return self.cursor.fetchall()
+        rows = self.result.rows[self.position:]
+        self.position = len(self.result.rows)
+        if not self.result.complete:
+            rows.extend(self.cursor.fetchall())
+        return rows
+
+
+class TableVersions(object):
+    """
+    The current version of each table. Versions are random, so that
+    processes sharing them through the cache backend can't repeat each
+    other's versions.
+
+    """
+
+    key_prefix = 'readwrite.table:'
+
+    def __init__(self, shared, delay):
+        self.versions = {}
+        self.shared = shared and SluggishCache(cache_backend, delay=delay)
+
+    def get(self, tables):
+        """Returns the current versions of the tables, as a tuple."""
+        if self.shared:
+            get = self.shared.get
+            prefix = self.key_prefix
+            return tuple([get(prefix + table) for table in tables])
+        versions = self.versions
+        return tuple([versions.get(table) for table in tables])
+
+    def change(self, tables):
+        for table in tables:
+            version = uuid.uuid4().hex
+            self.versions[table] = version
+            if self.shared:
+                self.shared.set(self.key_prefix + table, version, config.RESULT_CACHE_TIMEOUT)
+
+
+class ResultCache(object):
+
+    key_prefix = 'readwrite.result:'
+
+    def __init__(self, timeout, max_rows, size, shared, version_delay):
+        self.timeout = timeout
+        self.max_rows = max_rows
+        self.results = LRUCache(size)
+        self.read_tables = LRUCache(TABLE_CACHE_SIZE)
+        self.write_tables = LRUCache(TABLE_CACHE_SIZE)
+        self.versions = TableVersions(shared, version_delay)
+        self.shared = shared
+        # The tables written to by the current transaction.
+        self.pending = local()
+        self.stores = 0
+        self.invalidations = 0
+
+    def get(self, sql, params):
+        """
+        Returns (key, versions, result) for a query. The result is None if
+        it is not cached, and the key is None if it can't be cached.
+
+        """
+
+        tables = self.read_tables.get(sql)
+        if tables is None:
+            tables = parse_read_tables(sql)
+            self.read_tables.set(sql, tables)
+        if not tables:
+            # Without any tables, there is no way of knowing when it changes.
+            return None, None, None
+
+        try:
+            if isinstance(params, dict):
+                key = (sql, tuple(sorted(params.items())))
+            else:
+                key = (sql, tuple(params))
+            hash(key)
+        except TypeError:
+            return None, None, None
+
+        versions = (tables, self.versions.get(tables), self.versions.get((ALL_TABLES,)))
+
+        entry = self.results.get(key)
+        if entry is None and self.shared:
+            entry = cache_backend.get(self.shared_key(key))
+            if entry is not None:
+                self.results.set(key, entry)
+        if entry is not None:
+            expires, entry_versions, result = entry
+            if expires > time.time() and entry_versions == versions:
+                return key, versions, result
+            self.results.delete(key)
+
+        return key, versions, None
+
+    def fetch(self, key, versions, cursor):
+        """
+        Reads the rows of a query from the cursor, and caches them if there
+        are not too many. Returns them as a CachedResult.
+
+        """
+        rows = list(cursor.fetchmany(self.max_rows + 1))
+        if len(rows) > self.max_rows:
+            return CachedResult(cursor.description, rows, cursor.rowcount, complete=False)
+        result = CachedResult(cursor.description, rows, cursor.rowcount)
+        entry = (time.time() + self.timeout, versions, result)
+        self.results.set(key, entry)
+        if self.shared:
+            cache_backend.set(self.shared_key(key), entry, self.timeout)
+        self.stores += 1
+        return result
+
+    def shared_key(self, key):
+        return self.key_prefix + hashlib.md5(repr(key)).hexdigest()
+
+    def invalidate(self, sql):
+        """Changes the versions of the tables written to by some SQL."""
+        tables = self.write_tables.get(sql)
+        if tables is None:
+            tables = parse_write_tables(sql)
+            if tables is None:
+                tables = frozenset([ALL_TABLES])
+            self.write_tables.set(sql, tables)
+        if tables:
+            self.change(tables)
+
+    def invalidate_all(self):
+        self.change(frozenset([ALL_TABLES]))
+
+    def change(self, tables):
+        self.versions.change(tables)
+        self.invalidations += 1
+        # Change them again after committing, in case a replica
+        # was read from and cached in the meantime.
+        self.pending.tables = getattr(self.pending, 'tables', frozenset()) | tables
+
+    def committed(self, **kwargs):
+        tables = getattr(self.pending, 'tables', None)
+        if tables:
+            self.pending.tables = frozenset()
+            self.versions.change(tables)
+
+    def rolled_back(self, **kwargs):
+        self.pending.tables = frozenset()
+
+    def clear(self):
+        self.results.clear()
+        self.stores = 0
+        self.invalidations = 0
+
+    def stats(self):
+        stats = self.results.stats()
+        stats['stores'] = self.stores
+        stats['invalidations'] = self.invalidations
+        return stats
+
+
+result_cache = ResultCache(
+    timeout=config.RESULT_CACHE_TIMEOUT,
+    max_rows=config.RESULT_CACHE_MAX_ROWS,
+    size=config.RESULT_CACHE_SIZE,
+    shared=config.RESULT_CACHE_SHARED,
+    version_delay=config.RESULT_CACHE_VERSION_DELAY,
+)
+
+if config.RESULT_CACHE:
+    post_commit.connect(result_cache.committed, dispatch_uid='django_readwrite.resultcache.committed')
+    post_rollback.connect(result_cache.rolled_back, dispatch_uid='django_readwrite.resultcache.rolled_back')
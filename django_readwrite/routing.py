@@ -0,0 +1,150 @@
+"""
+Choosing which database to use, for requests (see MultiDBMiddleware) and
+for code that runs outside of requests, such as background tasks,
+management commands and scripts (see routing).
+
+"""
+
+import functools
+
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from django_readwrite import settings as config
+from django_readwrite.balancers import balancer
+from django_readwrite.connection import connection_state
+from django_readwrite.health import circuit_breakers
+from django_readwrite.lag import lag_monitor
+from django_readwrite.readonly import read_only_mode
+
+
+def choose_database(db_aliases):
+    """
+    Chooses one of the given databases. Returns a tuple of (alias, balanced)
+    where balanced is True if the load balancer chose the database, in which
+    case balancer.finished() must be called when it is no longer being used.
+
+    """
+
+    # Always use a read-only database when in read-only mode. This is
+    # controlled by defining READ_ONLY or READ_ONLY_WARNING within the
+    # settings.DATABASES options. This is slightly more complicated than
+    # necessary so it can avoid unnecessarily checking the value of
+    # read_only_mode (which accesses memcache).
+    if config.READ_ONLY_DATABASES:
+        for alias in db_aliases:
+            if alias not in config.READ_ONLY_DATABASES_SET:
+                # One of the options is not a read database,
+                # so read-only mode will have to be checked.
+                if read_only_mode:
+                    db_aliases = config.READ_ONLY_DATABASES
+                break
+
+    # Avoid databases which have fallen too far behind the primary
+    # database. This is controlled by defining MAX_LAG within the
+    # settings.DATABASES options. If they are all too far behind,
+    # then use the primary database instead.
+    if config.MAX_LAG:
+        db_aliases = lag_monitor.filter(db_aliases) or [DEFAULT_DB_ALIAS]
+
+    # Avoid databases which have been failing. This is controlled by the
+    # READWRITE_CIRCUIT_BREAKER_FAILURES setting. If they are all failing,
+    # then use the primary database instead.
+    if config.CIRCUIT_BREAKER_FAILURES:
+        db_aliases = circuit_breakers.filter(db_aliases) or [DEFAULT_DB_ALIAS]
+
+    if len(db_aliases) == 1:
+        return db_aliases[0], False
+    elif db_aliases:
+        alias = balancer.choose(db_aliases)
+        balancer.started(alias)
+        return alias, True
+    else:
+        # No databases have been specified,
+        # so use the default database connection.
+        return DEFAULT_DB_ALIAS, False
+
+
+def get_intended_databases(intent):
+    """
+    Returns the databases for an intent, which is 'read' for the read-only
+    databases, 'write' for the default database, or a database alias.
+
+    """
+    if intent == 'read':
+        return config.READ_ONLY_DATABASES or [DEFAULT_DB_ALIAS]
+    elif intent == 'write':
+        return [DEFAULT_DB_ALIAS]
+    elif intent in connections.databases:
+        return [intent]
+    else:
+        raise ValueError('Unknown database or routing intent: %r' % intent)
+
+
+class routing(object):
+    """
+    Context manager and decorator for choosing a database outside of
+    requests. It takes one or more intents, which can be 'read', 'write'
+    or database aliases, and chooses a database for them in the same way
+    as MultiDBMiddleware: using the load balancer, and taking read-only
+    mode, replication lag and circuit breakers into account.
+
+        with routing('read'):
+            generate_report()
+
+        @routing('write')
+        def import_accounts():
+            ...
+
+    Like MultiDBTransactionMiddleware, it creates a transaction when using
+    a writeable database. This is committed when the block exits, or rolled
+    back if it raises an exception. Pass transactional=False to disable it.
+
+    """
+
+    def __init__(self, *intents, **kwargs):
+        self.intents = intents or ('read',)
+        self.transactional = kwargs.pop('transactional', True)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments: %s' % ', '.join(kwargs))
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with routing(*self.intents, **{'transactional': self.transactional}):
+                return func(*args, **kwargs)
+        return wrapped
+
+    def __enter__(self):
+
+        db_aliases = []
+        for intent in self.intents:
+            for alias in get_intended_databases(intent):
+                if alias not in db_aliases:
+                    db_aliases.append(alias)
+
+        self.alias, self.balanced = choose_database(db_aliases)
+        self.old_alias = connection_state.alias
+        connection_state.alias = self.alias
+
+        self.managed = self.transactional and self.alias not in config.READ_ONLY_DATABASES_SET
+        if self.managed:
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+
+        return self.alias
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.managed:
+                try:
+                    if transaction.is_dirty():
+                        if exc_type is None:
+                            transaction.commit()
+                        else:
+                            transaction.rollback()
+                finally:
+                    transaction.leave_transaction_management()
+        finally:
+            connection_state.alias = self.old_alias
+            if self.balanced:
+                balancer.finished(self.alias)
@@ -1,6 +1,5 @@
 import collections
 import random
-import re
 
 from django.conf import settings
 from django.db import DEFAULT_DB_ALIAS
@@ -14,17 +13,6 @@ def _build_mappings():
     return result
 
 
-def _build_paths():
-    result = {}
-    for db_alias, options in settings.DATABASES.items():
-        paths = options.get('HTTP_PATHS')
-        if paths:
-            any_path = '|'.join(re.escape(path) for path in paths)
-            regex = re.compile(r'^(%s)' % any_path)
-            result[db_alias] = regex
-    return result
-
-
 def _get_read_only_databases():
     result = []
     for db_alias, options in settings.DATABASES.items():
@@ -35,6 +23,55 @@ def _get_read_only_databases():
     return result
 
 
+def _get_max_lag():
+    result = {}
+    for db_alias, options in settings.DATABASES.items():
+        max_lag = options.get('MAX_LAG')
+        if max_lag is not None:
+            result[db_alias] = max_lag
+    return result
+
+
+def _get_weights():
+    result = {}
+    for db_alias, options in settings.DATABASES.items():
+        result[db_alias] = options.get('WEIGHT', 1)
+    return result
+
+
+def _get_hedged_databases():
+    result = []
+    for db_alias, options in settings.DATABASES.items():
+        if options.get('HEDGE_READS'):
+            result.append(db_alias)
+    return result
+
+
+def _get_conn_max_ages():
+    result = {}
+    for db_alias, options in settings.DATABASES.items():
+        max_age = options.get('CONN_MAX_AGE', 0)
+        if max_age != 0:
+            result[db_alias] = max_age
+    return result
+
+
+def _get_pin_ttls():
+    result = {}
+    for db_alias, options in settings.DATABASES.items():
+        result[db_alias] = options.get('PIN_TTL', PIN_TTL)
+    return result
+
+
+def _build_path_prefixes():
+    result = {}
+    for db_alias, options in settings.DATABASES.items():
+        paths = options.get('HTTP_PATHS')
+        if paths:
+            result[db_alias] = list(paths)
+    return result
+
+
 # Determine the HTTP method to database alias mappings.
 # It will be in the format {http_method1: [alias1, alias2]}
 DATABASE_MAPPINGS = _build_mappings()
@@ -45,11 +82,177 @@ DATABASE_MAPPINGS = _build_mappings()
 FALLBACK_DATABASE = random.choice(DATABASE_MAPPINGS.get(None) or [DEFAULT_DB_ALIAS])
 
 
-# Determine which paths should be excluded from each database.
-# For example, the /admin/ URLs should not really be read-only.
-DATABASE_PATHS = _build_paths()
+# Determine which paths should be excluded from each database, as prefixes
+# matched by django_readwrite.paths.PathRouter. For example, the /admin/ URLs
+# should not really be read-only.
+DATABASE_PATH_PREFIXES = _build_path_prefixes()
+
+
+# The number of request paths to remember the matching databases for.
+PATH_CACHE_SIZE = getattr(settings, 'READWRITE_PATH_CACHE_SIZE', 10000)
 
 
 # Determine which databases are for read-only purposes.
 READ_ONLY_DATABASES = _get_read_only_databases()
 READ_ONLY_DATABASES_SET = set(READ_ONLY_DATABASES)
+
+
+# Determine the maximum replication lag (in seconds) allowed for each
+# database before it stops being chosen. It will be in the format
+# {alias1: max_lag}, and only contains databases with MAX_LAG defined.
+MAX_LAG = _get_max_lag()
+
+
+# How often (in seconds) the replication lag of those databases is checked.
+LAG_CHECK_INTERVAL = getattr(settings, 'READWRITE_LAG_CHECK_INTERVAL', 5)
+
+
+# Determine the relative weight of each database for load balancing.
+# It will be in the format {alias1: weight}, defaulting to 1.
+WEIGHTS = _get_weights()
+
+
+# The load balancer used to choose between multiple databases,
+# and any keyword arguments to create it with.
+BALANCER = getattr(settings, 'READWRITE_BALANCER', 'django_readwrite.balancers.RandomBalancer')
+BALANCER_OPTIONS = getattr(settings, 'READWRITE_BALANCER_OPTIONS', {})
+
+
+# The number of consecutive database errors which will stop a database from
+# being chosen, and how long (in seconds) to wait before probing it again.
+# Leaving the number of errors as None disables this.
+CIRCUIT_BREAKER_FAILURES = getattr(settings, 'READWRITE_CIRCUIT_BREAKER_FAILURES', None)
+CIRCUIT_BREAKER_TIMEOUT = getattr(settings, 'READWRITE_CIRCUIT_BREAKER_TIMEOUT', 30)
+
+
+# Whether clients should be pinned to the database they wrote to, so that
+# they read their own writes instead of reading from a lagging replica.
+# This can be 'cookie' (a signed cookie) or 'session' (a session key),
+# or None to disable it. The pin lasts for the PIN_TTL option of the
+# database that was written to, in seconds.
+PIN_AFTER_WRITE = getattr(settings, 'READWRITE_PIN_AFTER_WRITE', None)
+PIN_COOKIE_NAME = getattr(settings, 'READWRITE_PIN_COOKIE_NAME', 'readwrite_pin')
+PIN_TTL = getattr(settings, 'READWRITE_PIN_TTL', 5)
+PIN_TTLS = _get_pin_ttls()
+
+
+# Where per-request state is stored: 'thread', 'greenlet', or 'auto' to use
+# 'greenlet' when gevent or eventlet has monkey-patched the thread module.
+# See django_readwrite.local for details.
+LOCAL_BACKEND = getattr(settings, 'READWRITE_LOCAL', 'auto')
+
+
+# The fraction of requests (from 0 to 1) to collect query statistics for,
+# and whether to add them to the response as a Server-Timing header.
+# They are also sent as the request_query_stats signal.
+PROFILE_SAMPLE_RATE = getattr(settings, 'READWRITE_PROFILE_SAMPLE_RATE', 0)
+PROFILE_SERVER_TIMING = getattr(settings, 'READWRITE_PROFILE_SERVER_TIMING', True)
+
+
+# The file to write slow query statistics to, or None to disable them.
+# Queries slower than the threshold (in seconds) have their parameters
+# sampled, and a sample rate below 1 only records that fraction of queries.
+# The statistics are written every flush interval (in seconds), to a file
+# which rotates once it reaches the maximum size.
+SLOW_QUERY_LOG = getattr(settings, 'READWRITE_SLOW_QUERY_LOG', None)
+SLOW_QUERY_THRESHOLD = getattr(settings, 'READWRITE_SLOW_QUERY_THRESHOLD', 0.1)
+SLOW_QUERY_SAMPLE_RATE = getattr(settings, 'READWRITE_SLOW_QUERY_SAMPLE_RATE', 1)
+SLOW_QUERY_TABLE_SIZE = getattr(settings, 'READWRITE_SLOW_QUERY_TABLE_SIZE', 1000)
+SLOW_QUERY_FLUSH_INTERVAL = getattr(settings, 'READWRITE_SLOW_QUERY_FLUSH_INTERVAL', 60)
+SLOW_QUERY_LOG_MAX_BYTES = getattr(settings, 'READWRITE_SLOW_QUERY_LOG_MAX_BYTES', 10 * 1024 * 1024)
+SLOW_QUERY_LOG_BACKUPS = getattr(settings, 'READWRITE_SLOW_QUERY_LOG_BACKUPS', 5)
+
+
+# Determine which databases keep their connections open between requests,
+# and for how long (in seconds, or None for no limit). It will be in the
+# format {alias1: max_age}, and only contains databases with CONN_MAX_AGE
+# defined as something other than 0.
+CONN_MAX_AGES = _get_conn_max_ages()
+
+# How long (in seconds) a kept connection can be idle between requests
+# before it is checked with a query at the start of the next one.
+CONN_HEALTH_CHECK_INTERVAL = getattr(settings, 'READWRITE_CONN_HEALTH_CHECK_INTERVAL', 30)
+
+
+# Whether to cache the results of SELECT queries on read-only databases.
+# Results are cached in each process for the timeout (in seconds), unless
+# a write to one of their tables is seen first. Results with more than the
+# maximum number of rows are not cached, and the cache holds at most the
+# given number of results. Enabling the shared option also stores results
+# in Django's cache backend, so they can be shared between processes, and
+# keeps table versions there so writes invalidate them in every process
+# (after up to the version delay, in seconds).
+RESULT_CACHE = getattr(settings, 'READWRITE_RESULT_CACHE', False)
+RESULT_CACHE_TIMEOUT = getattr(settings, 'READWRITE_RESULT_CACHE_TIMEOUT', 60)
+RESULT_CACHE_MAX_ROWS = getattr(settings, 'READWRITE_RESULT_CACHE_MAX_ROWS', 1000)
+RESULT_CACHE_SIZE = getattr(settings, 'READWRITE_RESULT_CACHE_SIZE', 1000)
+RESULT_CACHE_SHARED = getattr(settings, 'READWRITE_RESULT_CACHE_SHARED', False)
+RESULT_CACHE_VERSION_DELAY = getattr(settings, 'READWRITE_RESULT_CACHE_VERSION_DELAY', 1)
+
+
+# Whether requests which use a writeable database should send their SELECT
+# queries to one of the read-only databases, until they write something,
+# save a model, enter a transaction or run a locking read. Clients who are
+# pinned after writing (see READWRITE_PIN_AFTER_WRITE) don't have their
+# reads offloaded. Other reads which decide what to write, such as the
+# related objects collected by Model.delete() or a view's own checks for
+# existing rows, can still see a lagging replica, so only enable this where
+# that is acceptable.
+OFFLOAD_READS = getattr(settings, 'READWRITE_OFFLOAD_READS', False)
+
+
+# Whether MultiDBTransactionMiddleware should wait for the first write (or
+# transaction entered by the view) before entering transaction management,
+# so that requests which never write skip it altogether. Committing, rolling
+# back or queueing pre-commit and post-commit functions also start it.
+LAZY_TRANSACTIONS = getattr(settings, 'READWRITE_LAZY_TRANSACTIONS', False)
+
+
+# Whether to record which views write to the database, and the queries
+# they run on each database, for the readwrite_advisor command. The table
+# holds at most the given number of views, and is shared with the command
+# through Django's cache backend every flush interval (in seconds).
+ROUTING_ADVISOR = getattr(settings, 'READWRITE_ROUTING_ADVISOR', False)
+ROUTING_ADVISOR_TABLE_SIZE = getattr(settings, 'READWRITE_ROUTING_ADVISOR_TABLE_SIZE', 1000)
+ROUTING_ADVISOR_FLUSH_INTERVAL = getattr(settings, 'READWRITE_ROUTING_ADVISOR_FLUSH_INTERVAL', 60)
+
+
+# The number of times a query (by SQL fingerprint) can run in one request.
+# Running it more often is reported as a possible N+1 query pattern. None
+# disables this. Strict mode raises an NPlusOneError at the end of the request
+# instead, for use in tests.
+NPLUSONE_THRESHOLD = getattr(settings, 'READWRITE_NPLUSONE_THRESHOLD', None)
+NPLUSONE_STRICT = getattr(settings, 'READWRITE_NPLUSONE_STRICT', False)
+
+
+# The number of threads for running functions with parallel(), and how long
+# (in seconds) the connections they use are kept open while idle.
+PARALLEL_WORKERS = getattr(settings, 'READWRITE_PARALLEL_WORKERS', 4)
+PARALLEL_IDLE_TIMEOUT = getattr(settings, 'READWRITE_PARALLEL_IDLE_TIMEOUT', 60)
+
+
+# Determine which read-only databases have their reads hedged.
+HEDGED_DATABASES = _get_hedged_databases()
+
+# Settings for hedging reads on databases with the HEDGE_READS option. A
+# query which takes longer than the given percentile of recent query times
+# (but at least the minimum delay, in seconds) is also sent to another
+# read-only database, and the first answer is used. The budget is the
+# fraction of queries which can be hedged, and the queries are run by the
+# given number of threads.
+HEDGE_PERCENTILE = getattr(settings, 'READWRITE_HEDGE_PERCENTILE', 95)
+HEDGE_MIN_DELAY = getattr(settings, 'READWRITE_HEDGE_MIN_DELAY', 0.01)
+HEDGE_BUDGET = getattr(settings, 'READWRITE_HEDGE_BUDGET', 0.05)
+HEDGE_WORKERS = getattr(settings, 'READWRITE_HEDGE_WORKERS', 16)
+
+
+# Settings for running post-commit functions queued with background=True.
+# They are run by the given number of threads, with at most the given
+# number waiting for a thread. When that many are waiting, more functions
+# are either run straight away in the committing thread ('inline') or
+# logged and discarded ('drop'). When the process exits, it waits for up to
+# the drain timeout (in seconds) for the waiting functions to finish.
+POST_COMMIT_WORKERS = getattr(settings, 'READWRITE_POST_COMMIT_WORKERS', 4)
+POST_COMMIT_QUEUE_SIZE = getattr(settings, 'READWRITE_POST_COMMIT_QUEUE_SIZE', 1000)
+POST_COMMIT_QUEUE_FULL = getattr(settings, 'READWRITE_POST_COMMIT_QUEUE_FULL', 'inline')
+POST_COMMIT_DRAIN_TIMEOUT = getattr(settings, 'READWRITE_POST_COMMIT_DRAIN_TIMEOUT', 10)
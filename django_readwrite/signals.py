@@ -1,52 +1,163 @@
-try:
-    from threading import local
-except ImportError:
-    from django.utils._threading_local import local
+import atexit
+import functools
+import logging
 
+from Queue import Full
+
+from django.db import DEFAULT_DB_ALIAS
 from django.dispatch import Signal
 from django.utils.datastructures import SortedDict
 
+from django_readwrite import settings as config
+from django_readwrite.local import local
+from django_readwrite.persistent import release_connections
+from django_readwrite.transactions import lazy_transactions
+from django_readwrite.workers import WorkerPool
+
+
+logger = logging.getLogger('django_readwrite.signals')
+
+
+class Batch(object):
+    """
+    The items queued for a batch handler, which is called once with the
+    list of them. With unique, each item is only included once.
+
+    """
+
+    def __init__(self, handler, unique=False, background=False):
+        self.handler = handler
+        self.items = []
+        self.unique = unique
+        self.seen = set()
+        self.background = background
+
+    def __call__(self):
+        if self.background:
+            run_in_background(functools.partial(self.handler, self.items))
+        else:
+            self.handler(self.items)
+
+    def add(self, item):
+        if self.unique:
+            if item in self.seen:
+                return
+            self.seen.add(item)
+        self.items.append(item)
+
+    def extend(self, other):
+        for item in other.items:
+            self.add(item)
+
+
+class FunctionQueue(object):
+    """
+    The functions queued during one transaction, or one savepoint within
+    it, in the order they were queued. Functions with the same key are only
+    kept once, with the latest one replacing the others.
+
+    """
+
+    def __init__(self, sid=None):
+        self.sid = sid
+        self.functions = SortedDict()
+
+    def __iter__(self):
+        for key, value in self.functions.iteritems():
+            if key:
+                yield value
+            else:
+                for item in value:
+                    yield item
+
+    def __len__(self):
+        return len(self.functions)
+
+    def add(self, func, key=None):
+        if key:
+            self.functions[key] = func
+        else:
+            self.functions.setdefault(None, [])
+            self.functions[None].append(func)
+
+    def add_batch_item(self, key, item, handler, unique=False, background=False):
+        batch = self.functions.get(key)
+        if batch is None:
+            batch = self.functions[key] = Batch(handler, unique, background)
+        batch.add(item)
+
+    def merge(self, other):
+        """Adds the functions from a savepoint which was committed."""
+        for key, value in other.functions.iteritems():
+            if key and isinstance(value, Batch) and key in self.functions:
+                self.functions[key].extend(value)
+            elif key:
+                self.functions[key] = value
+            else:
+                self.functions.setdefault(None, [])
+                self.functions[None].extend(value)
+
 
 class FunctionPool(local):
     """
     A function pool that uses thread locals for storage. This is used to
     queue up functions to run once when necessary. This means that each
-    thread has its own pool of messages.
+    thread has its own pool of messages. Greenlet locals are used
+    instead if configured, see django_readwrite.local.
+
+    Functions are queued for the transaction of a database alias, and only
+    run or discarded when that alias is committed or rolled back. Inside a
+    savepoint they are kept separately, and are discarded if the savepoint
+    is rolled back, or kept for the transaction if it is committed.
 
     """
 
+    def get_queues(self, using):
+        """Returns the FunctionQueues of a database, outermost first."""
+        if not hasattr(self, '_thread_data'):
+            self._thread_data = {}
+        queues = self._thread_data.setdefault(using or DEFAULT_DB_ALIAS, [])
+        if not queues:
+            queues.append(FunctionQueue())
+        return queues
+
+    def find_savepoint(self, sid, using):
+        queues = self.get_queues(using)
+        for index in range(len(queues) - 1, 0, -1):
+            if queues[index].sid == sid:
+                return queues, index
+        return queues, None
+
     def __iter__(self):
         """Return all queued functions."""
         if hasattr(self, '_thread_data'):
-            for key, value in self._thread_data.iteritems():
-                if key:
-                    yield value
-                else:
-                    for item in value:
-                        yield item
+            for queues in self._thread_data.values():
+                for queue in queues:
+                    for func in queue:
+                        yield func
 
     def __len__(self):
         if hasattr(self, '_thread_data'):
-            return len(self._thread_data)
+            return sum(len(queue) for queues in self._thread_data.values() for queue in queues)
         else:
             return 0
 
-    def execute(self):
-        """Execute all queued functions."""
+    def execute(self, using=None):
+        """Execute all functions queued for a database."""
 
         # Get all of the queued functions.
-        functions = list(self)
+        functions = [func for queue in self.get_queues(using) for func in queue]
 
         # Ensure the queue is cleared before running any functions.
         # This avoids triggering another post_commit signal, which would
         # execute this again, getting into an infinite loop.
-        self.clear()
+        self.clear(using)
 
         # Run the functions.
         for func in functions:
             func()
 
-    def queue(self, func, key=None):
+    def queue(self, func, key=None, using=None):
         """
         Queues a function to call after the transaction is committed. Use a key
         when you want to ensure that an action won't get triggered multiple
@@ -59,29 +170,117 @@ class FunctionPool(local):
 
         """
 
-        if not hasattr(self, '_thread_data'):
-            self._thread_data = SortedDict()
+        self.get_queues(using)[-1].add(func, key=key)
 
-        if key:
-            self._thread_data[key] = func
-        else:
-            self._thread_data.setdefault(None, [])
-            self._thread_data[None].append(func)
+    def queue_batch_item(self, handler, item, group=None, unique=False, background=False, using=None):
+        """
+        Queues an item for a batch handler, which is called once with the
+        list of items queued for it (and the same group).
+
+        """
+        key = ('batch', handler, group)
+        self.get_queues(using)[-1].add_batch_item(key, item, handler, unique, background)
+
+    def savepoint(self, sid, using=None):
+        """Starts keeping functions for a new savepoint."""
+        self.get_queues(using).append(FunctionQueue(sid))
+
+    def savepoint_commit(self, sid, using=None):
+        """Keeps the functions from a savepoint (and any inside it) for the transaction."""
+        queues, index = self.find_savepoint(sid, using)
+        if index is not None:
+            for queue in queues[index:]:
+                queues[index - 1].merge(queue)
+            del queues[index:]
+
+    def savepoint_rollback(self, sid, using=None):
+        """
+        Discards the functions from a savepoint (and any inside it). Anything
+        queued afterwards is kept for the enclosing transaction or savepoint.
 
-    def clear(self):
+        """
+        queues, index = self.find_savepoint(sid, using)
+        if index is not None:
+            del queues[index:]
+
+    def clear(self, using=None):
         if hasattr(self, '_thread_data'):
-            del self._thread_data
+            self._thread_data.pop(using or DEFAULT_DB_ALIAS, None)
 
 
 pre_commit = Signal()
 post_commit = Signal()
 post_rollback = Signal()
 
+# Sent with alias, old_state and new_state arguments
+# when a database's circuit breaker changes state.
+circuit_breaker_changed = Signal()
+
+# Sent with request and stats (a QueryStats instance) arguments at the end
+# of each request sampled by the query profiler.
+request_query_stats = Signal()
+
+# Sent with request and findings (a list of Finding instances) arguments at
+# the end of each request which repeated a query too many times.
+nplusone_detected = Signal()
+
+# Sent with func and error arguments when a post-commit function
+# which was run in the background raised an exception.
+post_commit_failed = Signal()
+
 pre_commit_function_pool = FunctionPool()
 post_commit_function_pool = FunctionPool()
 
+background_pool = WorkerPool(
+    'readwrite-post-commit',
+    config.POST_COMMIT_WORKERS,
+    max_queue=config.POST_COMMIT_QUEUE_SIZE,
+)
+
+
+def call_reporting_errors(func):
+    """Calls a background post-commit function, logging and signalling any error."""
+    try:
+        func()
+    except Exception as error:
+        logger.exception('Error in background post-commit function %r.' % func)
+        post_commit_failed.send(sender=None, func=func, error=error)
+
+
+def call_in_background(func):
+    """Calls a post-commit function in a worker thread, reporting any error."""
+    try:
+        call_reporting_errors(func)
+    finally:
+        # Don't leave the thread's connections in a transaction.
+        release_connections()
+
+
+def run_in_background(func):
+    """
+    Hands a function to the background worker threads. If too many are
+    already waiting, it is run straight away or dropped, according to
+    READWRITE_POST_COMMIT_QUEUE_FULL.
 
-def queue_pre_commit(func, key=None):
+    """
+    try:
+        background_pool.submit(call_in_background, func)
+    except Full:
+        if config.POST_COMMIT_QUEUE_FULL == 'drop':
+            logger.warning('Dropped background post-commit function %r, the queue is full.' % func)
+        else:
+            call_reporting_errors(func)
+
+
+def drain_background():
+    """Waits for the background post-commit functions when the process exits."""
+    background_pool.drain(config.POST_COMMIT_DRAIN_TIMEOUT)
+
+
+atexit.register(drain_background)
+
+
+def queue_pre_commit(func, key=None, using=None):
     """
     Queues a function to call before the transaction is committed. Use a
     key when you want to ensure that an action won't get triggered multiple
@@ -92,12 +291,16 @@ def queue_pre_commit(func, key=None):
     transaction is committed. In this case, you could use the key
     'validate_account.123' to ensure it only runs once.
 
+    Functions are queued for the transaction of the default database, or
+    the one given with using.
+
     """
 
-    pre_commit_function_pool.queue(func, key=key)
+    lazy_transactions.start_pending(using)
+    pre_commit_function_pool.queue(func, key=key, using=using)
 
 
-def queue_post_commit(func, key=None):
+def queue_post_commit(func, key=None, background=False, using=None):
     """
     Queues a function to call after the transaction is committed. Use a key
     when you want to ensure that an action won't get triggered multiple
@@ -108,22 +311,65 @@ def queue_post_commit(func, key=None):
     transaction is committed. In this case, you could use the key
     'sync_account.123' to ensure it only runs once.
 
+    Functions are queued for the transaction of the default database, or
+    the one given with using.
+
+    With background, the function is run by a worker thread instead of the
+    thread committing the transaction, so slow work doesn't hold up the
+    response. Errors are logged and sent with the post_commit_failed signal.
+
+    """
+
+    lazy_transactions.start_pending(using)
+    if background:
+        func = functools.partial(run_in_background, func)
+    post_commit_function_pool.queue(func, key=key, using=using)
+
+
+def queue_post_commit_batch(handler, item, group=None, unique=False, background=False, using=None):
     """
+    Queues an item for a handler which is called with a list of items after
+    the transaction is committed. The handler is called once for each group,
+    with the items queued for that group, in order. With unique, an item
+    which is queued several times is only included once.
+
+    Eg. instead of queueing (lambda: sync_account(n)) for 500 accounts, you
+    could queue each account number for sync_accounts, which is then called
+    with the list of all 500 and can sync them in one go.
+
+    """
+
+    lazy_transactions.start_pending(using)
+    post_commit_function_pool.queue_batch_item(handler, item, group=group, unique=unique,
+                                               background=background, using=using)
+
+
+def send_pre_commit(using=None):
+    pre_commit.send(sender=None, using=using)
+    pre_commit_function_pool.execute(using)
+
+
+def send_post_commit(using=None):
+    post_commit.send(sender=None, using=using)
+    post_commit_function_pool.execute(using)
+
 
-    post_commit_function_pool.queue(func, key=key)
+def send_post_rollback(using=None):
+    post_rollback.send(sender=None, using=using)
+    pre_commit_function_pool.clear(using)
+    post_commit_function_pool.clear(using)
 
 
-def send_pre_commit():
-    pre_commit.send(sender=None)
-    pre_commit_function_pool.execute()
+def send_savepoint(sid, using=None):
+    pre_commit_function_pool.savepoint(sid, using)
+    post_commit_function_pool.savepoint(sid, using)
 
 
-def send_post_commit():
-    post_commit.send(sender=None)
-    post_commit_function_pool.execute()
+def send_savepoint_commit(sid, using=None):
+    pre_commit_function_pool.savepoint_commit(sid, using)
+    post_commit_function_pool.savepoint_commit(sid, using)
 
 
-def send_post_rollback():
-    post_rollback.send(sender=None)
-    pre_commit_function_pool.clear()
-    post_commit_function_pool.clear()
+def send_savepoint_rollback(sid, using=None):
+    pre_commit_function_pool.savepoint_rollback(sid, using)
+    post_commit_function_pool.savepoint_rollback(sid, using)
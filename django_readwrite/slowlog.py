@@ -0,0 +1,163 @@
+"""
+A slow query log, for finding the statements which put the most load on
+each database. It is enabled by the READWRITE_SLOW_QUERY_LOG setting.
+
+Queries are grouped by database and SQL fingerprint (see
+django_readwrite.fingerprints) in a bounded in-process table, which counts
+them and their total, maximum and 95th percentile times. Queries slower
+than READWRITE_SLOW_QUERY_THRESHOLD also have a few samples of their
+parameters kept. Every READWRITE_SLOW_QUERY_FLUSH_INTERVAL seconds, the
+table is written to the log file as one JSON object per line, sorted by
+total time, and then cleared.
+
+"""
+
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+
+from django.utils import simplejson
+
+from django_readwrite import settings as config
+from django_readwrite.cursors import query_observers
+from django_readwrite.fingerprints import fingerprint
+from django_readwrite.utils import LRUCache
+
+
+class QueryGroup(object):
+    """Statistics for the queries with one fingerprint on one database."""
+
+    # The number of query times kept for estimating the 95th percentile,
+    # and the number of parameter samples kept for slow queries.
+    max_times = 100
+    max_samples = 3
+
+    def __init__(self, alias, fingerprint):
+        self.alias = alias
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.times = []
+        self.samples = []
+
+    def add(self, elapsed, params, threshold):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        # Keep a random sample of the query times (reservoir sampling).
+        if len(self.times) < self.max_times:
+            self.times.append(elapsed)
+        else:
+            index = random.randint(0, self.count - 1)
+            if index < self.max_times:
+                self.times[index] = elapsed
+        if elapsed >= threshold and len(self.samples) < self.max_samples:
+            self.samples.append({
+                'time': elapsed,
+                'params': repr(params)[:1000],
+            })
+
+    def percentile(self, percent):
+        times = sorted(self.times)
+        return times and times[int(round((len(times) - 1) * percent / 100.0))] or 0.0
+
+    def as_dict(self):
+        return {
+            'alias': self.alias,
+            'fingerprint': self.fingerprint,
+            'count': self.count,
+            'total': self.total,
+            'mean': self.count and self.total / self.count,
+            'p95': self.percentile(95),
+            'max': self.max,
+            'samples': self.samples,
+        }
+
+
+class SlowQueryLog(object):
+    """A query observer which records query statistics by fingerprint."""
+
+    def __init__(self, filename, threshold, sample_rate, table_size, flush_interval, max_bytes, backups):
+        self.filename = filename
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.table_size = table_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.table = LRUCache(table_size)
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.logger = None
+
+    def query_executed(self, db, sql, params, read_sql, elapsed):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        key = (db.alias, fingerprint(sql))
+        group = self.table.get(key)
+        if group is None:
+            group = QueryGroup(*key)
+            self.table.set(key, group)
+        group.add(elapsed, params, self.threshold)
+        if time.time() - self.started >= self.flush_interval:
+            self.flush()
+
+    def query_failed(self, db, sql, params, error):
+        pass
+
+    def get_logger(self):
+        if self.logger is None:
+            handler = logging.handlers.RotatingFileHandler(
+                self.filename,
+                maxBytes=self.max_bytes,
+                backupCount=self.backups,
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger = logging.getLogger('django_readwrite.slowlog')
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+        return self.logger
+
+    def flush(self):
+        """Writes the statistics to the log file and starts a new table."""
+
+        with self.lock:
+            if time.time() - self.started < self.flush_interval:
+                # Another thread has just flushed it.
+                return
+            table = self.table
+            started = self.started
+            self.table = LRUCache(self.table_size)
+            self.started = time.time()
+
+        groups = table.values()
+        groups.sort(key=lambda group: group.total, reverse=True)
+
+        logger = self.get_logger()
+        for group in groups:
+            line = group.as_dict()
+            line['start'] = started
+            line['end'] = self.started
+            line['pid'] = os.getpid()
+            line['sample_rate'] = self.sample_rate
+            logger.info(simplejson.dumps(line))
+
+
+slow_query_log = SlowQueryLog(
+    filename=config.SLOW_QUERY_LOG,
+    threshold=config.SLOW_QUERY_THRESHOLD,
+    sample_rate=config.SLOW_QUERY_SAMPLE_RATE,
+    table_size=config.SLOW_QUERY_TABLE_SIZE,
+    flush_interval=config.SLOW_QUERY_FLUSH_INTERVAL,
+    max_bytes=config.SLOW_QUERY_LOG_MAX_BYTES,
+    backups=config.SLOW_QUERY_LOG_BACKUPS,
+)
+
+if config.SLOW_QUERY_LOG:
+    query_observers.append(slow_query_log)
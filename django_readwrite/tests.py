@@ -1,8 +1,49 @@
+import hashlib
+import hmac
+import os
+import sys
+import threading
+import time
+from StringIO import StringIO
+
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection, connections, transaction, DatabaseError, IntegrityError, DEFAULT_DB_ALIAS
+from django.db.models.signals import pre_save
 from django.forms.models import modelform_factory
-from django.test import TestCase
+from django.http import HttpRequest, HttpResponse
+from django.test import TestCase, TransactionTestCase
 
+from django_readwrite import settings as config
+from django_readwrite import signals
+from django_readwrite.advisor import clear_shared_table, get_shared_table, RoutingAdvisor, CLEARED_KEY
+from django_readwrite.balancers import EWMABalancer, LeastOutstandingBalancer, WeightedBalancer
+from django_readwrite.connection import connection_state, request_state
+from django_readwrite.cursors import database_policies, get_policy, query_observers, RestrictedCursorWrapper, RestrictedDatabaseError, stop_offloading
+from django_readwrite.decorators import post_commit, pre_commit, use_primary, use_replica
+from django_readwrite.fingerprints import normalize
+from django_readwrite.health import CircuitBreakers, CLOSED, OPEN
+from django_readwrite.hedging import HedgedReads
+from django_readwrite.lag import ReplicationLagMonitor
+from django_readwrite.local import get_local_class, reset_local
+from django_readwrite.middleware import MultiDBMiddleware, MultiDBTransactionMiddleware
+from django_readwrite.nplusone import NPlusOneDetector, NPlusOneError
+from django_readwrite.parallel import parallel
+from django_readwrite.paths import PathRouter
+from django_readwrite.persistent import check_connections, connection_errors, connection_opened, release_connections
+from django_readwrite.pinning import get_pin, set_pin, sign
+from django_readwrite.pool import PoolTimeoutError, TemporaryConnectionPool
+from django_readwrite.profiling import QueryProfiler
 from django_readwrite.readonly import read_only_mode, ReadOnlyError
+from django_readwrite.resultcache import parse_read_tables, parse_write_tables, result_cache
+from django_readwrite.routing import routing
+from django_readwrite.signals import FunctionPool
+from django_readwrite.transactions import lazy_transactions
+from django_readwrite.utils import LRUCache
+from django_readwrite.workers import WorkerPool
 
 from apncore.util.unittest import RollbackTestCase
 
@@ -45,3 +86,1137 @@ class ReadOnlyTestCase(TestCase):
 
         # The read-only error message should have been added to the form.
         self.assertTrue(ReadOnlyError.message in form._errors.get('__all__', {}))
+
+
+class LocalTestCase(TestCase):
+
+    def test_thread(self):
+        storage = get_local_class('thread')()
+        storage.value = 'main'
+        seen = []
+
+        def other_thread():
+            seen.append(getattr(storage, 'value', None))
+            storage.value = 'other'
+            reset_local(storage)
+            seen.append(getattr(storage, 'value', None))
+
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [None, None])
+        self.assertEqual(storage.value, 'main')
+
+    def test_unknown(self):
+        self.assertRaises(ImproperlyConfigured, get_local_class, 'contextvars')
+
+
+class ConnectionStateTestCase(TestCase):
+
+    def setUp(self):
+        self.alias = config.READ_ONLY_DATABASES[0]
+        with connection_state.force(None):
+            self.default = connections[DEFAULT_DB_ALIAS]
+            self.replica = connections[self.alias]
+
+    def tearDown(self):
+        del connection_state.alias
+
+    def test_bind(self):
+        connection_state.alias = self.alias
+        self.assertTrue(connection_state.bind() is self.replica)
+        self.assertTrue(connection_state.connection is self.replica)
+        self.assertEqual(self.default.alias, self.alias)
+
+    def test_force(self):
+        connection_state.alias = self.alias
+        connection_state.bind()
+        with connection_state.force(None):
+            self.assertEqual(self.default.alias, DEFAULT_DB_ALIAS)
+            self.assertEqual(self.replica.alias, self.alias)
+            with connection_state.force(DEFAULT_DB_ALIAS):
+                self.assertEqual(self.replica.alias, DEFAULT_DB_ALIAS)
+            self.assertEqual(self.replica.alias, self.alias)
+        self.assertEqual(self.default.alias, self.alias)
+        self.assertTrue(connection_state.connection is self.replica)
+
+    def test_alias_changed(self):
+        connection_state.alias = self.alias
+        self.assertEqual(connection.alias, self.alias)
+        connection_state.alias = DEFAULT_DB_ALIAS
+        self.assertEqual(connection.alias, DEFAULT_DB_ALIAS)
+        self.assertTrue(connection_state.connection is self.default)
+        del connection_state.alias
+        self.assertEqual(self.replica.alias, config.FALLBACK_DATABASE)
+
+    def test_threads(self):
+        connection_state.alias = self.alias
+        connection_state.bind()
+        aliases = []
+        thread = threading.Thread(target=lambda: aliases.append(self.replica.alias))
+        thread.start()
+        thread.join()
+        self.assertEqual(aliases, [config.FALLBACK_DATABASE])
+
+
+class DatabasePolicyTestCase(TestCase):
+
+    def setUp(self):
+        connections.databases['policy_test'] = {'ENGINE': 'django.db.backends.dummy', 'READ_ONLY_WARNING': True}
+
+    def tearDown(self):
+        del connections.databases['policy_test']
+        database_policies.pop('policy_test', None)
+
+    def test_policies(self):
+        self.assertFalse(get_policy(DEFAULT_DB_ALIAS).read_only)
+        self.assertFalse(get_policy(DEFAULT_DB_ALIAS).warning)
+        self.assertTrue(get_policy(config.READ_ONLY_DATABASES[0]).read_only)
+        self.assertFalse(get_policy(config.READ_ONLY_DATABASES[0]).warning)
+        self.assertEqual(get_policy('policy_test'), (True, True, False, False))
+        self.assertTrue(get_policy('policy_test') is database_policies['policy_test'])
+
+    def test_is_read_sql(self):
+        with connection_state.force(None):
+            wrapper = RestrictedCursorWrapper(None, connections[DEFAULT_DB_ALIAS])
+        expected = [
+            ('SELECT 1', True),
+            ('  SELECT 1', True),
+            ('\nSELECT\n1', True),
+            ('select 1', True),
+            ('SELECT * FROM t1 FOR UPDATE', True),
+            ('SAVEPOINT s1', True),
+            ('/* comment */ SELECT 1', False),
+            ('SELECTION', False),
+            ('UPDATE t1 SET a = 1', False),
+        ]
+        for sql, read_sql in expected:
+            self.assertEqual(wrapper.is_read_sql(sql), read_sql, sql)
+            self.assertEqual(wrapper.is_read_sql(sql), bool(wrapper.READ_SQL_RE.match(sql)), sql)
+
+
+class RecordingCursor(object):
+    """A stand-in for a database cursor which records the queries it runs."""
+
+    def __init__(self):
+        self.queries = []
+
+    def executemany(self, sql, param_list):
+        self.queries.append((sql, list(param_list)))
+
+    def callproc(self, procname, params=()):
+        self.queries.append((procname, params))
+
+
+class RestrictedCursorTestCase(TestCase):
+
+    def setUp(self):
+        self.cursor = RecordingCursor()
+        with connection_state.force(None):
+            self.wrapper = RestrictedCursorWrapper(self.cursor, connections[config.READ_ONLY_DATABASES[0]])
+
+    def test_executemany_write(self):
+        self.assertRaises(RestrictedDatabaseError, self.wrapper.executemany,
+                          'INSERT INTO django_content_type (name) VALUES (%s)', [('a',), ('b',)])
+        self.assertEqual(self.cursor.queries, [])
+
+    def test_callproc(self):
+        self.assertRaises(RestrictedDatabaseError, self.wrapper.callproc, 'refresh_totals')
+        self.assertEqual(self.cursor.queries, [])
+
+    def test_read_only_mode(self):
+        with connection_state.force(None):
+            wrapper = RestrictedCursorWrapper(self.cursor, connections[DEFAULT_DB_ALIAS])
+        read_only_mode.enable()
+        try:
+            self.assertRaises(ReadOnlyError, wrapper.executemany, 'DELETE FROM django_content_type WHERE id = %s', [(1,)])
+            self.assertRaises(ReadOnlyError, wrapper.callproc, 'refresh_totals')
+        finally:
+            read_only_mode.disable()
+        self.assertEqual(self.cursor.queries, [])
+
+    def test_executemany_read(self):
+        checked = []
+        is_read_sql = self.wrapper.is_read_sql
+        self.wrapper.is_read_sql = lambda sql: checked.append(sql) or is_read_sql(sql)
+        self.wrapper.executemany('SELECT %s', [(1,), (2,), (3,)])
+        self.assertEqual(checked, ['SELECT %s'])
+        self.assertEqual(self.cursor.queries, [('SELECT %s', [(1,), (2,), (3,)])])
+
+
+class PathRouterTestCase(TestCase):
+
+    def setUp(self):
+        self.router = PathRouter({
+            'default': ['/admin/', '/accounts/'],
+            'other': ['/admin/reports/'],
+        }, cache_size=10)
+
+    def test_match(self):
+        self.assertEqual(self.router.match('/admin/reports/1/'), ('default', 'other'))
+        self.assertEqual(self.router.match('/admin/'), ('default',))
+        self.assertEqual(self.router.match('/accounts/login/'), ('default',))
+        self.assertEqual(self.router.match('/adm'), ())
+        self.assertEqual(self.router.match('/'), ())
+
+    def test_cache(self):
+        self.router.match('/admin/')
+        self.router.match('/admin/')
+        self.assertEqual(self.router.cache.hits, 1)
+        self.assertEqual(self.router.cache.misses, 1)
+
+
+class LRUCacheTestCase(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(10)
+        for number in range(10):
+            cache.set(number, number)
+        # Use the first item so that it is not the least recently used.
+        cache.get(0)
+        cache.set(10, 10)
+        self.assertTrue(0 in cache)
+        self.assertTrue(10 in cache)
+        self.assertFalse(1 in cache)
+        self.assertTrue(len(cache) <= 10)
+
+
+class FingerprintTestCase(TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(
+            normalize('SELECT * FROM "t1" WHERE "id" IN (1, 2, 3) AND "name" = \'it\'\'s\''),
+            'SELECT * FROM "t1" WHERE "id" IN (...) AND "name" = ?',
+        )
+        self.assertEqual(
+            normalize('SELECT * FROM "t1" WHERE "id" IN (%s, %s)\n LIMIT 21'),
+            'SELECT * FROM "t1" WHERE "id" IN (...) LIMIT ?',
+        )
+        self.assertEqual(
+            normalize('INSERT INTO "t1" ("a", "b") VALUES (%s, %s), (%s, %s)'),
+            'INSERT INTO "t1" ("a", "b") VALUES (...)',
+        )
+
+
+class ResultCacheTestCase(TestCase):
+
+    def test_parse_read_tables(self):
+        self.assertEqual(
+            parse_read_tables('SELECT "t1"."id" FROM "t1" INNER JOIN "T2" T3 ON ("t1"."id" = T3."t1_id")'),
+            frozenset(['t1', 't2']),
+        )
+        self.assertEqual(
+            parse_read_tables('SELECT * FROM "public"."t1", t2 AS x WHERE id IN (SELECT id FROM `t3`)'),
+            frozenset(['t1', 't2', 't3']),
+        )
+        self.assertEqual(parse_read_tables('SELECT 1'), frozenset())
+
+    def test_parse_write_tables(self):
+        self.assertEqual(parse_write_tables('UPDATE "t1" SET "name" = %s'), frozenset(['t1']))
+        self.assertEqual(parse_write_tables('INSERT INTO "t1" ("id") VALUES (%s)'), frozenset(['t1']))
+        self.assertEqual(parse_write_tables('DELETE FROM "t1" WHERE "id" IN (%s)'), frozenset(['t1']))
+        self.assertEqual(parse_write_tables('SET NAMES utf8'), frozenset())
+        self.assertEqual(parse_write_tables('MERGE INTO t1 USING t2'), None)
+
+
+class CountingCursor(object):
+    """A stand-in for a database cursor which counts the queries it runs."""
+
+    description = (('id', None, None, None, None, None, None),)
+    rowcount = 2
+    arraysize = 100
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = []
+
+    def execute(self, sql, params=()):
+        self.queries += 1
+        self.rows = [(1,), (2,)]
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self.rows))
+
+
+class CachedResultCursorTestCase(TestCase):
+
+    sql = 'SELECT "readwrite_test"."id" FROM "readwrite_test" WHERE "readwrite_test"."id" > %s'
+
+    def setUp(self):
+        self.result_cache = config.RESULT_CACHE
+        config.RESULT_CACHE = True
+        self.cursor = CountingCursor()
+        with connection_state.force(None):
+            self.reader = RestrictedCursorWrapper(self.cursor, connections[config.READ_ONLY_DATABASES[0]])
+            self.writer = RestrictedCursorWrapper(CountingCursor(), connections[DEFAULT_DB_ALIAS])
+        self.reader.policy = self.reader.policy._replace(cache_results=True)
+
+    def tearDown(self):
+        config.RESULT_CACHE = self.result_cache
+        result_cache.clear()
+
+    def read(self):
+        self.reader.execute(self.sql, (0,))
+        return self.reader.fetchall()
+
+    def test_cached(self):
+        self.assertEqual(self.read(), [(1,), (2,)])
+        self.assertEqual(self.read(), [(1,), (2,)])
+        self.assertEqual(self.cursor.queries, 1)
+
+    def test_invalidated(self):
+        self.read()
+        self.writer.execute('UPDATE "readwrite_test" SET "name" = %s', ('x',))
+        self.assertEqual(self.read(), [(1,), (2,)])
+        self.assertEqual(self.cursor.queries, 2)
+
+        # Writes to other tables don't change it.
+        self.writer.execute('UPDATE "readwrite_other" SET "name" = %s', ('x',))
+        self.read()
+        self.assertEqual(self.cursor.queries, 2)
+
+
+class FunctionPoolTestCase(TestCase):
+
+    def test_savepoints(self):
+        pool = FunctionPool()
+        called = []
+        pool.queue(lambda: called.append('outer'))
+        pool.queue(lambda: called.append('other'), using='other')
+        pool.savepoint('s1')
+        pool.queue(lambda: called.append('committed'))
+        pool.savepoint('s2')
+        pool.queue(lambda: called.append('rolled back'))
+        pool.savepoint_rollback('s2')
+        pool.savepoint_commit('s1')
+        pool.execute()
+        self.assertEqual(called, ['outer', 'committed'])
+        pool.clear('other')
+        self.assertEqual(len(pool), 0)
+
+    def test_batches(self):
+        pool = FunctionPool()
+        called = []
+
+        def handler(items):
+            called.append(items)
+
+        pool.queue_batch_item(handler, 1, unique=True)
+        pool.savepoint('s1')
+        pool.queue_batch_item(handler, 1, unique=True)
+        pool.queue_batch_item(handler, 2, unique=True)
+        pool.savepoint_commit('s1')
+        pool.savepoint('s2')
+        pool.queue_batch_item(handler, 3, unique=True)
+        pool.savepoint_rollback('s2')
+        pool.execute()
+        self.assertEqual(called, [[1, 2]])
+
+
+class SlowCursor(object):
+    """A stand-in for a database cursor which takes a while to answer."""
+
+    description = (('value', None, None, None, None, None, None),)
+    rowcount = 1
+    arraysize = 1
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def execute(self, sql, params=()):
+        time.sleep(self.delay)
+
+    def fetchall(self):
+        return [('slow',)]
+
+
+class HedgingTestCase(TestCase):
+
+    def test_hedge_wins(self):
+        alias = config.READ_ONLY_DATABASES[0]
+        hedger = HedgedReads(percentile=95, min_delay=0.01, budget=1, workers=2)
+        hedger.choose_other = lambda other: alias
+
+        with connection_state.force(None):
+            primary = connections[DEFAULT_DB_ALIAS]
+            primary._cursor()
+            primary_connection = primary.connection
+            connections[alias]._cursor()
+            replica_connection = connections[alias].connection
+
+        with connection_state.force(alias):
+            # The ORM calls the primary's wrapper, which proxies to the replica.
+            wrapper = RestrictedCursorWrapper(SlowCursor(0.5), connections[DEFAULT_DB_ALIAS])
+            hedger.execute(wrapper, "SELECT 'fast'", ())
+            self.assertEqual(wrapper.fetchall(), [('fast',)])
+
+        self.assertEqual(hedger.won, 1)
+        with connection_state.force(None):
+            # Only the replica's connection was left to the slow query.
+            self.assertTrue(primary.connection is primary_connection)
+            self.assertFalse(connections[alias].connection is replica_connection)
+
+    def test_budget(self):
+        alias = config.READ_ONLY_DATABASES[0]
+        hedger = HedgedReads(percentile=95, min_delay=0.05, budget=0.1, workers=2)
+        hedger.choose_other = lambda other: alias
+        hedger.tokens = 0
+
+        with connection_state.force(None):
+            # Every query adds to the budget, not just the slow ones.
+            for number in range(10):
+                wrapper = RestrictedCursorWrapper(SlowCursor(0), connections[alias])
+                hedger.execute(wrapper, 'SELECT 1', ())
+            self.assertEqual(hedger.fired, 0)
+            wrapper = RestrictedCursorWrapper(SlowCursor(0.5), connections[alias])
+            hedger.execute(wrapper, 'SELECT 1', ())
+
+        self.assertEqual(hedger.queries, 11)
+        self.assertEqual(hedger.fired, 1)
+        self.assertEqual(hedger.skipped, 0)
+
+
+class TransactionMiddlewareTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.lazy_transactions = config.LAZY_TRANSACTIONS
+        config.LAZY_TRANSACTIONS = False
+        self.middleware = MultiDBTransactionMiddleware()
+        self.request = HttpRequest()
+        self.request.method = 'POST'
+
+    def tearDown(self):
+        config.LAZY_TRANSACTIONS = self.lazy_transactions
+        request_state.reset()
+        del connection_state.alias
+
+    def test_view_routed_to_replica(self):
+        connection_state.alias = DEFAULT_DB_ALIAS
+        self.middleware.process_request(self.request)
+        self.assertTrue(transaction.is_managed())
+        self.assertEqual(request_state.transaction_alias, DEFAULT_DB_ALIAS)
+
+        # MultiDBMiddleware.process_view routes a @use_replica view.
+        connection_state.alias = config.READ_ONLY_DATABASES[0]
+        self.middleware.process_view(self.request, None, (), {})
+
+        # The primary's transaction was left, and no other was entered.
+        self.assertFalse(transaction.is_managed())
+        self.assertEqual(request_state.transaction_alias, None)
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertFalse(transaction.is_managed())
+
+    def test_lazy_write(self):
+        config.LAZY_TRANSACTIONS = True
+        connection_state.alias = DEFAULT_DB_ALIAS
+        started = lazy_transactions.started
+        self.middleware.process_request(self.request)
+        self.assertTrue(request_state.transaction_pending)
+        self.assertFalse(transaction.is_managed())
+
+        connection.cursor().execute('UPDATE django_content_type SET name = name')
+        self.assertFalse(request_state.transaction_pending)
+        self.assertTrue(transaction.is_managed())
+        self.assertEqual(lazy_transactions.started, started + 1)
+
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertFalse(transaction.is_managed())
+
+    def start_lazy(self):
+        config.LAZY_TRANSACTIONS = True
+        connection_state.alias = DEFAULT_DB_ALIAS
+        self.middleware.process_request(self.request)
+        self.assertTrue(request_state.transaction_pending)
+
+    def test_lazy_transaction_functions(self):
+        for func in (transaction.commit, transaction.rollback, transaction.set_dirty, transaction.savepoint):
+            self.start_lazy()
+            func()
+            self.assertFalse(request_state.transaction_pending)
+            self.assertTrue(transaction.is_managed())
+            self.middleware.process_response(self.request, HttpResponse())
+            self.assertFalse(transaction.is_managed())
+
+    def test_lazy_post_commit(self):
+        called = []
+
+        @post_commit
+        def after():
+            called.append(True)
+
+        self.start_lazy()
+        after()
+        self.assertEqual(called, [])
+        transaction.set_dirty()
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(called, [True])
+
+    def test_lazy_mandate_transaction(self):
+        called = []
+        self.start_lazy()
+        pre_commit(mandate_transaction=True)(lambda: called.append(True))()
+        self.assertTrue(transaction.is_managed())
+        transaction.set_dirty()
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(called, [True])
+
+    def test_lazy_queue(self):
+        called = []
+        self.start_lazy()
+        signals.queue_post_commit(lambda: called.append(True))
+        self.assertTrue(transaction.is_managed())
+        transaction.set_dirty()
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(called, [True])
+
+    def test_lazy_read(self):
+        config.LAZY_TRANSACTIONS = True
+        connection_state.alias = DEFAULT_DB_ALIAS
+        avoided = lazy_transactions.avoided
+        self.middleware.process_request(self.request)
+        connection.cursor().execute('SELECT 1')
+        self.assertFalse(transaction.is_managed())
+
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertFalse(request_state.transaction_pending)
+        self.assertEqual(lazy_transactions.avoided, avoided + 1)
+
+
+class ViewDecoratorTestCase(TestCase):
+
+    def setUp(self):
+        self.middleware = MultiDBMiddleware()
+        self.middleware.view_aliases = {}
+        self.request = HttpRequest()
+
+    def tearDown(self):
+        request_state.reset()
+        del connection_state.alias
+
+    def test_use_replica(self):
+        self.request.method = 'POST'
+        self.middleware.process_request(self.request)
+        self.assertEqual(connection_state.alias, DEFAULT_DB_ALIAS)
+        self.middleware.process_view(self.request, use_replica(lambda request: None), (), {})
+        self.assertTrue(connection_state.alias in config.READ_ONLY_DATABASES_SET)
+
+    def test_use_primary(self):
+        self.request.method = 'GET'
+        self.middleware.process_request(self.request)
+        self.assertTrue(connection_state.alias in config.READ_ONLY_DATABASES_SET)
+        self.middleware.process_view(self.request, use_primary(lambda request: None), (), {})
+        self.assertEqual(connection_state.alias, DEFAULT_DB_ALIAS)
+
+    def test_undecorated(self):
+        self.request.method = 'GET'
+        self.middleware.process_request(self.request)
+        alias = connection_state.alias
+        self.middleware.process_view(self.request, lambda request: None, (), {})
+        self.assertEqual(connection_state.alias, alias)
+
+
+class RoutingTestCase(TransactionTestCase):
+
+    def test_read(self):
+        with routing('read') as alias:
+            self.assertTrue(alias in config.READ_ONLY_DATABASES_SET)
+            self.assertEqual(connection.alias, alias)
+            self.assertFalse(transaction.is_managed())
+        self.assertEqual(connection.alias, DEFAULT_DB_ALIAS)
+
+    def test_write(self):
+        with routing('write') as alias:
+            self.assertEqual(alias, DEFAULT_DB_ALIAS)
+            self.assertTrue(transaction.is_managed())
+        self.assertFalse(transaction.is_managed())
+
+    def test_exception(self):
+        try:
+            with routing('read'):
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertEqual(connection.alias, DEFAULT_DB_ALIAS)
+
+    def test_decorator(self):
+        aliases = []
+        routing('read')(lambda: aliases.append(connection.alias))()
+        self.assertTrue(aliases[0] in config.READ_ONLY_DATABASES_SET)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, routing('nope').__enter__)
+
+
+class TemporaryConnectionPoolTestCase(TestCase):
+
+    def setUp(self):
+        self.pool = TemporaryConnectionPool('test_pool', max_size=1, timeout=0.01, keep_open=True)
+
+    def test_timeout(self):
+        with self.pool.get():
+            try:
+                with self.pool.get():
+                    pass
+                self.fail('PoolTimeoutError was not raised, it should have been.')
+            except PoolTimeoutError:
+                pass
+        self.assertEqual(self.pool.stats()['timeouts'], 1)
+
+    def test_interrupted(self):
+        try:
+            with self.pool.get() as alias:
+                with connection_state.force(alias):
+                    connections[alias].cursor().execute('SELECT 1')
+                raise KeyboardInterrupt
+        except KeyboardInterrupt:
+            pass
+        # The alias was returned to the pool, and its connection discarded.
+        stats = self.pool.stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['discards'], 1)
+        with self.pool.get():
+            pass
+
+    def test_new_connection_fails(self):
+        def fail():
+            raise DatabaseError('could not connect')
+
+        new_connection = self.pool._new_connection
+        self.pool._new_connection = fail
+        for attempt in range(2):
+            self.assertRaises(DatabaseError, self.pool.acquire)
+        self.assertEqual(self.pool.stats()['size'], 0)
+
+        # The failures didn't use up the pool's only slot.
+        self.pool._new_connection = new_connection
+        with self.pool.get():
+            pass
+
+
+class WorkerPoolTestCase(TestCase):
+
+    def test_exit(self):
+        pool = WorkerPool('test', 1)
+
+        def exit():
+            raise SystemExit
+
+        future = pool.submit(exit)
+        self.assertTrue(future.wait(1))
+        self.assertRaises(SystemExit, future.result)
+
+        # The thread which exited is replaced by another.
+        self.assertEqual(pool.submit(lambda: 'done').result(), 'done')
+        self.assertEqual(len(pool.threads), 1)
+        self.assertTrue(pool.drain(1))
+
+
+class ParallelTestCase(TestCase):
+
+    def test_parallel(self):
+        def query():
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            return connection.alias, cursor.fetchone()[0]
+
+        results = parallel(query, lambda: 2)
+        # The query used a pooled connection to a read-only database.
+        self.assertTrue(results[0][0].split('_parallel')[0] in config.READ_ONLY_DATABASES)
+        self.assertEqual(results[0][1], 1)
+        self.assertEqual(results[1], 2)
+
+    def test_error(self):
+        def fail():
+            raise ValueError
+        self.assertRaises(ValueError, parallel, lambda: 1, fail)
+
+
+class PersistentConnectionsTestCase(TestCase):
+
+    def setUp(self):
+        self.alias = config.READ_ONLY_DATABASES[0]
+        self.conn_max_ages = config.CONN_MAX_AGES
+        config.CONN_MAX_AGES = {self.alias: 60}
+        with connection_state.force(None):
+            self.wrapper = connections[self.alias]
+            self.wrapper.cursor()
+            connection_opened(sender=None, connection=self.wrapper)
+
+    def tearDown(self):
+        config.CONN_MAX_AGES = self.conn_max_ages
+
+    def get_connection(self):
+        with connection_state.force(None):
+            return self.wrapper.connection
+
+    def test_kept(self):
+        connection = self.get_connection()
+        release_connections()
+        check_connections()
+        self.assertTrue(self.get_connection() is connection)
+
+    def test_too_old(self):
+        with connection_state.force(None):
+            self.wrapper.readwrite_opened = (self.wrapper.connection, time.time() - 61)
+        check_connections()
+        self.assertEqual(self.get_connection(), None)
+
+    def test_closed_while_idle(self):
+        release_connections()
+        with connection_state.force(None):
+            self.wrapper.readwrite_released = (self.wrapper.connection, time.time() - 31)
+        # The database server closed the connection between requests.
+        self.get_connection().close()
+        check_connections()
+        self.assertEqual(self.get_connection(), None)
+
+    def test_recently_used(self):
+        release_connections()
+        connection = self.get_connection()
+        # It isn't checked with a query, so a broken one is still kept.
+        connection.close()
+        check_connections()
+        self.assertTrue(self.get_connection() is connection)
+        with connection_state.force(None):
+            self.wrapper.connection = None
+
+    def test_database_error(self):
+        with connection_state.force(None):
+            connection_errors.query_failed(self.wrapper, 'SELECT', (), DatabaseError())
+        self.get_connection().close()
+        release_connections()
+        self.assertEqual(self.get_connection(), None)
+
+    def test_not_in_transaction(self):
+        connection = self.get_connection()
+        stand_in = RecordingConnection()
+        with connection_state.force(None):
+            self.wrapper.connection = stand_in
+            self.wrapper.readwrite_opened = (stand_in, time.time())
+        try:
+            release_connections()
+            self.assertEqual(stand_in.rollbacks, 0)
+            stand_in.status = 2
+            release_connections()
+            self.assertEqual(stand_in.rollbacks, 1)
+            self.assertTrue(self.get_connection() is stand_in)
+        finally:
+            with connection_state.force(None):
+                self.wrapper.connection = connection
+
+
+class RecordingConnection(object):
+    """A stand-in for a psycopg2 connection which records rollbacks."""
+
+    def __init__(self):
+        self.status = 0
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class PinningTestCase(TestCase):
+
+    def setUp(self):
+        self.pin_after_write = config.PIN_AFTER_WRITE
+        self.pin_ttls = config.PIN_TTLS
+        config.PIN_AFTER_WRITE = 'cookie'
+        config.PIN_TTLS = {DEFAULT_DB_ALIAS: 60}
+
+    def tearDown(self):
+        config.PIN_AFTER_WRITE = self.pin_after_write
+        config.PIN_TTLS = self.pin_ttls
+
+    def get_request(self, cookie):
+        request = HttpRequest()
+        request.COOKIES[config.PIN_COOKIE_NAME] = cookie
+        return request
+
+    def get_cookie(self):
+        response = HttpResponse()
+        set_pin(HttpRequest(), response, DEFAULT_DB_ALIAS)
+        return response.cookies[config.PIN_COOKIE_NAME].value
+
+    def test_signed(self):
+        cookie = self.get_cookie()
+        self.assertEqual(get_pin(self.get_request(cookie)), DEFAULT_DB_ALIAS)
+
+    def test_tampered(self):
+        value, signature = self.get_cookie().rsplit(':', 1)
+        alias, expires = value.rsplit(':', 1)
+        # Extending the pin breaks the signature.
+        value = '%s:%f' % (alias, float(expires) + 3600)
+        self.assertEqual(get_pin(self.get_request('%s:%s' % (value, signature))), None)
+        # So does signing without the salt.
+        signature = hmac.new(settings.SECRET_KEY, value, hashlib.sha1).hexdigest()
+        self.assertEqual(get_pin(self.get_request('%s:%s' % (value, signature))), None)
+        self.assertEqual(get_pin(self.get_request('garbage')), None)
+
+    def test_expired(self):
+        value = '%s:%f' % (DEFAULT_DB_ALIAS, time.time() - 1)
+        self.assertEqual(get_pin(self.get_request('%s:%s' % (value, sign(value)))), None)
+
+
+class OffloadingTestCase(TestCase):
+
+    def setUp(self):
+        pre_save.connect(stop_offloading, dispatch_uid='django_readwrite.cursors.stop_offloading')
+
+    def tearDown(self):
+        if not config.OFFLOAD_READS:
+            pre_save.disconnect(dispatch_uid='django_readwrite.cursors.stop_offloading')
+        request_state.reset()
+
+    def test_save_stops_offloading(self):
+        request_state.offload_alias = config.READ_ONLY_DATABASES[0]
+        ContentType(name='test', app_label='django_readwrite', model='test').save()
+        self.assertEqual(request_state.offload_alias, None)
+
+    def test_closes_connection(self):
+        offload_reads = config.OFFLOAD_READS
+        config.OFFLOAD_READS = True
+        middleware = MultiDBMiddleware()
+        request = HttpRequest()
+        request.method = 'POST'
+        try:
+            middleware.process_request(request)
+            alias = request_state.offload_alias
+            self.assertTrue(alias in config.READ_ONLY_DATABASES_SET)
+            with connection_state.force(None):
+                connections[alias].close()
+            connection.cursor().execute('SELECT 1')
+            with connection_state.force(None):
+                self.assertFalse(connections[alias].connection is None)
+            middleware.cleanup()
+            with connection_state.force(None):
+                self.assertTrue(connections[alias].connection is None)
+        finally:
+            config.OFFLOAD_READS = offload_reads
+            del connection_state.alias
+
+
+class ReplicationLagTestCase(TestCase):
+
+    def setUp(self):
+        connections.databases['lag_test'] = {'ENGINE': 'django.db.backends.dummy'}
+        self.monitor = ReplicationLagMonitor({'lag_test': 10}, interval=60)
+        # Don't start the background thread.
+        self.monitor.pid = os.getpid()
+
+    def tearDown(self):
+        del connections.databases['lag_test']
+
+    def test_unmeasurable(self):
+        self.assertEqual(self.monitor.filter(['lag_test']), ['lag_test'])
+        self.monitor.check()
+        self.assertTrue(self.monitor.is_lagging('lag_test'))
+        self.assertEqual(self.monitor.filter(['lag_test']), [])
+
+    def test_rolls_back(self):
+        alias = config.READ_ONLY_DATABASES[0]
+        rollbacks = []
+        connections.databases[alias]['LAG_QUERY'] = 'SELECT 3'
+        with connection_state.force(None):
+            connections[alias]._rollback = lambda: rollbacks.append(alias)
+        try:
+            self.assertEqual(self.monitor.measure(alias), 3)
+        finally:
+            del connections.databases[alias]['LAG_QUERY']
+            with connection_state.force(None):
+                del connections[alias]._rollback
+        self.assertEqual(rollbacks, [alias])
+
+
+class NPlusOneTestCase(TestCase):
+
+    def setUp(self):
+        self.detector = NPlusOneDetector(threshold=2, strict=True)
+        self.queries = []
+        observer = self
+
+        class Observer(object):
+            def query_executed(self, db, sql, params, read_sql, elapsed):
+                observer.queries.append(sql)
+
+            def query_failed(self, db, sql, params, error):
+                pass
+
+        self.observers = list(query_observers)
+        query_observers[:] = [self.detector, Observer()]
+
+    def tearDown(self):
+        query_observers[:] = self.observers
+        request_state.reset()
+
+    def test_strict(self):
+        request = HttpRequest()
+        request.path = '/'
+        self.detector.start()
+        for number in range(4):
+            connection.cursor().execute('SELECT %s' % number)
+        # The observers after the detector still saw every query.
+        self.assertEqual(len(self.queries), 4)
+        self.assertRaises(NPlusOneError, self.detector.finish, request)
+
+
+def read_view(request):
+    pass
+
+
+def write_view(request):
+    pass
+
+
+class RoutingAdvisorTestCase(TestCase):
+
+    def setUp(self):
+        self.advisor = RoutingAdvisor(table_size=10, flush_interval=0)
+
+    def tearDown(self):
+        clear_shared_table()
+        cache.delete(CLEARED_KEY)
+        request_state.reset()
+
+    def request(self, view_func, queries):
+        request = HttpRequest()
+        request.method = 'GET'
+        self.advisor.start('method')
+        self.advisor.view(view_func)
+        with connection_state.force(None):
+            for alias, sql in queries:
+                self.advisor.query_executed(connections[alias], sql, (), sql.startswith('SELECT'), 0.01)
+        self.advisor.finish(request)
+
+    def test_record(self):
+        self.request(read_view, [(DEFAULT_DB_ALIAS, 'SELECT 1'), (DEFAULT_DB_ALIAS, 'SELECT 2')])
+        self.request(read_view, [(DEFAULT_DB_ALIAS, 'SELECT 1')])
+        self.request(write_view, [(DEFAULT_DB_ALIAS, 'UPDATE t1 SET a = 1')])
+
+        records = dict((record.view, record) for record in get_shared_table())
+        record = records['django_readwrite.tests.read_view']
+        self.assertEqual((record.method, record.requests, record.writes), ('GET', 2, 0))
+        self.assertEqual(record.routing, {'method': 2})
+        self.assertEqual(record.databases[DEFAULT_DB_ALIAS][0], 3)
+        self.assertEqual(records['django_readwrite.tests.write_view'].writes, 1)
+
+    def test_report(self):
+        self.request(read_view, [(DEFAULT_DB_ALIAS, 'SELECT 1')])
+        self.request(write_view, [(DEFAULT_DB_ALIAS, 'UPDATE t1 SET a = 1')])
+
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            call_command('readwrite_advisor', 'report', min_requests=1)
+            call_command('readwrite_advisor', 'clear')
+        finally:
+            sys.stdout = stdout
+
+        report = output.getvalue()
+        self.assertTrue('GET django_readwrite.tests.read_view' in report)
+        self.assertTrue('routed by method for 1 requests: use @use_replica' in report)
+        self.assertFalse('write_view' in report)
+        self.assertEqual(list(get_shared_table()), [])
+
+
+class QueryProfilerTestCase(TestCase):
+
+    def setUp(self):
+        self.profiler = QueryProfiler(sample_rate=1, server_timing=True)
+        self.sent = []
+        signals.request_query_stats.connect(self.received)
+
+    def tearDown(self):
+        signals.request_query_stats.disconnect(self.received)
+        request_state.reset()
+
+    def received(self, sender, request, stats, **kwargs):
+        self.sent.append((request, stats))
+
+    def test_request(self):
+        alias = config.READ_ONLY_DATABASES[0]
+        self.profiler.start()
+        with connection_state.force(None):
+            for db, elapsed in ((connections[DEFAULT_DB_ALIAS], 0.002), (connections[alias], 0.0005), (connections[alias], 0.2)):
+                self.profiler.query_executed(db, 'SELECT 1', (), True, elapsed)
+
+        request = HttpRequest()
+        response = HttpResponse()
+        self.profiler.finish(request, response)
+
+        self.assertEqual(
+            response['Server-Timing'],
+            'db;dur=202.500;desc="3 queries", '
+            'db-%s;dur=2.000;desc="1 queries", '
+            'db-%s;dur=200.500;desc="2 queries"' % (DEFAULT_DB_ALIAS, alias),
+        )
+        self.assertEqual(len(self.sent), 1)
+        self.assertTrue(self.sent[0][0] is request)
+        stats = self.sent[0][1]
+        self.assertEqual(stats.count, 3)
+        self.assertEqual(stats.databases[DEFAULT_DB_ALIAS][0], 1)
+        self.assertEqual(stats.databases[alias][0], 2)
+        self.assertEqual(stats.databases[alias][2], [1, 0, 0, 0, 0, 1, 0, 0])
+        self.assertEqual(request_state.query_stats, None)
+
+    def test_not_sampled(self):
+        self.profiler.sample_rate = 0
+        self.profiler.start()
+        response = HttpResponse()
+        self.profiler.finish(HttpRequest(), response)
+        self.assertFalse(response.has_header('Server-Timing'))
+        self.assertEqual(self.sent, [])
+
+
+class BackgroundPostCommitTestCase(TestCase):
+
+    def setUp(self):
+        self.background_pool = signals.background_pool
+        self.queue_full = config.POST_COMMIT_QUEUE_FULL
+        signals.background_pool = WorkerPool('test-post-commit', 1, max_queue=1)
+        self.errors = []
+        signals.post_commit_failed.connect(self.failed)
+
+    def tearDown(self):
+        signals.post_commit_failed.disconnect(self.failed)
+        signals.background_pool = self.background_pool
+        config.POST_COMMIT_QUEUE_FULL = self.queue_full
+
+    def failed(self, sender, func, error, **kwargs):
+        self.errors.append(error)
+
+    def fail_later(self):
+        raise ValueError('failed')
+
+    def fill_queue(self):
+        """Keeps the worker busy and its queue full, until the returned event is set."""
+        started = threading.Event()
+        finish = threading.Event()
+
+        def block():
+            started.set()
+            finish.wait()
+
+        signals.run_in_background(block)
+        started.wait()
+        signals.run_in_background(lambda: None)
+        return finish
+
+    def test_background(self):
+        threads = []
+        signals.run_in_background(lambda: threads.append(threading.current_thread()))
+        signals.run_in_background(self.fail_later)
+        self.assertTrue(signals.background_pool.drain(1))
+        self.assertFalse(threads[0] is threading.current_thread())
+        self.assertEqual([str(error) for error in self.errors], ['failed'])
+
+    def test_queue_full_inline(self):
+        config.POST_COMMIT_QUEUE_FULL = 'inline'
+        finish = self.fill_queue()
+        called = []
+        signals.run_in_background(lambda: called.append(threading.current_thread()))
+        # The error is reported rather than raised from the commit.
+        signals.run_in_background(self.fail_later)
+        finish.set()
+        self.assertEqual(called, [threading.current_thread()])
+        self.assertEqual(len(self.errors), 1)
+        self.assertTrue(signals.background_pool.drain(1))
+
+    def test_queue_full_drop(self):
+        config.POST_COMMIT_QUEUE_FULL = 'drop'
+        finish = self.fill_queue()
+        called = []
+        signals.run_in_background(lambda: called.append(True))
+        finish.set()
+        self.assertTrue(signals.background_pool.drain(1))
+        self.assertEqual(called, [])
+
+    def test_drain_timeout(self):
+        finish = self.fill_queue()
+        self.assertFalse(signals.background_pool.drain(0.01))
+        finish.set()
+        self.assertTrue(signals.background_pool.drain(1))
+
+    def test_pre_commit_background(self):
+        self.assertRaises(TypeError, pre_commit, background=True)
+
+
+class BalancerTestCase(TestCase):
+
+    def test_weighted(self):
+        balancer = WeightedBalancer({'a': 1, 'b': 0})
+        for number in range(20):
+            self.assertEqual(balancer.choose(['a', 'b']), 'a')
+
+    def test_least_outstanding(self):
+        balancer = LeastOutstandingBalancer()
+        balancer.started('a')
+        for number in range(20):
+            self.assertEqual(balancer.choose(['a', 'b']), 'b')
+        balancer.finished('a')
+        balancer.started('b')
+        self.assertEqual(balancer.choose(['a', 'b']), 'a')
+
+    def test_ewma(self):
+        balancer = EWMABalancer(decay=0.5)
+
+        class Database(object):
+            def __init__(self, alias):
+                self.alias = alias
+
+        balancer.query_executed(Database('a'), 'SELECT 1', (), True, 0.5)
+        balancer.query_executed(Database('b'), 'SELECT 1', (), True, 0.1)
+        balancer.query_executed(Database('b'), 'SELECT 1', (), True, 0.3)
+        self.assertEqual(balancer.latencies['b'], 0.2)
+        self.assertEqual(balancer.choose(['a', 'b']), 'b')
+
+
+class CircuitBreakerTestCase(TestCase):
+
+    def setUp(self):
+        self.alias = config.READ_ONLY_DATABASES[0]
+        self.breakers = CircuitBreakers(failures=2, timeout=60)
+        self.breaker = self.breakers[self.alias]
+        # Don't start the timer for the probe.
+        self.breaker.open = lambda: self.breaker.change_state(OPEN)
+
+    def fail(self, error, sql='SELECT 1'):
+        with connection_state.force(None):
+            self.breakers.query_failed(connections[self.alias], sql, (), error)
+
+    def test_opens(self):
+        OperationalError = self.breakers.connection_errors[0]
+        self.fail(OperationalError())
+        with connection_state.force(None):
+            self.breakers.query_executed(connections[self.alias], 'SELECT 1', (), True, 0)
+        self.fail(OperationalError())
+        self.assertEqual(self.breaker.state, CLOSED)
+        # Failing to connect.
+        self.fail(DatabaseError(), sql=None)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breakers.filter([self.alias, DEFAULT_DB_ALIAS]), [DEFAULT_DB_ALIAS])
+
+    def test_query_errors(self):
+        # Errors from the query itself, such as a missing table.
+        with connection_state.force(None):
+            try:
+                connections[self.alias].cursor().execute('SELECT * FROM readwrite_missing')
+            except DatabaseError as error:
+                pass
+        for number in range(3):
+            self.fail(error)
+            self.fail(IntegrityError())
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_probe(self):
+        self.breaker.change_state(OPEN)
+        self.breaker.probe()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual(self.breakers.filter([self.alias]), [self.alias])
@@ -0,0 +1,59 @@
+"""
+Lazily started transactions for MultiDBTransactionMiddleware.
+
+When READWRITE_LAZY_TRANSACTIONS is enabled, the middleware only marks a
+request using a writeable database as needing a transaction. The
+transaction is started by RestrictedCursorWrapper just before the first
+write query, or by the view entering transaction management itself, so
+the request's transaction is always the outermost one. It is also started
+by anything which expects the request to be under transaction management
+already: committing, rolling back, creating a savepoint, marking the
+transaction dirty or clean, and queueing pre-commit or post-commit
+functions. Requests which never do any of these don't enter transaction
+management at all.
+
+"""
+
+from django.db import connection, transaction
+
+from django_readwrite.connection import request_state
+
+
+class LazyTransactions(object):
+    """Starts the pending transactions, and counts how many were avoided."""
+
+    def __init__(self):
+        self.started = 0
+        self.avoided = 0
+
+    def defer(self):
+        """Marks the current request as needing a transaction."""
+        request_state.transaction_pending = True
+
+    def start(self):
+        """Starts the current request's pending transaction."""
+        request_state.transaction_pending = False
+        self.started += 1
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        request_state.transaction_alias = connection.alias
+
+    def start_pending(self, using=None):
+        """Starts the current request's transaction if it is pending for the given database."""
+        if request_state.transaction_pending and (using is None or using == connection.alias):
+            self.start()
+
+    def cancel(self):
+        """Forgets the current request's transaction if it never started."""
+        if request_state.transaction_pending:
+            request_state.transaction_pending = False
+            self.avoided += 1
+
+    def stats(self):
+        return {
+            'started': self.started,
+            'avoided': self.avoided,
+        }
+
+
+lazy_transactions = LazyTransactions()
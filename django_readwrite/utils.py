@@ -0,0 +1,76 @@
+import itertools
+import threading
+
+
+class LRUCache(object):
+    """
+    A bounded cache which discards the least recently used items when it
+    grows past max_size. It is meant for small values which are looked up
+    very frequently, such as the results of parsing SQL or request paths.
+
+    Lookups don't take a lock. Each item records when it was last used,
+    and when the cache is full the oldest tenth of the items are discarded
+    in one go. This makes lookups much cheaper than keeping the items in
+    order, at the cost of the hit and miss counts (and the recency of
+    items being used by several threads at once) being approximate.
+
+    """
+
+    missed = object()
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = {}
+        self.clock = itertools.count()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        try:
+            entry = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        entry[1] = next(self.clock)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        self.data[key] = [value, next(self.clock)]
+        if len(self.data) > self.max_size:
+            self.evict()
+
+    def values(self):
+        return [entry[0] for entry in list(self.data.values())]
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def evict(self):
+        """Discards the least recently used items."""
+        with self.lock:
+            excess = len(self.data) - self.max_size
+            if excess > 0:
+                entries = sorted(self.data.items(), key=lambda item: item[1][1])
+                for key, entry in entries[:excess + self.max_size // 10]:
+                    self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,149 @@
+"""
+A bounded pool of worker threads, for running database work in the
+background. Threads are started as they are needed, up to max_workers,
+and are started again in each process, so they survive servers that fork
+their workers. With max_queue, at most that many functions can be waiting
+for a thread, and submit() raises Queue.Full when there are more.
+
+"""
+
+import logging
+import os
+import sys
+import threading
+import time
+
+from Queue import Queue
+
+
+class Future(object):
+    """The result of a function submitted to a WorkerPool."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """Waits for the function to finish, and returns whether it did."""
+        self.event.wait(timeout)
+        return self.event.is_set()
+
+    def result(self):
+        """Waits for the function to finish, and returns its result or raises its exception."""
+        self.event.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def set_result(self, value):
+        self.value = value
+        self.event.set()
+
+    def set_exception(self, exc_info):
+        self.exc_info = exc_info
+        self.event.set()
+
+
+class WorkerPool(object):
+
+    def __init__(self, name, max_workers, max_queue=0):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pid = None
+        self.queue = None
+        self.threads = []
+        self.idle = 0
+
+    def in_worker(self):
+        """Checks if the current thread is one of this pool's workers."""
+        return getattr(self.local, 'worker', False)
+
+    def has_capacity(self):
+        """Checks if a submitted function could start straight away."""
+        if self.pid != os.getpid() or len(self.threads) < self.max_workers:
+            return True
+        return self.idle > self.queue.qsize()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queues a function to be called by a worker thread, and returns a
+        Future for its result. Raises Queue.Full if the queue is full.
+
+        """
+        future = Future()
+        with self.lock:
+            if self.pid != os.getpid():
+                # Threads don't survive forking, so start again.
+                self.pid = os.getpid()
+                self.queue = Queue(self.max_queue)
+                self.threads = []
+                self.idle = 0
+            self.queue.put_nowait((future, func, args, kwargs))
+            self.start_thread()
+        return future
+
+    def start_thread(self):
+        """
+        Starts another thread if there are more functions waiting than
+        threads waiting for them. This must be called with the lock held.
+
+        """
+        if self.queue.qsize() > self.idle and len(self.threads) < self.max_workers:
+            thread = threading.Thread(target=self.run, args=(self.queue,), name='%s-%d' % (self.name, len(self.threads) + 1))
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+
+    def run(self, queue):
+        self.local.worker = True
+        try:
+            while True:
+                with self.lock:
+                    self.idle += 1
+                future, func, args, kwargs = queue.get()
+                with self.lock:
+                    self.idle -= 1
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as error:
+                    future.set_exception(sys.exc_info())
+                    if not isinstance(error, Exception):
+                        # Let SystemExit or GreenletExit end the thread.
+                        raise
+                finally:
+                    queue.task_done()
+        finally:
+            with self.lock:
+                if queue is self.queue:
+                    # Replace this thread if it is still needed.
+                    self.threads.remove(threading.current_thread())
+                    self.start_thread()
+
+    def drain(self, timeout=None):
+        """
+        Waits for the queued functions to finish, for up to timeout seconds.
+        Returns whether they all did.
+
+        """
+        queue = self.queue
+        if queue is None or self.pid != os.getpid():
+            return True
+        deadline = timeout is not None and time.time() + timeout
+        with queue.all_tasks_done:
+            while queue.unfinished_tasks:
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        logging.warning('%d functions were still queued in the %s worker pool.' % (queue.unfinished_tasks, self.name))
+                        return False
+                    queue.all_tasks_done.wait(remaining)
+                else:
+                    queue.all_tasks_done.wait()
+        return True